@@ -0,0 +1,225 @@
+"""Benchmark of the ASGI middleware against the BaseHTTPMiddleware version.
+
+Requests are driven the way uvicorn drives an application: each request
+is a task calling the application with its own receive and send, with a
+number of requests in flight at once. The request body arrives in chunks,
+and the response is streamed in chunks. Compares:
+  - the bare Starlette application.
+  - the previous middleware, built on starlette's BaseHTTPMiddleware,
+    which buffers the request before calling the application and wraps
+    the response (reproduced here as LegacyASGIMetricsMiddleware).
+  - ASGIMetricsMiddleware, which taps the ASGI messages.
+
+Reports requests/sec, p50/p99 latency, and the p50 time until the
+application reads the first request chunk.
+
+Usage:
+  python benchmarks/bench_asgi.py [--concurrency 1,64] [--requests 2000]
+"""
+import argparse
+import asyncio
+from collections import deque
+import json
+import os
+import tempfile
+import time
+
+from starlette.applications import Starlette
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route
+
+from metricrule.agent import ASGIMetricsMiddleware
+from metricrule.agent.mrmetric import MetricContext
+from metricrule.agent.mrrecorder import get_sample_point, is_json_content_type
+from metricrule.agent.mrrecorder import log_request_metrics, log_response_metrics
+from metricrule.agent.mrreload import ReloadableConfig
+
+_CONFIG = '''
+input_content_filter: ".instances[*]"
+input_metrics {{
+    name: "{prefix}_feature"
+    value {{
+        value {{
+            parsed_value {{
+                field_path: ".feature[0]"
+                parsed_type: FLOAT
+            }}
+        }}
+    }}
+}}
+output_content_filter: ".predictions[*]"
+output_metrics {{
+    name: "{prefix}_prediction"
+    value {{
+        value {{
+            parsed_value {{
+                field_path: "[0]"
+                parsed_type: FLOAT
+            }}
+        }}
+    }}
+}}
+'''
+
+
+class LegacyASGIMetricsMiddleware(BaseHTTPMiddleware):
+    """The middleware as it was before it handled ASGI messages directly.
+    """
+
+    def __init__(self, app, config_path):
+        super().__init__(app)
+        self._agent = ReloadableConfig(config_path)
+
+    async def dispatch(self, request, call_next):
+        request_body = await request.body()
+        sample_point = get_sample_point(None, request_body)
+        state = self._agent.state
+        context_labels = deque()
+        log_request_metrics(state.config, state.instruments[MetricContext.INPUT],
+                            request_body, context_labels, sample_point,
+                            content_type=request.headers.get('content-type'))
+        response = await call_next(request)
+        if response.status_code != 200:
+            return response
+        return _LoggingResponse(response, lambda body: log_response_metrics(
+            state.config, state.instruments[MetricContext.OUTPUT], body,
+            context_labels, sample_point))
+
+
+class _LoggingResponse(Response):
+    def __init__(self, original_response, log_fn):  # pylint: disable=super-init-not-called
+        self.original_response = original_response
+        self.log_fn = log_fn
+        self.chunks = []
+        self.capturing = True
+
+    async def __call__(self, scope, receive, send):
+        async def logging_send(message):
+            if message['type'] == 'http.response.start':
+                headers = dict(message.get('headers', ()))
+                self.capturing = is_json_content_type(
+                    headers.get(b'content-type', b'').decode('latin-1'))
+            elif self.capturing:
+                self.chunks.append(message.get('body', b''))
+                if not message.get('more_body', False):
+                    self.log_fn(b''.join(self.chunks))
+            await send(message)
+
+        await self.original_response(scope, receive, logging_send)
+
+
+def _make_bodies(rows):
+    request = {'instances': [{'feature': [row % 100 / 10]} for row in range(rows)]}
+    response = {'predictions': [[row % 10 / 10] for row in range(rows)]}
+    return json.dumps(request).encode(), json.dumps(response).encode()
+
+
+def _make_app(response_body, read_times):
+    async def predict(request):
+        read_times.append(time.perf_counter())
+        await request.body()
+
+        async def chunks():
+            middle = len(response_body) // 2
+            yield response_body[:middle]
+            yield response_body[middle:]
+        return StreamingResponse(chunks(), media_type='application/json')
+    return Starlette(routes=[Route('/predict', predict, methods=['POST'])])
+
+
+async def _request(app, request_body, chunk_bytes):
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+             'method': 'POST', 'scheme': 'http', 'path': '/predict', 'raw_path': b'/predict',
+             'root_path': '', 'query_string': b'', 'server': ('127.0.0.1', 8000),
+             'client': ('127.0.0.1', 50000),
+             'headers': [(b'content-type', b'application/json'),
+                         (b'content-length', str(len(request_body)).encode())]}
+    chunks = deque(request_body[i:i + chunk_bytes]
+                   for i in range(0, len(request_body), chunk_bytes))
+    complete = asyncio.Event()
+
+    async def receive():
+        if len(chunks) > 0:
+            body = chunks.popleft()
+            # Yield to other requests, as a socket read would.
+            await asyncio.sleep(0)
+            return {'type': 'http.request', 'body': body, 'more_body': len(chunks) > 0}
+        await complete.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.body' and not message.get('more_body', False):
+            complete.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return start, time.perf_counter()
+
+
+async def _run(app, request_body, args, concurrency, read_times):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, read_delays = [], []
+
+    async def one():
+        async with semaphore:
+            read_count = len(read_times)
+            start, end = await _request(app, request_body, args.chunk_bytes)
+            latencies.append(end - start)
+            if len(read_times) > read_count:
+                read_delays.append(read_times[read_count] - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(args.requests)))
+    return args.requests / (time.perf_counter() - started), latencies, read_delays
+
+
+def _percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=_int_list, default=[1, 16, 64],
+                        help='Comma separated numbers of requests in flight')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='Requests per benchmark')
+    parser.add_argument('--rows', type=int, default=32,
+                        help='Instances per request')
+    parser.add_argument('--chunk-bytes', type=int, default=512,
+                        help='Size of the chunks the request body arrives in')
+    args = parser.parse_args()
+
+    request_body, response_body = _make_bodies(args.rows)
+    print(f'{"middleware":<12}{"conc":>6}{"req/s":>10}{"p50 us":>10}{"p99 us":>10}'
+          f'{"read p50 us":>13}')
+    for index, (name, middleware) in enumerate((
+            ('none', None), ('legacy', LegacyASGIMetricsMiddleware),
+            ('asgi', ASGIMetricsMiddleware))):
+        with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+            config_file.write(_CONFIG.format(prefix=f'bench_asgi{index}'))
+        try:
+            read_times = []
+            app = _make_app(response_body, read_times)
+            if middleware is not None:
+                app.add_middleware(middleware, config_path=config_file.name)
+            for concurrency in args.concurrency:
+                asyncio.run(_run(app, request_body, args, concurrency, read_times))  # warmup
+                read_times.clear()
+                rate, latencies, read_delays = asyncio.run(
+                    _run(app, request_body, args, concurrency, read_times))
+                print(f'{name:<12}{concurrency:>6}{rate:>10.0f}'
+                      f'{_percentile(latencies, 0.5) * 1e6:>10.1f}'
+                      f'{_percentile(latencies, 0.99) * 1e6:>10.1f}'
+                      f'{_percentile(read_delays, 0.5) * 1e6:>13.1f}')
+        finally:
+            os.remove(config_file.name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""Benchmark of the import time of the agent, as paid on cold starts.
+
+Each statement is run in a new interpreter, so that no module is already
+imported, and timed by the interpreter itself. Reports the median and
+minimum over runs, and the heavy dependencies each statement imported.
+A WSGI server should import neither starlette nor jsonpath_ng, and no
+integration should import protobuf until a config is loaded.
+
+Usage:
+  python benchmarks/bench_import.py [--runs 20]
+  python -X importtime -c 'import metricrule.agent.wsgi'  # for details
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+_STATEMENTS = (
+    'import metricrule.agent',
+    'from metricrule.agent import WSGIMetricsMiddleware',
+    'from metricrule.agent import ASGIMetricsMiddleware',
+    'from metricrule.agent.mrconfig import load_config; load_config("")',
+    'from metricrule.agent import WSGIMetricsMiddleware; '
+    'from metricrule.agent import ASGIMetricsMiddleware',
+)
+_DEPENDENCIES = ('starlette', 'werkzeug', 'jsonpath_ng', 'google.protobuf',
+                 'prometheus_client', 'numpy')
+_SCRIPT = '''
+import sys, time, json
+start = time.perf_counter()
+{statement}
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, [name for name in {dependencies!r} if name in sys.modules]]))
+'''
+
+
+def _time_import(statement):
+    script = _SCRIPT.format(statement=statement, dependencies=_DEPENDENCIES)
+    output = subprocess.run([sys.executable, '-c', script], check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20,
+                        help='Interpreters started per statement')
+    args = parser.parse_args()
+
+    print(f'{"statement":<70}{"p50 ms":>9}{"min ms":>9}  imported')
+    for statement in _STATEMENTS:
+        timings = []
+        for _ in range(args.runs):
+            elapsed, imported = _time_import(statement)
+            timings.append(elapsed * 1e3)
+        label = statement if len(statement) <= 68 else statement[:65] + '...'
+        print(f'{label:<70}{statistics.median(timings):>9.1f}{min(timings):>9.1f}'
+              f'  {", ".join(imported)}')
+
+
+if __name__ == '__main__':
+    main()
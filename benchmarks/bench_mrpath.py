@@ -0,0 +1,69 @@
+"""Benchmark of path evaluation against the example config's paths.
+
+Compares, per path:
+  - jsonpath_ng parsing and evaluating the path on every call, as
+    mrmetric._extract_values did before configs were compiled.
+  - jsonpath_ng evaluating a pre-parsed path.
+  - the native evaluator in mrpath.
+
+Usage:
+  python benchmarks/bench_mrpath.py [--rows 100] [--number 2000]
+"""
+import argparse
+import timeit
+
+from jsonpath_ng import parse
+
+from metricrule.agent.mrpath import compile_path, FallbackPath
+
+
+def _make_payload(rows):
+    return {
+        'instances': [
+            {'Type': ['Cat' if i % 2 else 'Dog'], 'Breed1': [f'Breed{i % 7}']}
+            for i in range(rows)
+        ],
+        'predictions': [[i / rows] for i in range(rows)],
+    }
+
+
+def _uncompiled(path):
+    def evaluate(payload):
+        return [match.value for match in parse(path).find(payload)]
+    return evaluate
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=100,
+                        help='Number of instances / predictions in the payload')
+    parser.add_argument('--number', type=int, default=2000,
+                        help='Number of evaluations per measurement')
+    args = parser.parse_args()
+
+    payload = _make_payload(args.rows)
+    instance = payload['instances'][0]
+    prediction = payload['predictions'][0]
+    cases = (
+        ('$.instances[*]', payload),
+        ('$.predictions[*]', payload),
+        ('$.Breed1[0]', instance),
+        ('$.Type[0]', instance),
+        ('$[0]', prediction),
+    )
+
+    print(f'{"path":<20}{"uncompiled us":>15}{"jsonpath_ng us":>16}'
+          f'{"native us":>11}{"speedup":>9}')
+    for path, data in cases:
+        timings = []
+        for evaluate in (_uncompiled(path), FallbackPath(path), compile_path(path)):
+            assert evaluate(data) == _uncompiled(path)(data)
+            seconds = min(timeit.repeat(
+                lambda evaluate=evaluate: evaluate(data), number=args.number, repeat=3))
+            timings.append(seconds / args.number * 1e6)
+        print(f'{path:<20}{timings[0]:>15.2f}{timings[1]:>16.2f}'
+              f'{timings[2]:>11.2f}{timings[1] / timings[2]:>8.1f}x')
+
+
+if __name__ == '__main__':
+    main()
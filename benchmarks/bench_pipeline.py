@@ -0,0 +1,298 @@
+"""Benchmark suite for the metric pipeline and the middlewares.
+
+Covers, for every combination of the parameters:
+  - get_metric_instances and get_context_labels on a decoded payload.
+  - log_request_metrics and log_response_metrics on a raw body.
+  - WSGIMetricsMiddleware and ASGIMetricsMiddleware end to end, with
+    in-process test clients, against the same application without the
+    middleware.
+
+Each result reports ops/sec, p50/p99 latency (and for the middlewares,
+p50/p99 overhead over the bare application) and the peak memory allocated
+per operation. Results are written as JSON, and can be compared against a
+previous run.
+
+Usage:
+  python benchmarks/bench_pipeline.py --output results.json
+  python benchmarks/bench_pipeline.py --rows 1,1000 --metrics 1,20 \
+      --baseline previous.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from google.protobuf import text_format
+from starlette.applications import Starlette
+from starlette.responses import Response
+from starlette.routing import Route
+from starlette.testclient import TestClient
+from werkzeug.test import Client
+
+from metricrule.agent import ASGIMetricsMiddleware, WSGIMetricsMiddleware
+from metricrule.agent.mrmetric import compile_plan, get_context_labels, get_metric_instances
+from metricrule.agent.mrmetric import MetricContext
+from metricrule.agent.mrotel import initialize_all_instruments
+from metricrule.agent.mrrecorder import log_request_metrics, log_response_metrics
+from metricrule.config_gen.metric_configuration_pb2 import SidecarConfig
+
+_case_ids = itertools.count()
+
+
+def _make_config(prefix, num_metrics):
+    metrics = ''.join(f'''
+    input_metrics {{
+        name: "{prefix}_feature_{i}"
+        value {{
+            value {{
+                parsed_value {{
+                    field_path: ".feature_{i}[0]"
+                    parsed_type: FLOAT
+                }}
+            }}
+        }}
+        labels {{
+            label_key {{ string_value: "Category" }}
+            label_value {{
+                parsed_value {{
+                    field_path: ".category[0]"
+                    parsed_type: STRING
+                }}
+            }}
+        }}
+    }}''' for i in range(num_metrics))
+    return f'''
+    input_content_filter: ".instances[*]"
+    {metrics}
+    input_metrics {{
+        name: "{prefix}_input_count"
+        simple_counter {{}}
+    }}
+    output_content_filter: ".predictions[*]"
+    output_metrics {{
+        name: "{prefix}_prediction"
+        value {{
+            value {{
+                parsed_value {{
+                    field_path: "[0]"
+                    parsed_type: FLOAT
+                }}
+            }}
+        }}
+    }}
+    context_labels_from_input {{
+        label_key {{ string_value: "Segment" }}
+        label_value {{
+            parsed_value {{
+                field_path: ".segment"
+                parsed_type: STRING
+            }}
+        }}
+    }}
+    '''
+
+
+def _make_bodies(rows, num_metrics, cardinality, payload_bytes):
+    padding = 'x' * (payload_bytes // max(rows, 1))
+    instances = [
+        dict({f'feature_{i}': [(row * 7 + i) % 100 / 10] for i in range(num_metrics)},
+             category=[f'c{row % cardinality}'], segment='default', padding=padding)
+        for row in range(rows)
+    ]
+    request = {'instances': instances}
+    response = {'predictions': [[row % 10 / 10] for row in range(rows)]}
+    return json.dumps(request).encode(), json.dumps(response).encode()
+
+
+def _measure(fn, iterations, warmup=3):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        fn()
+        timings.append(time.perf_counter_ns() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timings, peak
+
+
+def _percentile(timings, fraction):
+    ordered = sorted(timings)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def _summarize(name, params, timings, peak, baseline_timings=None):
+    result = {
+        'benchmark': name,
+        'params': params,
+        'iterations': len(timings),
+        'ops_per_sec': len(timings) / (sum(timings) / 1e9),
+        'p50_us': _percentile(timings, 0.5) / 1e3,
+        'p99_us': _percentile(timings, 0.99) / 1e3,
+        'mean_us': statistics.fmean(timings) / 1e3,
+        'alloc_peak_kib': peak / 1024,
+    }
+    if baseline_timings is not None:
+        result['p50_overhead_us'] = result['p50_us'] - \
+            _percentile(baseline_timings, 0.5) / 1e3
+        result['p99_overhead_us'] = result['p99_us'] - \
+            _percentile(baseline_timings, 0.99) / 1e3
+    return result
+
+
+def _bench_pipeline(params, iterations):
+    prefix = f'bench{next(_case_ids)}'
+    config = SidecarConfig()
+    text_format.Parse(_make_config(prefix, params['metrics']), config)
+    plan = compile_plan(config)
+    instruments = initialize_all_instruments(plan)
+    request_body, response_body = _make_bodies(
+        params['rows'], params['metrics'], params['cardinality'], params['payload_bytes'])
+    request_obj = json.loads(request_body)
+
+    def log_both():
+        context_labels = []
+        log_request_metrics(plan, instruments[MetricContext.INPUT],
+                            request_body, context_labels)
+        log_response_metrics(plan, instruments[MetricContext.OUTPUT],
+                             response_body, context_labels)
+
+    cases = (
+        ('get_metric_instances',
+         lambda: get_metric_instances(plan, request_obj, MetricContext.INPUT)),
+        ('get_context_labels',
+         lambda: get_context_labels(plan, request_obj, MetricContext.INPUT)),
+        ('log_request_response_metrics', log_both),
+    )
+    for name, fn in cases:
+        timings, peak = _measure(fn, iterations)
+        yield _summarize(name, params, timings, peak)
+
+
+def _write_config(num_metrics):
+    with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+        config_file.write(_make_config(f'bench{next(_case_ids)}', num_metrics))
+    return config_file.name
+
+
+def _bench_middlewares(params, iterations):
+    request_body, response_body = _make_bodies(
+        params['rows'], params['metrics'], params['cardinality'], params['payload_bytes'])
+    wsgi_config_path = _write_config(params['metrics'])
+    asgi_config_path = _write_config(params['metrics'])
+    try:
+        def wsgi_app(environ, start_response):
+            environ['wsgi.input'].read()
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [response_body]
+        bare_wsgi = Client(wsgi_app)
+        wsgi = Client(WSGIMetricsMiddleware(wsgi_app, wsgi_config_path))
+
+        async def endpoint(request):
+            await request.body()
+            return Response(response_body, media_type='application/json')
+        bare_asgi_app = Starlette(routes=[Route('/predict', endpoint, methods=['POST'])])
+        asgi_app = Starlette(routes=[Route('/predict', endpoint, methods=['POST'])])
+        asgi_app.add_middleware(ASGIMetricsMiddleware, config_path=asgi_config_path)
+
+        def wsgi_post(client):
+            return lambda: client.post('/predict', data=request_body, buffered=True)
+
+        def asgi_post(client):
+            return lambda: client.post('/predict', content=request_body)
+
+        bare_timings, _ = _measure(wsgi_post(bare_wsgi), iterations)
+        timings, peak = _measure(wsgi_post(wsgi), iterations)
+        yield _summarize('wsgi_middleware', params, timings, peak, bare_timings)
+        with TestClient(bare_asgi_app) as bare_asgi, TestClient(asgi_app) as asgi:
+            bare_timings, _ = _measure(asgi_post(bare_asgi), iterations)
+            timings, peak = _measure(asgi_post(asgi), iterations)
+            yield _summarize('asgi_middleware', params, timings, peak, bare_timings)
+    finally:
+        os.remove(wsgi_config_path)
+        os.remove(asgi_config_path)
+
+
+def _metadata():
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'git_revision': revision,
+        'python': sys.version,
+        'platform': platform.platform(),
+    }
+
+
+def _key(result):
+    return result['benchmark'], json.dumps(result['params'], sort_keys=True)
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=_int_list, default=[1, 100],
+                        help='Comma separated batch rows per payload')
+    parser.add_argument('--metrics', type=_int_list, default=[1, 10],
+                        help='Comma separated numbers of input value metrics')
+    parser.add_argument('--cardinality', type=_int_list, default=[1, 50],
+                        help='Comma separated numbers of distinct label values')
+    parser.add_argument('--payload-bytes', type=_int_list, default=[0, 100000],
+                        help='Comma separated sizes of padding in the request')
+    parser.add_argument('--iterations', type=int, default=100,
+                        help='Measured operations per benchmark')
+    parser.add_argument('--skip-middlewares', action='store_true',
+                        help='Only benchmark the metric pipeline')
+    parser.add_argument('--output', help='Path to write JSON results to')
+    parser.add_argument('--baseline', help='Path of JSON results to compare to')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = {_key(r): r for r in json.load(baseline_file)['results']}
+
+    results = []
+    print(f'{"benchmark":<30}{"rows":>6}{"metrics":>8}{"card":>6}{"bytes":>8}'
+          f'{"ops/s":>10}{"p50 us":>10}{"p99 us":>10}{"peak KiB":>10}{"vs base":>9}')
+    for rows, metrics, cardinality, payload_bytes in itertools.product(
+            args.rows, args.metrics, args.cardinality, args.payload_bytes):
+        params = {'rows': rows, 'metrics': metrics,
+                  'cardinality': cardinality, 'payload_bytes': payload_bytes}
+        suites = [_bench_pipeline(params, args.iterations)]
+        if not args.skip_middlewares:
+            suites.append(_bench_middlewares(params, args.iterations))
+        for result in itertools.chain(*suites):
+            results.append(result)
+            previous = baseline.get(_key(result))
+            ratio = '' if previous is None else \
+                f'{result["ops_per_sec"] / previous["ops_per_sec"]:.2f}x'
+            print(f'{result["benchmark"]:<30}{rows:>6}{metrics:>8}{cardinality:>6}'
+                  f'{payload_bytes:>8}{result["ops_per_sec"]:>10.0f}'
+                  f'{result["p50_us"]:>10.1f}{result["p99_us"]:>10.1f}'
+                  f'{result["alloc_peak_kib"]:>10.1f}{ratio:>9}')
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump({'metadata': _metadata(), 'results': results}, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark of recording to one series from many threads.
+
+Compares the regular instruments, whose prometheus_client children are
+shared by all threads, with the sharded instruments, which accumulate in
+a shard per thread. Each thread records to the same counter and histogram
+series. Reports records/sec by number of threads.
+
+Usage:
+  python benchmarks/bench_shard.py [--threads 1,8] [--records 200000]
+"""
+import argparse
+import threading
+import time
+
+import prometheus_client
+
+from metricrule.agent.mrmetric import MetricInstrumentSpec
+from metricrule.agent.mrotel import initialize_instrument
+from metricrule.agent.mrshard import initialize_sharded_instrument
+
+
+def _run(instruments, num_threads, records):
+    barrier = threading.Barrier(num_threads + 1)
+    labels = {'Tag': 'hot'}
+
+    def record():
+        barrier.wait()
+        for index in range(records // num_threads):
+            for instrument in instruments:
+                instrument.record(index % 10 / 10, labels)
+
+    threads = [threading.Thread(target=record) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return records * len(instruments) / (time.perf_counter() - started)
+
+
+def _int_list(value):
+    return [int(part) for part in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=_int_list, default=[1, 4, 16],
+                        help='Comma separated numbers of recording threads')
+    parser.add_argument('--records', type=int, default=200000,
+                        help='Records per instrument per benchmark')
+    args = parser.parse_args()
+
+    print(f'{"instruments":<12}{"threads":>8}{"records/s":>12}')
+    for name, initialize in (('regular', initialize_instrument),
+                             ('sharded', initialize_sharded_instrument)):
+        instruments = [initialize(MetricInstrumentSpec(
+            instrument_type, float, f'bench_shard_{name}_{instrument_type.__name__.lower()}',
+            ('Tag',))) for instrument_type in (prometheus_client.Counter,
+                                               prometheus_client.Histogram)]
+        for num_threads in args.threads:
+            rate = _run(instruments, num_threads, args.records)
+            print(f'{name:<12}{num_threads:>8}{rate:>12.0f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,36 @@
 This package targets servers that serve trained ML models.
 
 Middleware and views are provided that conform to both the WSGI and
-ASGI specifications.
+ASGI specifications. They are imported on first access, so that a WSGI
+server does not import the ASGI framework, and the other way round.
 """
-from .asgi import ASGIApplication, ASGIMetricsMiddleware
-from .wsgi import WSGIApplication, WSGIMetricsMiddleware
+from typing import Any, TYPE_CHECKING
+import importlib
+
+if TYPE_CHECKING:
+    from .asgi import ASGIApplication, ASGIMetricsMiddleware
+    from .wsgi import WSGIApplication, WSGIMetricsMiddleware
 
 __all__ = ["ASGIApplication", "ASGIMetricsMiddleware",
            "WSGIApplication", "WSGIMetricsMiddleware"]
+
+# Modules of the attributes imported on first access.
+_LAZY_ATTRIBUTES = {
+    "ASGIApplication": ".asgi",
+    "ASGIMetricsMiddleware": ".asgi",
+    "WSGIApplication": ".wsgi",
+    "WSGIMetricsMiddleware": ".wsgi",
+}
+
+
+def __getattr__(name: str) -> Any:
+    module_name = _LAZY_ATTRIBUTES.get(name)
+    if module_name is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module_name, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__() -> list[str]:
+    return sorted(set(globals()) | set(__all__))
@@ -16,85 +16,293 @@ This module provides two classes:
      uvicorn main:app
 """
 from collections import deque
+import asyncio
+from typing import Any, Awaitable, Callable, Deque, Mapping, MutableMapping, Optional, Sequence
 
-from prometheus_client import make_asgi_app
-from starlette.middleware.base import BaseHTTPMiddleware, RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
+from .mrconfig import CardinalityConfig, DriftConfig, ExpositionConfig, MetricOptions, OTLPConfig
+from .mrconfig import RouteConfig, SamplingConfig
+from .mrexpose import ExpositionCache
+from .mrjson import JSONDecoder
+from .mrmetric import is_sampled, MetricContext
+from .mrprocess import get_scrape_registry
+from .mrroute import RouteTable
+from .mrrecorder import DEFAULT_MAX_CAPTURE_BYTES, get_sample_point, is_json_content_type
+from .mrrecorder import log_exchange_metrics, needs_request_body
 
-from .mrconfig import load_config
-from .mrotel import initialize_all_instruments
-from .mrmetric import MetricContext
-from .mrrecorder import log_request_metrics, log_response_metrics
+Message = MutableMapping[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
 
 
 class ASGIApplication:
     """An ASGI application to view collected metrics.
     """
     @staticmethod
-    def make():
+    def make(exposition: Optional[ExpositionConfig] = None):
         """Makes a new ASGI application.
-        """
-        return make_asgi_app()
 
+        In multi-process mode, the application serves the metrics of all
+        processes. Expositions are cached for a short time, and served
+        gzipped, in OpenMetrics or in protobuf as negotiated by scrapers.
+        Cached expositions are served from the event loop, and others are
+        rendered on the default executor, so that the loop keeps serving
+        requests meanwhile.
 
-class ASGIMetricsMiddleware(BaseHTTPMiddleware):
-    """ASGI middleware to log metrics for requests and responses.
-    """
+        Args:
+          exposition: Configuration of the cache and compression of
+            expositions.
+        """
+        cache = ExpositionCache(get_scrape_registry(), exposition or ExpositionConfig())
 
-    class LoggingResponse(Response):
-        """A response subclass that logs before forwarding the response.
+        async def metrics_app(scope: Message, receive: Receive, send: Send) -> None:
+            # pylint: disable=unused-argument
+            if scope['type'] != 'http':
+                return
+            request = (scope['method'], scope.get('query_string', b'').decode('latin-1'),
+                       _get_header(scope, b'accept') or '',
+                       _get_header(scope, b'accept-encoding') or '')
+            response = cache.respond_cached(*request)
+            if response is None:
+                response = await asyncio.get_running_loop().run_in_executor(
+                    None, cache.respond, *request)
+            await send({'type': 'http.response.start', 'status': response.status,
+                        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                    for name, value in response.headers]})
+            await send({'type': 'http.response.body', 'body': response.body})
+        return metrics_app
 
-        If the response is streamed, it will be cached until the payload
-        is complete and logging is done.
-        """
 
-        def __init__(self, original_response, log_fn):  # pylint: disable=super-init-not-called
-            # Super not called since StreamingResponse does not call Response.init,
-            # and so behavior is inconsistent.
-            self.original_response = original_response
-            self.log_fn = log_fn
-            self.chunks = b''
+class ASGIMetricsMiddleware:
+    """ASGI middleware to log metrics for requests and responses.
 
-        async def __call__(self, scope, receive, send) -> None:
-            async def logging_send(message) -> None:
-                if 'body' in message:
-                    self.chunks += message['body']
-                if not 'more_body' in message or not message['more_body']:
-                    self.log_fn(self.chunks)
-                await send(message)
+    The middleware only observes the messages passed between the server
+    and the application: request body chunks are kept as the application
+    receives them, and response body chunks as it sends them, up to a
+    capture limit. Metrics are recorded once the application returns,
+    after the response was sent. Requests whose body the application does
+    not read completely are not recorded.
 
-            await self.original_response(scope, receive, logging_send)
+    Attributes:
+        app: The ASGI application to forward requests to.
+    """
 
-    def __init__(self, app, config_path=None):
+    def __init__(self, app, config_path=None, *,  # pylint: disable=too-many-arguments
+                 sampling: Optional[SamplingConfig] = None,
+                 max_capture_bytes: Optional[int] = DEFAULT_MAX_CAPTURE_BYTES,
+                 json_decoder: Optional[JSONDecoder] = None,
+                 selective_decoding: bool = False,
+                 metric_options: Optional[Mapping[str, MetricOptions]] = None,
+                 drift: Optional[DriftConfig] = None,
+                 cardinality: Optional[CardinalityConfig] = None,
+                 reload_interval: Optional[float] = None,
+                 routes: Optional[Sequence[RouteConfig]] = None,
+                 otlp: Optional[OTLPConfig] = None,
+                 sharded: bool = False):
         """Initializes middleware for the given app.
 
         Args:
           app: The ASGI application to be called.
           config_path: The path to read agent config from.
+          sampling: Configuration to record metrics for only a fraction
+            of requests.
+          max_capture_bytes: Largest request or response body to keep for
+            recording, or None for no limit. Requests with a larger body
+            are not recorded.
+          json_decoder: The JSON decoder to use for payloads, by default
+            orjson when installed, else the standard library.
+          selective_decoding: Whether to only decode the parts of payloads
+            read by the config, skipping e.g large unused arrays.
+          metric_options: Options of the instruments of value metrics,
+            e.g histogram buckets or quantile sketches, by metric name.
+          drift: Configuration to export drift scores of value metrics
+            against baseline distributions.
+          cardinality: Configuration to limit the number of values of
+            each label of a metric.
+          reload_interval: If set, config files are polled for changes at
+            this interval in seconds, and reloaded without interrupting
+            requests when they change.
+          routes: If set, only requests of these routes are recorded, each
+            with the config of its route instead of config_path. Requests
+            of other routes are passed through without capturing them.
+          otlp: If set, metrics are aggregated in memory and exported to
+            an OTLP collector, instead of recorded to prometheus_client.
+          sharded: If set, each thread accumulates values in its own
+            shard, merged when metrics are scraped, so that threads
+            recording the same series do not contend on its lock.
+
+        Raises:
+          ValueError: If both config_path and routes are given, or if
+            sharded in multi-process mode.
+        """
+        self.app = app
+        self._json_decoder = json_decoder
+        self._selective_decoding = selective_decoding
+        self._sampling = sampling
+        self._max_capture_bytes = max_capture_bytes
+        self._routes = RouteTable(
+            config_path, routes, sampling=sampling, metric_options=metric_options, drift=drift,
+            cardinality=cardinality, reload_interval=reload_interval, otlp=otlp, sharded=sharded)
+
+    def reload_config(self) -> None:
+        """Reloads config files, keeping instruments of unchanged metrics.
+
+        Raises:
+          Exception: If a config cannot be loaded, in which case the
+            current config is kept.
+        """
+        self._routes.reload()
+
+    async def __call__(self, scope: Message, receive: Receive, send: Send) -> None:
+        """The ASGI application.
+
+        Args:
+            scope: The connection scope.
+            receive: The callable to receive messages from the server.
+            send: The callable to send messages to the server.
+        """
+        agent = None
+        if scope['type'] == 'http':
+            agent = self._routes.match(scope['method'], scope['path'])
+        if agent is None:
+            await self.app(scope, receive, send)
+            return
+        # The request is recorded with the state it started with.
+        state = agent.state
+        sample_point = None
+        if self._sampling is None or not self._sampling.deterministic:
+            # Drawn up front, so that bodies of requests sampled out are
+            # not kept.
+            sample_point = get_sample_point(self._sampling, None)
+            if not (is_sampled(state.config, MetricContext.INPUT, sample_point) or
+                    is_sampled(state.config, MetricContext.OUTPUT, sample_point)):
+                await self.app(scope, receive, send)
+                return
+        capture_request = needs_request_body(state.config, self._sampling)
+        exchange = _CapturingExchange(receive, send, self._max_capture_bytes, capture_request)
+        try:
+            await self.app(scope, exchange.receive, exchange.send)
+        finally:
+            request_body = exchange.request_body()
+            if request_body is not None or not capture_request:
+                if sample_point is None:
+                    sample_point = get_sample_point(self._sampling, request_body)
+                log_exchange_metrics(
+                    state.config, state.instruments, request_body,
+                    exchange.response_body(), sample_point,
+                    request_content_type=_get_header(scope, b'content-type'),
+                    decoder=self._json_decoder,
+                    selective=self._selective_decoding)
+
+
+class _CapturingExchange:
+    """Copies of the body chunks of a request and its response.
+
+    Chunks are kept as they pass between the server and the application,
+    without changing the messages. If the application starts a recorded
+    response before reading the whole request body, the rest of the body
+    is read first, and handed to the application if it reads it later.
+    Other responses are forwarded at once.
+    """
+
+    def __init__(self, receive: Receive, send: Send,
+                 max_capture_bytes: Optional[int], capture_request: bool) -> None:
+        self._receive = receive
+        self._send = send
+        self._request = _Body(max_capture_bytes)
+        if not capture_request:
+            self._request.discard()
+        self._response = _Body(max_capture_bytes)
+        self._received: Deque[Message] = deque()
+
+    async def receive(self) -> Message:
+        """Receives a message from the server, keeping request body chunks.
+        """
+        if len(self._received) > 0:
+            return self._received.popleft()
+        return self._capture_request(await self._receive())
+
+    async def send(self, message: Message) -> None:
+        """Sends a message to the server, keeping response body chunks.
+        """
+        message_type = message['type']
+        if message_type == 'http.response.start':
+            # Other responses are not recorded, as their payloads are not
+            # predictions.
+            if (message['status'] != 200 or
+                    not is_json_content_type(_get_header(message, b'content-type'))):
+                self._response.discard()
+            # Servers may not deliver the request body once the response
+            # is complete.
+            while self._response.is_pending() and self._request.is_pending():
+                received = self._capture_request(await self._receive())
+                self._received.append(received)
+                if received['type'] != 'http.request':
+                    break
+        elif message_type == 'http.response.body':
+            self._response.add(message.get('body', b''), message.get('more_body', False))
+        await self._send(message)
+
+    def request_body(self) -> Optional[bytes]:
+        """Gets the request body, if completely received and kept.
         """
-        super().__init__(app)
-        self._config = load_config(config_path)
-        self._instruments = initialize_all_instruments(self._config)
-        self._context_labels = deque()
+        return self._request.get()
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        """Middleware implementation that logs requests and responses.
+    def response_body(self) -> Optional[bytes]:
+        """Gets the response body, if completely sent and kept.
         """
-        request_body = await request.body()
-        self._context_labels.clear()
-        log_request_metrics(
-            self._config,
-            self._instruments[MetricContext.INPUT],
-            request_body,
-            self._context_labels)
-        response = await call_next(request)
-        if response.status_code == 200:
-            logging_response = ASGIMetricsMiddleware.LoggingResponse(
-                response, lambda r: log_response_metrics(
-                    self._config,
-                    self._instruments[MetricContext.OUTPUT],
-                    r,
-                    self._context_labels))
-            return logging_response
-        return response
+        return self._response.get()
+
+    def _capture_request(self, message: Message) -> Message:
+        if message['type'] == 'http.request':
+            self._request.add(message.get('body', b''), message.get('more_body', False))
+        return message
+
+
+class _Body:
+    """The chunks of a body, kept until it is complete or too large.
+    """
+
+    def __init__(self, max_bytes: Optional[int]) -> None:
+        self._max_bytes = max_bytes
+        self._chunks: list[bytes] = []
+        self._size = 0
+        self._capturing = True
+        self._complete = False
+
+    def add(self, chunk: bytes, more: bool) -> None:
+        """Keeps a chunk of the body, and whether more chunks follow.
+        """
+        if not self.is_pending():
+            return
+        self._size += len(chunk)
+        if self._max_bytes is not None and self._size > self._max_bytes:
+            self.discard()
+            return
+        if len(chunk) > 0:
+            self._chunks.append(chunk)
+        self._complete = not more
+
+    def is_pending(self) -> bool:
+        """Whether more chunks of the body are kept when they arrive.
+        """
+        return self._capturing and not self._complete
+
+    def discard(self) -> None:
+        """Stops keeping the body, which is then not recorded.
+        """
+        self._capturing = False
+        self._chunks = []
+
+    def get(self) -> Optional[bytes]:
+        """Gets the body, if complete and kept.
+        """
+        if not (self._capturing and self._complete):
+            return None
+        return b''.join(self._chunks)
+
+
+def _get_header(message, name: bytes) -> Optional[str]:
+    for key, value in message.get('headers', ()):
+        if key.lower() == name:
+            return value.decode('latin-1')
+    return None
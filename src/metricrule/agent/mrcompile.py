@@ -0,0 +1,58 @@
+"""A command to validate agent configs and precompile them.
+
+Precompiling a textproto config at build time, e.g in a Docker image,
+lets workers read it as a binary proto instead of parsing textproto:
+either from an output file, or from a cache directory shared with
+workers through METRICRULE_CONFIG_CACHE_DIR.
+
+  metricrule-config config.textproto --cache-dir /var/cache/metricrule
+"""
+from typing import Optional, Sequence
+import argparse
+import os
+import sys
+
+from .mrconfig import get_cache_path, load_config, write_atomically
+from .mrconfig import BINARY_CONFIG_SUFFIXES, CONFIG_CACHE_DIR_ENV
+from .mrmetric import compile_plan
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """Validates a config, and precompiles it to a binary config.
+
+    Args:
+      argv: Command line arguments, by default those of the process.
+
+    Returns:
+      The exit status of the command.
+    """
+    parser = argparse.ArgumentParser(
+        prog='metricrule-config',
+        description='Validates an agent config, and precompiles it so that '
+                    'workers read it without parsing textproto.')
+    parser.add_argument('config_path', help='Path of the textproto or binary config.')
+    parser.add_argument('-o', '--output', help='Path to write the binary config to.')
+    parser.add_argument('--cache-dir', default=os.environ.get(CONFIG_CACHE_DIR_ENV),
+                        help='Directory of cached configs to add the config to.')
+    args = parser.parse_args(argv)
+    try:
+        config_proto = load_config(args.config_path, cache_dir='')
+        compile_plan(config_proto)
+    except Exception as error:  # pylint: disable=broad-except
+        print(f'Invalid config {args.config_path}: {error}', file=sys.stderr)
+        return 1
+    config_data = config_proto.SerializeToString()
+    if args.output:
+        write_atomically(args.output, config_data)
+        print(args.output)
+    if args.cache_dir and not args.config_path.endswith(BINARY_CONFIG_SUFFIXES):
+        os.makedirs(args.cache_dir, exist_ok=True)
+        with open(args.config_path, 'rb') as config_file:
+            cache_path = get_cache_path(args.cache_dir, config_file.read())
+        write_atomically(cache_path, config_data)
+        print(cache_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,25 +1,361 @@
 """Utils for dealing with agent configuration.
 
-Provides a method to read a protoconf file from a file path into a proto.
+Provides a method to read a protoconf file from a file path into a proto,
+and agent-side options that are not part of the config proto.
+
+Configs are read as textproto, or as binary-serialized protos if their
+file name ends in a binary suffix. Parsing textproto is slow for large
+configs, and is repeated by every worker process, so parsed configs can be
+cached in a directory as binary protos, keyed by a hash of the file. The
+cache can be filled at build time with the metricrule-config command, see
+mrcompile.
 """
-from google.protobuf import text_format
+from enum import Enum
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, TYPE_CHECKING, Union
+import hashlib
+import os
+import tempfile
+
+if TYPE_CHECKING:
+    from ..config_gen.metric_configuration_pb2 import SidecarConfig  # pylint: disable=relative-beyond-top-level
 
-from ..config_gen.metric_configuration_pb2 import SidecarConfig  # pylint: disable=relative-beyond-top-level
+# Environment variable of the default directory of cached configs.
+CONFIG_CACHE_DIR_ENV = 'METRICRULE_CONFIG_CACHE_DIR'
+# Suffixes of files read as binary-serialized config protos.
+BINARY_CONFIG_SUFFIXES = ('.pb', '.binpb')
+# Changed if cached configs may no longer be read as before.
+_CACHE_VERSION = b'1'
 
 
-def load_config(config_path: str) -> SidecarConfig:
+def load_config(config_path: str, cache_dir: Optional[str] = None) -> 'SidecarConfig':
     """Loads a file from the specified path into a config proto.
 
     Args:
-      config_path: Path to a textproto config file.
+      config_path: Path to a textproto config file, or a binary config
+        file with a suffix in BINARY_CONFIG_SUFFIXES.
+      cache_dir: Directory of cached configs. A textproto config found in
+        it is read from the cache, and one not found is added to it if
+        the directory is writable. By default, the directory in the
+        METRICRULE_CONFIG_CACHE_DIR environment variable, if any. An
+        empty string disables the cache.
 
     Returns:
       A config proto populated with the values read from the file.
     """
-    config_data = ''
-    if len(config_path) > 0:
-        with open(config_path, 'r') as config_file:
-            config_data = config_file.read()
+    # Protobuf is imported only once a config is loaded.
+    from google.protobuf import text_format  # pylint: disable=import-outside-toplevel
+    from google.protobuf.message import DecodeError  # pylint: disable=import-outside-toplevel
+    from ..config_gen.metric_configuration_pb2 import SidecarConfig  # pylint: disable=relative-beyond-top-level,import-outside-toplevel,redefined-outer-name
     config_proto = SidecarConfig()
+    if len(config_path) == 0:
+        return config_proto
+    with open(config_path, 'rb') as config_file:
+        config_data = config_file.read()
+    if config_path.endswith(BINARY_CONFIG_SUFFIXES):
+        config_proto.ParseFromString(config_data)
+        return config_proto
+    if cache_dir is None:
+        cache_dir = os.environ.get(CONFIG_CACHE_DIR_ENV)
+    if not cache_dir:
+        text_format.Parse(config_data, config_proto)
+        return config_proto
+    cache_path = get_cache_path(cache_dir, config_data)
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            config_proto.ParseFromString(cache_file.read())
+        return config_proto
+    except (OSError, DecodeError):
+        # A truncated or corrupt entry is parsed again and overwritten.
+        config_proto.Clear()
     text_format.Parse(config_data, config_proto)
+    try:
+        write_atomically(cache_path, config_proto.SerializeToString())
+    except OSError:
+        pass
     return config_proto
+
+
+def get_cache_path(cache_dir: str, config_data: bytes) -> str:
+    """Gets the path of the cached config of a textproto config.
+
+    Args:
+      cache_dir: Directory of cached configs.
+      config_data: Contents of the textproto config file.
+
+    Returns:
+      The path of the binary config in the directory.
+    """
+    digest = hashlib.sha256(_CACHE_VERSION + b'\0' + config_data).hexdigest()
+    return os.path.join(cache_dir, digest + '.binpb')
+
+
+def write_atomically(path: str, data: bytes) -> None:
+    """Writes a file through a temporary file, so that readers never see
+    a partial file.
+
+    The file gets the permissions of files created with open, rather than
+    those of temporary files, readable by the owner only, so that files
+    written at build time can be read by the user of the server.
+
+    Args:
+      path: Path of the file.
+      data: Contents of the file.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile('wb', dir=directory, delete=False) as temp_file:
+        temp_file.write(data)
+    try:
+        os.chmod(temp_file.name, 0o666 & ~_get_umask())
+        os.replace(temp_file.name, path)
+    except OSError:
+        os.remove(temp_file.name)
+        raise
+
+
+def _get_umask() -> int:
+    # The umask can only be read by setting it.
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+class RouteConfig(NamedTuple):
+    """Configuration of the metrics of the requests of one endpoint.
+
+    Attributes:
+      pathPrefix: Prefix of the request paths of the endpoint, relative
+        to where the middleware is mounted, matching whole path
+        segments. A request matches the route of the longest matching
+        prefix.
+      configPath: Path of the agent config of the endpoint.
+      methods: HTTP methods of the requests of the endpoint, or empty
+        for any method.
+    """
+    pathPrefix: str
+    configPath: str
+    methods: tuple[str, ...] = ()
+
+
+class SamplingConfig(NamedTuple):
+    """Configuration of the fraction of requests to record metrics for.
+
+    Counter increments of sampled metrics are scaled by the inverse of
+    their rate, so that counts remain unbiased.
+
+    Attributes:
+      rate: Default fraction of requests to record, between 0 and 1.
+      deterministic: Whether to sample by a hash of the request body,
+        instead of a random draw per request. In both cases input and
+        output metrics of one request are kept or dropped together.
+      inputRate: If set, overrides the rate for input metrics.
+      outputRate: If set, overrides the rate for output metrics.
+      metricRates: Overrides of the rate for metrics of the given names.
+    """
+    rate: float = 1.0
+    deterministic: bool = False
+    inputRate: Optional[float] = None
+    outputRate: Optional[float] = None
+    metricRates: Mapping[str, float] = MappingProxyType({})
+
+
+class HistogramConfig(NamedTuple):
+    """Configuration of the histogram a value metric is recorded to.
+
+    Attributes:
+      buckets: Upper bounds of the buckets, in increasing order. If not
+        set, the default buckets of prometheus_client are used.
+      exponentialScale: If set, values are instead recorded to buckets
+        of a base-2 exponential histogram at this scale, over the range
+        of values observed. Bucket bounds are powers of 2**(2**-scale),
+        so a scale of 3 has buckets about 9% wide. Exponential histograms
+        are kept in process memory, so they cannot be used in
+        multi-process mode, where only the metric files of processes are
+        scraped.
+      maxBuckets: Largest number of exponential buckets for each sign of
+        values. Once the range of buckets reaches it, values beyond it
+        are counted in the bucket at its edge, or only in the +Inf
+        bucket, e.g 160 buckets at a scale of 3 span a factor of 2**20.
+    """
+    buckets: Optional[tuple[float, ...]] = None
+    exponentialScale: Optional[int] = None
+    maxBuckets: int = 160
+
+
+class SketchConfig(NamedTuple):
+    """Configuration of a quantile sketch a value metric is recorded to.
+
+    Values are recorded to a DDSketch instead of a histogram, and exported
+    as a summary of estimated quantiles. Estimates are within a relative
+    error of the true quantile, at a memory bounded by maxBins, without
+    choosing buckets in advance. Sketches are kept in process memory, so
+    they cannot be used in multi-process mode, where only the metric files
+    of processes are scraped.
+
+    Attributes:
+      quantiles: Quantiles to export, between 0 and 1.
+      relativeAccuracy: Relative error of estimated quantiles.
+      maxBins: Largest number of bins for each sign of values. Beyond
+        it, the lowest quantiles of positive values lose accuracy.
+    """
+    quantiles: tuple[float, ...] = (0.01, 0.5, 0.99)
+    relativeAccuracy: float = 0.01
+    maxBins: int = 2048
+
+
+# Options for metrics, by the type of their instrument.
+MetricOptions = Union[HistogramConfig, SketchConfig]
+
+
+def linear_buckets(start: float, width: float, count: int) -> tuple[float, ...]:
+    """Generates bucket upper bounds at equal distances.
+
+    Args:
+      start: Upper bound of the first bucket.
+      width: Distance between consecutive upper bounds, above 0.
+      count: Number of buckets, at least 1.
+
+    Returns:
+      The upper bounds, in increasing order.
+
+    Raises:
+      ValueError: If width or count are out of range.
+    """
+    if width <= 0 or count < 1:
+        raise ValueError('Linear buckets need a positive width and count')
+    return tuple(start + width * i for i in range(count))
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> tuple[float, ...]:
+    """Generates bucket upper bounds at equal ratios.
+
+    Args:
+      start: Upper bound of the first bucket, above 0.
+      factor: Ratio between consecutive upper bounds, above 1.
+      count: Number of buckets, at least 1.
+
+    Returns:
+      The upper bounds, in increasing order.
+
+    Raises:
+      ValueError: If start, factor or count are out of range.
+    """
+    if start <= 0 or factor <= 1 or count < 1:
+        raise ValueError('Exponential buckets need a positive start and count, '
+                         'and a factor above 1')
+    return tuple(start * factor ** i for i in range(count))
+
+
+class DriftConfig(NamedTuple):
+    """Configuration of drift scores of value metrics against a baseline.
+
+    Values of metrics in the baseline are counted in the bins of their
+    baseline distribution over a sliding window, which advances in
+    slices. After each slice, the divergences of the window from the
+    baseline are exported as gauges.
+
+    Attributes:
+      baselinePath: Path of a JSON file of baseline distributions, see
+        mrdrift.load_baselines.
+      windowSeconds: Duration of the window compared to the baseline.
+      slices: Number of slices the window advances by.
+      epsilon: Fraction added to every bin before comparing, so that
+        empty bins have finite divergences.
+      gaugeName: Name of the gauge of the scores, labeled by metric name
+        and measure (psi, kl or js).
+    """
+    baselinePath: str
+    windowSeconds: float = 300.0
+    slices: int = 10
+    epsilon: float = 1e-4
+    gaugeName: str = 'metricrule_feature_drift'
+
+
+class CardinalityConfig(NamedTuple):
+    """Configuration of limits on the number of values of labels.
+
+    Label values parsed from payloads may be unbounded, e.g IDs or free
+    text, and each value of a label creates new series. With a limit, the
+    most frequent values of each label of a metric keep their own series,
+    and other values are replaced by otherValue. Frequencies are estimated
+    with a space-saving sketch, so a value that becomes frequent replaces
+    the least frequent kept value, whose series are removed.
+
+    Attributes:
+      maxValues: Default largest number of values kept for each label of
+        a metric.
+      metricMaxValues: Overrides of maxValues for metrics of the given
+        names.
+      candidates: Number of values not kept whose frequency is estimated,
+        for each label. By default, 4 times the largest number kept.
+      otherValue: The value replacing values that are not kept.
+      counterName: Name of the counter of replaced values, labeled by
+        metric and label name.
+    """
+    maxValues: int = 100
+    metricMaxValues: Mapping[str, int] = MappingProxyType({})
+    candidates: Optional[int] = None
+    otherValue: str = '__other__'
+    counterName: str = 'metricrule_collapsed_label_values'
+
+
+class Temporality(Enum):
+    """Enumerations of what exported values of a metric aggregate.
+
+    Values match the aggregation temporalities of OTLP.
+    """
+    # Values since the previous export.
+    DELTA = 1
+    # Values since the series was created.
+    CUMULATIVE = 2
+
+
+class OTLPConfig(NamedTuple):
+    """Configuration of the export of metrics to an OTLP/HTTP collector.
+
+    Metrics are aggregated in memory by label values, instead of being
+    recorded to prometheus_client, and exported in bulk at an interval as
+    OTLP JSON. Value metrics are exported as histograms of the buckets of
+    their HistogramConfig, or of the default buckets; exponential and
+    sketch options only apply to prometheus_client. Exports that fail with
+    a retryable error are sent again at later intervals.
+
+    Attributes:
+      endpoint: URL of the metrics endpoint of the collector.
+      intervalSeconds: Interval between exports.
+      temporality: Whether exported values aggregate the values since
+        the previous export, or since the start.
+      headers: Headers of export requests, e.g for authentication.
+      timeoutSeconds: Timeout of an export request.
+      maxAttempts: Largest number of times an export is sent before it
+        is dropped.
+      maxPendingExports: Largest number of failed exports kept to be
+        sent again, beyond which the oldest is dropped. With cumulative
+        temporality, only the latest export is kept, as it supersedes
+        earlier ones.
+      serviceName: The service.name attribute of the exported resource.
+    """
+    endpoint: str = 'http://localhost:4318/v1/metrics'
+    intervalSeconds: float = 10.0
+    temporality: Temporality = Temporality.CUMULATIVE
+    headers: Mapping[str, str] = MappingProxyType({})
+    timeoutSeconds: float = 5.0
+    maxAttempts: int = 5
+    maxPendingExports: int = 16
+    serviceName: str = 'metricrule-agent'
+
+
+class ExpositionConfig(NamedTuple):
+    """Configuration of the application serving metrics to scrapers.
+
+    Attributes:
+      cacheSeconds: Time a rendered exposition is served to further
+        scrapes of the same format and metric names, or 0 to render
+        each scrape.
+      maxCachedResponses: Largest number of renderings kept, by format,
+        metric names and compression.
+      compress: Whether to gzip expositions for scrapers accepting it.
+    """
+    cacheSeconds: float = 1.0
+    maxCachedResponses: int = 16
+    compress: bool = True
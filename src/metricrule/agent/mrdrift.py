@@ -0,0 +1,387 @@
+"""Drift scores of value metrics against baseline distributions.
+
+A baseline file gives the distribution of metrics at training time, as
+counts over bins. A monitor counts the values recorded for those metrics
+in the same bins, over a sliding window of slices. A background thread
+advances the window after each slice, updating its counts incrementally,
+and exports the divergences of the window from the baseline as gauges:
+  - psi, the population stability index.
+  - kl, the Kullback-Leibler divergence of the window from the baseline.
+  - js, the Jensen-Shannon divergence, between 0 and ln(2).
+
+Only a few gauge series per metric are then scraped, instead of
+computing drift from histograms at query time.
+"""
+from collections import deque
+from typing import Any, Callable, Deque, Iterable, NamedTuple, Optional, Sequence
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+
+import prometheus_client
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+from .mrconfig import DriftConfig
+from .mrmetric import MetricInstrumentSpec
+from .mrotel import Instrument
+
+_logger = logging.getLogger(__name__)
+
+# Default number of bins of baselines given as values.
+DEFAULT_BASELINE_BINS = 10
+# Smallest batch of values binned with NumPy.
+_MIN_VECTORIZED_BATCH = 16
+_MEASURES = ('psi', 'kl', 'js')
+
+
+class Baseline(NamedTuple):
+    """The baseline distribution of a metric, as counts over bins.
+
+    Attributes:
+      bounds: Upper bounds of the bins, in increasing order. A value is
+        in the first bin whose bound it does not exceed, or in a last bin
+        above all bounds.
+      counts: Counts of values in each bin, one more than bounds.
+    """
+    bounds: tuple[float, ...]
+    counts: tuple[float, ...]
+
+
+class DriftScores(NamedTuple):
+    """Divergences of a distribution from a baseline.
+
+    Attributes:
+      psi: The population stability index.
+      kl: The Kullback-Leibler divergence from the baseline.
+      js: The Jensen-Shannon divergence.
+    """
+    psi: float
+    kl: float
+    js: float
+
+
+def load_baselines(path: str) -> dict[str, Baseline]:
+    """Loads baseline distributions from a JSON file.
+
+    The file maps metric names to either bins or sample values, e.g
+      {"metrics": {
+        "feature_a": {"bounds": [0.5, 1.0], "counts": [10, 30, 5]},
+        "feature_b": {"values": [0.2, 0.7, ...], "bins": 10}}}
+
+    Args:
+      path: Path of the file.
+
+    Returns:
+      Baselines by metric name.
+
+    Raises:
+      ValueError: If a baseline is malformed.
+    """
+    with open(path, 'r', encoding='utf-8') as baseline_file:
+        data = json.load(baseline_file)
+    baselines = {}
+    for name, spec in data.get('metrics', {}).items():
+        if 'values' in spec:
+            baselines[name] = baseline_from_values(
+                spec['values'], spec.get('bins', DEFAULT_BASELINE_BINS))
+        else:
+            baselines[name] = make_baseline(spec['bounds'], spec['counts'])
+    return baselines
+
+
+def make_baseline(bounds: Sequence[float], counts: Sequence[float]) -> Baseline:
+    """Makes a baseline from bins.
+
+    Args:
+      bounds: Upper bounds of the bins, in increasing order.
+      counts: Counts of values in each bin, one more than bounds.
+
+    Returns:
+      The baseline.
+
+    Raises:
+      ValueError: If the bounds or counts are malformed.
+    """
+    bounds = tuple(float(bound) for bound in bounds)
+    counts = tuple(float(count) for count in counts)
+    if any(lower >= upper for lower, upper in zip(bounds, bounds[1:])):
+        raise ValueError('Baseline bounds must be increasing')
+    if len(counts) != len(bounds) + 1:
+        raise ValueError('A baseline needs one more count than bounds')
+    if any(count < 0 for count in counts) or sum(counts) <= 0:
+        raise ValueError('Baseline counts must be non-negative, with a positive total')
+    return Baseline(bounds, counts)
+
+
+def baseline_from_values(values: Iterable[float],
+                         num_bins: int = DEFAULT_BASELINE_BINS) -> Baseline:
+    """Makes a baseline of sample values, with bins of equal frequency.
+
+    Args:
+      values: Sample values of the metric, e.g from training data.
+      num_bins: Number of bins, fewer if values repeat.
+
+    Returns:
+      The baseline.
+
+    Raises:
+      ValueError: If there are no finite values.
+    """
+    ordered = sorted(float(value) for value in values if math.isfinite(value))
+    if len(ordered) == 0:
+        raise ValueError('A baseline needs at least one finite value')
+    bounds = sorted({ordered[(len(ordered) - 1) * i // num_bins]
+                     for i in range(1, num_bins)})
+    counts = [0.0] * (len(bounds) + 1)
+    for value in ordered:
+        counts[bisect.bisect_left(bounds, value)] += 1
+    return make_baseline(bounds, counts)
+
+
+def divergences(baseline: Sequence[float], actual: Sequence[float],
+                epsilon: float = 1e-4) -> DriftScores:
+    """Computes divergences between two distributions over the same bins.
+
+    Args:
+      baseline: Counts of the baseline distribution.
+      actual: Counts of the compared distribution.
+      epsilon: Fraction added to every bin before normalizing.
+
+    Returns:
+      The scores, or NaN scores if either distribution is empty.
+    """
+    baseline_total, actual_total = sum(baseline), sum(actual)
+    if baseline_total <= 0 or actual_total <= 0:
+        return DriftScores(math.nan, math.nan, math.nan)
+    expected = _normalize([count / baseline_total + epsilon for count in baseline])
+    observed = _normalize([count / actual_total + epsilon for count in actual])
+    psi = kl = js = 0.0
+    for p, q in zip(expected, observed):
+        if p == q:
+            continue
+        psi += _relative_entropy(q, p) + _relative_entropy(p, q)
+        kl += _relative_entropy(q, p)
+        m = (p + q) / 2
+        js += (_relative_entropy(p, m) + _relative_entropy(q, m)) / 2
+    return DriftScores(psi, kl, js)
+
+
+class DriftMonitor:  # pylint: disable=too-many-instance-attributes
+    """Computes drift scores of value metrics over a sliding window.
+    """
+
+    def __init__(self, drift: DriftConfig, *,
+                 registry: Optional[prometheus_client.CollectorRegistry] =
+                 prometheus_client.REGISTRY,
+                 start: bool = True) -> None:
+        """Initializes the monitor.
+
+        Drift is computed for value metrics with a baseline, once their
+        instruments are wrapped by the monitor.
+
+        Args:
+          drift: Configuration of the baselines and window.
+          registry: The registry to register the gauge with, if any.
+          start: Whether to start a thread advancing the window after
+            each slice. If not, update must be called instead.
+        """
+        self._baselines = load_baselines(drift.baselinePath)
+        self._drift = drift
+        self._windows: dict[str, _Window] = {}
+        # Numbers of wrapped instruments of each monitored metric.
+        self._references: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._gauge = prometheus_client.Gauge(
+            drift.gaugeName,
+            'Divergence of the recent distribution of a metric from its baseline',
+            labelnames=('metric', 'measure'),
+            registry=registry,
+            multiprocess_mode='liveall')
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if start:
+            self._thread = threading.Thread(
+                target=self._run, name='metricrule-drift', daemon=True)
+            self._thread.start()
+
+    def wrap_instrument(self, spec: MetricInstrumentSpec, instrument: Instrument) -> Instrument:
+        """Wraps an instrument to also count its values, if monitored.
+
+        Args:
+          spec: Specification of the instrument.
+          instrument: The instrument.
+
+        Returns:
+          The wrapped instrument if its metric is a value metric with a
+          baseline, else the instrument. Once all wrapped instruments of
+          a metric are unregistered, its drift is no longer computed.
+        """
+        baseline = self._baselines.get(spec.name)
+        if baseline is None or spec.instrumentType != prometheus_client.Histogram:
+            return instrument
+        with self._lock:
+            window = self._windows.get(spec.name)
+            if window is None:
+                window = _Window(baseline, max(self._drift.slices, 1))
+                self._windows[spec.name] = window
+            self._references[spec.name] = self._references.get(spec.name, 0) + 1
+        return DriftInstrument(instrument, window, lambda: self._release(spec.name))
+
+    def update(self) -> dict[str, DriftScores]:
+        """Advances the window by a slice, and updates the scores.
+
+        Returns:
+          The scores of the window, by metric name.
+        """
+        scores = {}
+        with self._lock:
+            windows = list(self._windows.items())
+        for name, window in windows:
+            window.advance()
+            metric_scores = divergences(
+                window.baseline.counts, window.counts(), self._drift.epsilon)
+            with self._lock:
+                if self._windows.get(name) is not window:
+                    # Released meanwhile, so its gauges were removed.
+                    continue
+                for measure, score in zip(_MEASURES, metric_scores):
+                    self._gauge.labels(name, measure).set(score)
+            scores[name] = metric_scores
+        return scores
+
+    def stop(self) -> None:
+        """Stops the thread advancing the window, if any.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _release(self, name: str) -> None:
+        # Drops the window and gauges of a metric once it is unused.
+        with self._lock:
+            references = self._references[name] - 1
+            if references > 0:
+                self._references[name] = references
+                return
+            del self._references[name]
+            del self._windows[name]
+            for measure in _MEASURES:
+                try:
+                    self._gauge.remove(name, measure)
+                except KeyError:
+                    # Not updated yet.
+                    pass
+
+    def _run(self) -> None:
+        interval = self._drift.windowSeconds / max(self._drift.slices, 1)
+        next_update = time.monotonic() + interval
+        while not self._stopped.wait(max(next_update - time.monotonic(), 0.0)):
+            next_update += interval
+            try:
+                self.update()
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception('Failed to update drift scores')
+
+
+class DriftInstrument(Instrument):
+    """An instrument that also counts values in a drift window.
+    """
+
+    def __init__(self, instrument: Instrument, window: '_Window',
+                 release: Callable[[], None]):
+        """Initializes the instrument.
+
+        Args:
+          instrument: The instrument to record values to.
+          window: The window to count values in.
+          release: Called when the instrument is unregistered.
+        """
+        self.instrument = instrument
+        self._window = window
+        self._release = release
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        self.instrument.record(value, labels)
+        self._window.observe((value,))
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        self.instrument.record_many(values, labels)
+        self._window.observe(values)
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        self.instrument.remove_label_value(index, value)
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        self.instrument.unregister(registry)
+        self._release()
+
+
+class _Window:
+    """Counts of values in the bins of a baseline, over sliding slices.
+
+    The counts of the window are kept as the sum of its slices, adding
+    each slice as it completes and subtracting it as it expires.
+    """
+
+    def __init__(self, baseline: Baseline, slices: int) -> None:
+        self.baseline = baseline
+        self._slices: Deque[list[int]] = deque()
+        self._max_slices = slices
+        self._current = [0] * len(baseline.counts)
+        self._totals = [0] * len(baseline.counts)
+        self._lock = threading.Lock()
+
+    def observe(self, values: Sequence[Any]) -> None:
+        """Counts values in the current slice.
+        """
+        bounds = self.baseline.bounds
+        if np is not None and len(values) >= _MIN_VECTORIZED_BATCH:
+            amounts = np.asarray(values, dtype=np.float64)
+            bins = np.searchsorted(bounds, amounts[~np.isnan(amounts)], side='left')
+            counts = np.bincount(bins, minlength=len(self._current)).tolist()
+            with self._lock:
+                for index, count in enumerate(counts):
+                    self._current[index] += count
+            return
+        with self._lock:
+            for value in values:
+                value = float(value)
+                if not math.isnan(value):
+                    self._current[bisect.bisect_left(bounds, value)] += 1
+
+    def advance(self) -> None:
+        """Adds the current slice to the window, expiring the oldest.
+        """
+        with self._lock:
+            completed, self._current = self._current, [0] * len(self._current)
+        self._slices.append(completed)
+        self._totals = [total + count for total, count in zip(self._totals, completed)]
+        if len(self._slices) > self._max_slices:
+            expired = self._slices.popleft()
+            self._totals = [total - count for total, count in zip(self._totals, expired)]
+
+    def counts(self) -> list[int]:
+        """Gets the counts of the window, by bin.
+        """
+        return list(self._totals)
+
+
+def _normalize(weights: Sequence[float]) -> list[float]:
+    total = sum(weights)
+    return [weight / total for weight in weights]
+
+
+def _relative_entropy(weight: float, reference: float) -> float:
+    # The term w * ln(w / r), with 0 * ln(0 / r) = 0 and w * ln(w / 0) = inf.
+    if weight == 0:
+        return 0.0
+    if reference == 0:
+        return math.inf
+    return weight * math.log(weight / reference)
@@ -0,0 +1,347 @@
+"""Rendering of collected metrics for scrapes, cached for a short time.
+
+Rendering the exposition of every series of a registry is costly when
+there are many series, and several scrapers, e.g a pair of Prometheus
+servers, scrape the same metrics. Renderings are cached by format,
+requested metric names and compression, and served to further scrapes
+until they expire. Concurrent scrapes of an expired rendering wait for a
+single new rendering.
+
+Expositions are rendered in the Prometheus text format, OpenMetrics, or
+the delimited protobuf format of io.prometheus.client.MetricFamily, as
+negotiated by the Accept header of the scrape. Only the metrics named by
+name[] query parameters are exposed, if any.
+"""
+from collections import OrderedDict
+from http import HTTPStatus
+from typing import Any, Callable, Iterable, NamedTuple, Optional, Sequence, Union
+from urllib.parse import parse_qs
+import copy
+import gzip
+import math
+import struct
+import threading
+import time
+
+import prometheus_client
+from prometheus_client.exposition import choose_encoder, gzip_accepted
+
+from .mrconfig import ExpositionConfig
+
+PROTOBUF_CONTENT_TYPE = ('application/vnd.google.protobuf; '
+                         'proto=io.prometheus.client.MetricFamily; encoding=delimited')
+# Compression level of gzipped expositions, trading size for CPU.
+_GZIP_LEVEL = 6
+_ALLOWED_METHODS = 'OPTIONS,GET'
+
+# Numbers of the MetricType enum of io.prometheus.client.
+_METRIC_TYPES = {
+    'counter': 0,
+    'gauge': 1,
+    'summary': 2,
+    'unknown': 3,
+    'histogram': 4,
+    'gaugehistogram': 5,
+    'info': 1,
+    'stateset': 1,
+}
+
+Encoder = Callable[[Any], bytes]
+# Content type, metric names and compression of a rendering.
+_Key = tuple[str, Optional[tuple[str, ...]], bool]
+
+
+class Exposition(NamedTuple):
+    """A response to a scrape.
+
+    Attributes:
+      status: The HTTP status code.
+      headers: The response headers.
+      body: The response body.
+    """
+    status: int
+    headers: list[tuple[str, str]]
+    body: bytes
+
+    @property
+    def status_line(self) -> str:
+        """The status, as a WSGI status line.
+        """
+        return f'{self.status} {HTTPStatus(self.status).phrase}'
+
+
+class _Scrape(NamedTuple):
+    key: _Key
+    encoder: Encoder
+    headers: list[tuple[str, str]]
+
+
+class _RestrictedRegistry:  # pylint: disable=too-few-public-methods
+    """The samples of the given names of a registry.
+
+    Unlike CollectorRegistry.restricted_registry, collectors without a
+    describe method, e.g that of multi-process mode, are filtered too.
+    """
+
+    def __init__(self, registry: Any, names: Iterable[str]) -> None:
+        self._registry = registry
+        self._names = frozenset(names)
+
+    def collect(self) -> Iterable[Any]:
+        """Collects the metrics with samples of the names.
+        """
+        for metric in self._registry.collect():
+            samples = [sample for sample in metric.samples if sample.name in self._names]
+            if len(samples) > 0:
+                restricted = copy.copy(metric)
+                restricted.samples = samples
+                yield restricted
+
+
+class ExpositionCache:
+    """Renders the metrics of a registry for scrapes, caching renderings.
+    """
+
+    def __init__(self, registry: Any = prometheus_client.REGISTRY,
+                 exposition: ExpositionConfig = ExpositionConfig()) -> None:
+        """Initializes an empty cache.
+
+        Args:
+          registry: The registry of the exposed metrics.
+          exposition: Configuration of the cache and compression.
+        """
+        self._registry = registry
+        self._exposition = exposition
+        # Expiry time and body of renderings, by content type, metric
+        # names and compression, from the least recently rendered.
+        self._renderings: OrderedDict[_Key, tuple[float, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def respond(self, method: str, query_string: str, accept: str,
+                accept_encoding: str) -> Exposition:
+        """Responds to a scrape, rendering the exposition if not cached.
+
+        Args:
+          method: The HTTP method of the scrape.
+          query_string: The query string of the scrape.
+          accept: The Accept header of the scrape.
+          accept_encoding: The Accept-Encoding header of the scrape.
+
+        Returns:
+          The response.
+        """
+        scrape = self._parse(method, query_string, accept, accept_encoding)
+        if isinstance(scrape, Exposition):
+            return scrape
+        rendering = self._get_cached(scrape.key)
+        if rendering is None:
+            rendering = self._render(scrape.key, scrape.encoder)
+        return Exposition(200, scrape.headers, rendering)
+
+    def respond_cached(self, method: str, query_string: str, accept: str,
+                       accept_encoding: str) -> Optional[Exposition]:
+        """Responds to a scrape if its exposition is cached, without
+        waiting on other scrapes.
+
+        Args:
+          method: The HTTP method of the scrape.
+          query_string: The query string of the scrape.
+          accept: The Accept header of the scrape.
+          accept_encoding: The Accept-Encoding header of the scrape.
+
+        Returns:
+          The response, or None if the exposition needs rendering.
+        """
+        scrape = self._parse(method, query_string, accept, accept_encoding)
+        if isinstance(scrape, Exposition):
+            return scrape
+        rendering = self._get_cached(scrape.key)
+        if rendering is None:
+            return None
+        return Exposition(200, scrape.headers, rendering)
+
+    def _parse(self, method: str, query_string: str, accept: str,
+               accept_encoding: str) -> Union[Exposition, _Scrape]:
+        # The response if not a scrape of metrics, else the scrape.
+        if method == 'OPTIONS':
+            return Exposition(200, [('Allow', _ALLOWED_METHODS)], b'')
+        if method != 'GET':
+            return Exposition(405, [('Allow', _ALLOWED_METHODS)],
+                              f'# HTTP 405: {method}; use OPTIONS or GET\n'.encode())
+        encoder, content_type = _choose_encoder(accept)
+        names = parse_qs(query_string).get('name[]')
+        compress = self._exposition.compress and gzip_accepted(accept_encoding)
+        headers = [('Content-Type', content_type)]
+        if compress:
+            headers.append(('Content-Encoding', 'gzip'))
+        return _Scrape(
+            (content_type, None if names is None else tuple(sorted(set(names))), compress),
+            encoder, headers)
+
+    def _get_cached(self, key: _Key) -> Optional[bytes]:
+        rendering = self._renderings.get(key)
+        if rendering is None or rendering[0] <= time.monotonic():
+            return None
+        return rendering[1]
+
+    def _render(self, key: _Key, encoder: Encoder) -> bytes:
+        with self._lock:
+            # Rendered meanwhile by a concurrent scrape.
+            rendering = self._renderings.get(key)
+            started = time.monotonic()
+            if rendering is not None and rendering[0] > started:
+                return rendering[1]
+            _, names, compress = key
+            registry = self._registry
+            if names is not None:
+                registry = _RestrictedRegistry(registry, names)
+            body = encoder(registry)
+            if compress:
+                body = gzip.compress(body, compresslevel=_GZIP_LEVEL)
+            if self._exposition.cacheSeconds > 0:
+                self._renderings[key] = (started + self._exposition.cacheSeconds, body)
+                self._renderings.move_to_end(key)
+                while len(self._renderings) > max(self._exposition.maxCachedResponses, 1):
+                    self._renderings.popitem(last=False)
+            return body
+
+
+def generate_protobuf(registry: Any = prometheus_client.REGISTRY) -> bytes:
+    """Renders the metrics of a registry in the delimited protobuf format.
+
+    Each metric is encoded as an io.prometheus.client.MetricFamily
+    message, prefixed by its length. Buckets of infinite bound are left
+    out, as they are implied by the sample count.
+
+    Args:
+      registry: The registry of the metrics.
+
+    Returns:
+      The encoded metric families.
+    """
+    output = bytearray()
+    for metric in registry.collect():
+        family = _encode_family(metric)
+        output += _varint(len(family))
+        output += family
+    return bytes(output)
+
+
+def _choose_encoder(accept: str) -> tuple[Encoder, str]:
+    # The first supported format of the Accept header, if protobuf.
+    for accepted in (accept or '').split(','):
+        parameters = [token.strip() for token in accepted.split(';')]
+        if parameters[0] == 'application/vnd.google.protobuf':
+            if ('proto=io.prometheus.client.MetricFamily' in parameters
+                    and 'encoding=delimited' in parameters):
+                return generate_protobuf, PROTOBUF_CONTENT_TYPE
+        elif parameters[0] in ('application/openmetrics-text', 'text/plain'):
+            break
+    return choose_encoder(accept)
+
+
+def _encode_family(metric: Any) -> bytes:
+    name = metric.name
+    if metric.type == 'counter':
+        name += '_total'
+    elif metric.type == 'info':
+        name += '_info'
+    family = _string_field(1, name)
+    if metric.documentation:
+        family += _string_field(2, metric.documentation)
+    family += _varint_field(3, _METRIC_TYPES.get(metric.type, 3))
+    for labels, samples in _group_series(metric.samples):
+        family += _bytes_field(4, _encode_metric(metric, labels, samples))
+    return family
+
+
+def _group_series(samples: Iterable[Any]) -> list[tuple[dict[str, str], list[Any]]]:
+    # Samples by their labels, other than those of buckets and quantiles.
+    series: dict[tuple[tuple[str, str], ...], tuple[dict[str, str], list[Any]]] = {}
+    for sample in samples:
+        labels = {key: value for key, value in sample.labels.items()
+                  if key not in ('le', 'quantile')}
+        key = tuple(sorted(labels.items()))
+        if key not in series:
+            series[key] = (labels, [])
+        series[key][1].append(sample)
+    return list(series.values())
+
+
+def _encode_metric(metric: Any, labels: dict[str, str], samples: Sequence[Any]) -> bytes:
+    message = b''.join(_bytes_field(1, _string_field(1, key) + _string_field(2, value))
+                       for key, value in labels.items())
+    if metric.type == 'counter':
+        values = [sample.value for sample in samples if sample.name == metric.name + '_total']
+        message += _bytes_field(3, _double_field(1, values[0] if values else 0.0))
+    elif metric.type == 'summary':
+        message += _bytes_field(4, _encode_summary(metric.name, samples))
+    elif metric.type in ('histogram', 'gaugehistogram'):
+        message += _bytes_field(7, _encode_histogram(metric, samples))
+    elif metric.type == 'unknown':
+        message += _bytes_field(5, _double_field(1, samples[0].value))
+    else:
+        message += _bytes_field(2, _double_field(1, samples[0].value))
+    timestamps = [sample.timestamp for sample in samples if sample.timestamp is not None]
+    if timestamps:
+        timestamp = timestamps[0]
+        milliseconds = (timestamp.sec * 1000 + timestamp.nsec // 1_000_000
+                        if hasattr(timestamp, 'sec') else round(float(timestamp) * 1000))
+        message += _varint_field(6, milliseconds)
+    return message
+
+
+def _encode_summary(name: str, samples: Sequence[Any]) -> bytes:
+    message = b''
+    for sample in samples:
+        if sample.name == name + '_count':
+            message += _varint_field(1, int(sample.value))
+        elif sample.name == name + '_sum':
+            message += _double_field(2, sample.value)
+        elif sample.name == name and 'quantile' in sample.labels:
+            message += _bytes_field(3, _double_field(1, float(sample.labels['quantile']))
+                                    + _double_field(2, sample.value))
+    return message
+
+
+def _encode_histogram(metric: Any, samples: Sequence[Any]) -> bytes:
+    prefix = '_g' if metric.type == 'gaugehistogram' else '_'
+    message = b''
+    for sample in samples:
+        if sample.name == metric.name + prefix + 'count':
+            message += _varint_field(1, int(sample.value))
+        elif sample.name == metric.name + prefix + 'sum':
+            message += _double_field(2, sample.value)
+        elif sample.name == metric.name + '_bucket':
+            bound = float(sample.labels['le'])
+            if not math.isinf(bound):
+                message += _bytes_field(3, _varint_field(1, int(sample.value))
+                                        + _double_field(2, bound))
+    return message
+
+
+def _varint(value: int) -> bytes:
+    # Negative values are encoded as 64-bit two's complement.
+    value &= (1 << 64) - 1
+    output = bytearray()
+    while value > 0x7f:
+        output.append(value & 0x7f | 0x80)
+        value >>= 7
+    output.append(value)
+    return bytes(output)
+
+
+def _varint_field(number: int, value: int) -> bytes:
+    return _varint(number << 3) + _varint(value)
+
+
+def _double_field(number: int, value: float) -> bytes:
+    return _varint(number << 3 | 1) + struct.pack('<d', value)
+
+
+def _bytes_field(number: int, value: bytes) -> bytes:
+    return _varint(number << 3 | 2) + _varint(len(value)) + value
+
+
+def _string_field(number: int, value: str) -> bytes:
+    return _bytes_field(number, value.encode('utf-8'))
@@ -0,0 +1,366 @@
+"""A histogram with exponential buckets over the range values fall in.
+
+Bucket bounds are those of an OpenTelemetry base-2 exponential histogram:
+at a scale s, bounds are the powers of b = 2**(2**-s), and their negatives,
+so every bucket has the same relative width. The scale is fixed, and the
+buckets of each sign of values cover a contiguous range of indices, which
+grows towards the values observed up to a largest number of buckets, and
+never shrinks. Values beyond the range are counted in the nearest bucket
+whose bound is still above them, or only in the +Inf bucket, so memory is
+bounded at the cost of resolution at the extremes.
+
+The histogram has the interface of a prometheus_client histogram, and is
+exported as one, with the bounds of all buckets in the range, including
+empty ones, as `le` labels. A bound, once exported, is then exported at
+every later scrape, as rate() and histogram_quantile() expect.
+"""
+from typing import Any, Callable, Iterable, Optional, Sequence
+import math
+import threading
+
+import prometheus_client
+from prometheus_client.core import HistogramMetricFamily
+from prometheus_client.utils import floatToGoString
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Default scale of new histograms, i.e buckets about 4.4% wide.
+DEFAULT_SCALE = 4
+# Default largest number of buckets for each sign of values.
+DEFAULT_MAX_BUCKETS = 160
+# Smallest batch of values indexed with NumPy.
+_MIN_VECTORIZED_BATCH = 16
+
+
+class ExponentialHistogram:
+    """A metric, optionally with labels, of exponential histograms.
+    """
+
+    def __init__(self, name: str, documentation: str,  # pylint: disable=too-many-arguments
+                 labelnames: Iterable[str] = (), *,
+                 scale: int = DEFAULT_SCALE,
+                 max_buckets: int = DEFAULT_MAX_BUCKETS,
+                 registry: Optional[prometheus_client.CollectorRegistry] =
+                 prometheus_client.REGISTRY):
+        """Initializes the metric, and registers it to be collected.
+
+        Args:
+          name: Name of the metric.
+          documentation: Help text of the metric.
+          labelnames: Names of the labels of the metric.
+          scale: Scale of the buckets, between -10 and 20.
+          max_buckets: Largest number of buckets for each sign of values.
+          registry: The registry to register the metric with, if any.
+        """
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._scale = scale
+        self._max_buckets = max(max_buckets, 2)
+        self._lock = threading.Lock()
+        self._metrics: dict[tuple[str, ...], ExponentialBuckets] = {}
+        if len(self._labelnames) == 0:
+            self._metrics[()] = ExponentialBuckets(scale, self._max_buckets)
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues: Any) -> 'ExponentialBuckets':
+        """Gets the histogram of the given label values.
+        """
+        if len(labelvalues) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+        key = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            child = self._metrics.get(key)
+            if child is None:
+                child = ExponentialBuckets(self._scale, self._max_buckets)
+                self._metrics[key] = child
+            return child
+
+    def remove(self, *labelvalues: Any) -> None:
+        """Removes the histogram of the given label values.
+        """
+        key = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            self._metrics.pop(key, None)
+
+    def observe(self, amount: float) -> None:
+        """Observes a value in the histogram of a metric without labels.
+        """
+        self._unlabeled().observe(amount)
+
+    def observe_many(self, amounts: Sequence[float]) -> None:
+        """Observes values in the histogram of a metric without labels.
+        """
+        self._unlabeled().observe_many(amounts)
+
+    def describe(self) -> list[HistogramMetricFamily]:
+        """Describes the metric, without samples, for registration.
+        """
+        return [HistogramMetricFamily(self._name, self._documentation,
+                                      labels=self._labelnames)]
+
+    def collect(self) -> list[HistogramMetricFamily]:
+        """Collects the histograms of all label values.
+        """
+        family = HistogramMetricFamily(self._name, self._documentation,
+                                       labels=self._labelnames)
+        with self._lock:
+            children = list(self._metrics.items())
+        for labelvalues, child in children:
+            buckets, sum_value = child.cumulative_buckets()
+            family.add_metric(list(labelvalues), buckets, sum_value)
+        return [family]
+
+    def _unlabeled(self) -> 'ExponentialBuckets':
+        if len(self._labelnames) > 0:
+            raise ValueError('No label values specified for a labeled metric')
+        return self._metrics[()]
+
+
+class ExponentialBuckets:  # pylint: disable=too-many-instance-attributes
+    """The sparse exponential buckets of one histogram.
+
+    Attributes:
+      scale: The scale of the buckets.
+    """
+
+    def __init__(self, scale: int = DEFAULT_SCALE,
+                 max_buckets: int = DEFAULT_MAX_BUCKETS) -> None:
+        self.scale = scale
+        # Positive values by the index of their bucket (b**i, b**(i + 1)],
+        # and negative values by that of their bucket (-b**(i + 1), -b**i].
+        self._positive = _Window(max_buckets)
+        self._negative = _Window(max_buckets)
+        self._zero_count = 0
+        self._negative_infinity_count = 0
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, amount: float) -> None:
+        """Observes a value.
+        """
+        amount = float(amount)
+        with self._lock:
+            self._count += 1
+            self._sum += amount
+            if amount == 0.0:
+                self._zero_count += 1
+            elif amount == -math.inf:
+                self._negative_infinity_count += 1
+            elif amount > 0 and amount != math.inf:
+                self._add_positive(bucket_index(amount, self.scale), 1)
+            elif amount < 0:
+                self._add_negative(_negative_bucket_index(-amount, self.scale), 1)
+
+    def observe_many(self, amounts: Sequence[float]) -> None:
+        """Observes values, as if observed one at a time.
+        """
+        if np is None or len(amounts) < _MIN_VECTORIZED_BATCH:
+            for amount in amounts:
+                self.observe(amount)
+            return
+        values = np.asarray(amounts, dtype=np.float64)
+        finite = values[np.isfinite(values)]
+        with self._lock:
+            self._count += len(values)
+            # Accumulate sequentially, as observing one at a time would.
+            with np.errstate(invalid='ignore'):
+                self._sum = float(np.add.accumulate(
+                    np.concatenate(([self._sum], values)))[-1])
+            self._zero_count += int(np.count_nonzero(finite == 0.0))
+            self._negative_infinity_count += int(np.count_nonzero(values == -np.inf))
+            positive = finite[finite > 0]
+            if len(positive) > 0:
+                self._add_many(self._positive, self._add_positive,
+                               _bucket_indices(positive, self.scale))
+            negative = -finite[finite < 0]
+            if len(negative) > 0:
+                self._add_many(self._negative, self._add_negative,
+                               _negative_bucket_indices(negative, self.scale))
+
+    def cumulative_buckets(self) -> tuple[list[tuple[str, int]], float]:
+        """Gets cumulative counts by upper bound, and the sum of values.
+
+        Bounds are those of all buckets in the range of indices of each
+        sign, including empty ones, so that a bound is exported from the
+        first value at or below it on.
+
+        Returns:
+          A list of (upper bound, count of values at most the bound) in
+          increasing order of bounds, ending with +Inf, and the sum.
+        """
+        with self._lock:
+            scale = self.scale
+            negative = self._negative.items()
+            positive = self._positive.items()
+            zero_count = self._zero_count
+            cumulative = self._negative_infinity_count
+            count = self._count
+            sum_value = self._sum
+        buckets = []
+        for index, bucket_count in reversed(negative):
+            cumulative += bucket_count
+            buckets.append((floatToGoString(-bucket_lower_bound(index, scale)), cumulative))
+        if zero_count > 0 or cumulative > 0:
+            cumulative += zero_count
+            buckets.append(('0', cumulative))
+        for index, bucket_count in positive:
+            cumulative += bucket_count
+            buckets.append((floatToGoString(bucket_lower_bound(index + 1, scale)), cumulative))
+        buckets.append(('+Inf', count))
+        return buckets, sum_value
+
+    def _add_positive(self, index: int, count: int) -> None:
+        window = self._positive
+        side = window.add(index, count)
+        if side < 0:
+            # Smaller values are still at most the lowest bound.
+            window.counts[window.low] = window.counts.get(window.low, 0) + count
+        # Larger values are only counted by the +Inf bucket.
+
+    def _add_negative(self, index: int, count: int) -> None:
+        window = self._negative
+        side = window.add(index, count)
+        if side < 0:
+            # Values closer to zero are only at most the bound of 0.
+            self._zero_count += count
+        elif side > 0:
+            window.counts[window.high] = window.counts.get(window.high, 0) + count
+
+    @staticmethod
+    def _add_many(window: '_Window', add: Callable[[int, int], None], indices: Any) -> None:
+        # Counts of distinct indices are added at once when the range they
+        # extend to does not depend on the order of the values.
+        unique, counts = np.unique(indices, return_counts=True)
+        if window.is_full() or window.fits(int(unique[0]), int(unique[-1])):
+            for index, count in zip(unique.tolist(), counts.tolist()):
+                add(index, count)
+        else:
+            for index in indices.tolist():
+                add(index, 1)
+
+
+class _Window:
+    """Counts of buckets over a contiguous range of indices, which grows
+    towards new indices up to a largest number of buckets, and never
+    shrinks.
+
+    Attributes:
+      counts: Counts of the buckets in the range, by index.
+      low: The lowest index of the range.
+      high: The highest index of the range, below low if empty.
+    """
+
+    def __init__(self, max_buckets: int) -> None:
+        self.counts: dict[int, int] = {}
+        self.low = 0
+        self.high = -1
+        self._max_buckets = max(max_buckets, 1)
+
+    def is_full(self) -> bool:
+        """Whether the range has the largest number of buckets.
+        """
+        return self.high - self.low + 1 >= self._max_buckets
+
+    def fits(self, low: int, high: int) -> bool:
+        """Whether extending the range to the given indices keeps it
+        within the largest number of buckets.
+        """
+        if self.high >= self.low:
+            low, high = min(low, self.low), max(high, self.high)
+        return high - low + 1 <= self._max_buckets
+
+    def add(self, index: int, count: int) -> int:
+        """Adds to the count of a bucket, extending the range towards it.
+
+        Returns:
+          0 if counted, else -1 or 1 if the index is below or above the
+          range, which cannot be extended to it.
+        """
+        if self.high < self.low:
+            self.low = self.high = index
+        elif index < self.low:
+            self.low = max(index, self.high - self._max_buckets + 1)
+        elif index > self.high:
+            self.high = min(index, self.low + self._max_buckets - 1)
+        if index < self.low:
+            return -1
+        if index > self.high:
+            return 1
+        self.counts[index] = self.counts.get(index, 0) + count
+        return 0
+
+    def items(self) -> list[tuple[int, int]]:
+        """Gets the counts of all buckets of the range, in increasing
+        order of index.
+        """
+        return [(index, self.counts.get(index, 0)) for index in range(self.low, self.high + 1)]
+
+
+def bucket_index(value: float, scale: int) -> int:
+    """Gets the index of the bucket holding a positive, finite value.
+
+    Args:
+      value: The value.
+      scale: The scale of the buckets.
+
+    Returns:
+      The index i of the bucket (b**i, b**(i + 1)] holding the value.
+    """
+    mantissa, exponent = math.frexp(value)
+    # Powers of two are the upper bounds of buckets.
+    exact = mantissa == 0.5
+    if scale <= 0:
+        return (exponent - 1 - exact) >> -scale
+    if exact:
+        return ((exponent - 1) << scale) - 1
+    index = math.ceil(math.log2(value) * (1 << scale)) - 1
+    # Correct rounding errors of the logarithm near bucket bounds.
+    return min(max(index, (exponent - 1) << scale), (exponent << scale) - 1)
+
+
+def bucket_lower_bound(index: int, scale: int) -> float:
+    """Gets the lower bound of a bucket, i.e the upper bound of the previous.
+
+    Args:
+      index: The index of the bucket.
+      scale: The scale of the buckets.
+
+    Returns:
+      The lower bound b**index of the bucket.
+    """
+    if scale <= 0:
+        return math.ldexp(1.0, index << -scale)
+    return 2.0 ** (index / (1 << scale))
+
+
+def _bucket_indices(values: Any, scale: int) -> Any:
+    mantissas, exponents = np.frexp(values)
+    exact = mantissas == 0.5
+    exponents = exponents.astype(np.int64)
+    if scale <= 0:
+        return (exponents - 1 - exact) >> -scale
+    indices = np.ceil(np.log2(values) * (1 << scale)).astype(np.int64) - 1
+    indices = np.clip(indices, (exponents - 1) << scale, (exponents << scale) - 1)
+    return np.where(exact, ((exponents - 1) << scale) - 1, indices)
+
+
+def _negative_bucket_index(value: float, scale: int) -> int:
+    # The index i of the bucket [b**i, b**(i + 1)) of a magnitude, so that
+    # negative values at a bound are counted with it.
+    index = bucket_index(value, scale)
+    return index + (bucket_lower_bound(index + 1, scale) == value)
+
+
+def _negative_bucket_indices(values: Any, scale: int) -> Any:
+    indices = _bucket_indices(values, scale)
+    if scale <= 0:
+        bounds = np.ldexp(1.0, (indices + 1) << -scale)
+    else:
+        bounds = 2.0 ** ((indices + 1) / (1 << scale))
+    return indices + (bounds == values)
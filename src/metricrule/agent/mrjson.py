@@ -0,0 +1,89 @@
+"""Decoding of JSON payloads.
+
+Payloads are decoded with orjson when it is installed, and with the
+standard library json module otherwise. Bodies that cannot be JSON are
+rejected by their first byte, without attempting to decode them.
+"""
+from typing import Any, Callable, Union
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the environment.
+    orjson = None  # type: ignore
+
+JSONDecoder = Callable[[Union[str, bytes]], Any]
+
+# Leading whitespace, then the first character of a JSON text.
+_JSON_START_BYTES = re.compile(rb'[ \t\r\n]*(?:[{\["0-9tfn]|-[0-9])')
+_JSON_START_STR = re.compile(r'[ \t\r\n]*(?:[{\["0-9tfn]|-[0-9])')
+_UTF8_BOM = b'\xef\xbb\xbf'
+
+
+def stdlib_decode(body: Union[str, bytes]) -> Any:
+    """Decodes a JSON payload with the standard library.
+
+    Args:
+      body: Content of the payload.
+
+    Returns:
+      The decoded object.
+
+    Raises:
+      ValueError: If the payload is not valid JSON.
+    """
+    return json.loads(body)
+
+
+def orjson_decode(body: Union[str, bytes]) -> Any:
+    """Decodes a JSON payload with orjson.
+
+    Payloads orjson rejects but the standard library accepts, like NaN
+    and Infinity literals, are decoded by the standard library. Integers
+    beyond 64 bits are decoded as floats.
+
+    Args:
+      body: Content of the payload.
+
+    Returns:
+      The decoded object.
+
+    Raises:
+      ImportError: If orjson is not installed.
+      ValueError: If the payload is not valid JSON.
+    """
+    if orjson is None:
+        raise ImportError('orjson_decode requires orjson, install metricrule[orjson]')
+    try:
+        return orjson.loads(body)  # pylint: disable=no-member
+    except ValueError:
+        return json.loads(body)
+
+
+def get_default_decoder() -> JSONDecoder:
+    """Gets the fastest JSON decoder available.
+
+    Returns:
+      orjson_decode if orjson is installed, else stdlib_decode.
+    """
+    if orjson is not None:
+        return orjson_decode
+    return stdlib_decode
+
+
+def may_be_json(body: Union[str, bytes]) -> bool:
+    """Gets whether a payload may be JSON, from its first character.
+
+    Args:
+      body: Content of the payload.
+
+    Returns:
+      False if the payload is certainly not JSON, e.g. it is empty, a
+      form or an HTML page, and True otherwise.
+    """
+    if isinstance(body, str):
+        return _JSON_START_STR.match(body) is not None
+    if body.startswith(_UTF8_BOM):
+        return _JSON_START_BYTES.match(body, len(_UTF8_BOM)) is not None
+    return _JSON_START_BYTES.match(body) is not None
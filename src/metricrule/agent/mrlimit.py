@@ -0,0 +1,236 @@
+"""Limits on the number of values of metric labels.
+
+Each label of a limited metric keeps its own series for at most a number
+of values. Values are kept as they first appear, until the limit is
+reached. Beyond it, the frequencies of other values are estimated with a
+space-saving sketch of candidates, and a candidate that is certainly more
+frequent than the least frequent kept value replaces it. Series of the
+replaced value are removed, so the number of series stays bounded. Values
+that are not kept are recorded as an `__other__` value, and counted.
+"""
+import heapq
+import threading
+from typing import Any, Optional, Sequence
+
+import prometheus_client
+
+from .mrconfig import CardinalityConfig
+from .mrmetric import MetricInstrumentSpec
+from .mrotel import Instrument
+
+
+class SpaceSaving:
+    """Estimates the counts of the most frequent items of a stream.
+
+    At most capacity items are counted. A new item replaces the item of
+    the smallest count, and inherits its count as an error bound, so an
+    estimate is never below the true count, and at most its error above.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self._capacity = max(capacity, 1)
+        self._counts: dict[str, tuple[int, int]] = {}
+        # Entries of counts, including outdated ones, ordered by count.
+        self._heap: list[tuple[int, str]] = []
+
+    def add(self, item: str, count: int = 1) -> tuple[int, int]:
+        """Counts occurrences of an item.
+
+        Args:
+          item: The item.
+          count: The number of occurrences.
+
+        Returns:
+          The estimated count of the item, and its error bound.
+        """
+        current = self._counts.get(item)
+        if current is not None:
+            return self.put(item, current[0] + count, current[1])
+        if len(self._counts) < self._capacity:
+            return self.put(item, count, 0)
+        smallest, smallest_count = self._pop_smallest()
+        del self._counts[smallest]
+        return self.put(item, smallest_count + count, smallest_count)
+
+    def put(self, item: str, count: int, error: int) -> tuple[int, int]:
+        """Sets the estimated count of an item, without replacing others.
+        """
+        self._counts[item] = (count, error)
+        heapq.heappush(self._heap, (count, item))
+        if len(self._heap) > 4 * self._capacity + 16:
+            self._heap = [(item_count, name) for name, (item_count, _) in self._counts.items()]
+            heapq.heapify(self._heap)
+        return count, error
+
+    def pop(self, item: str) -> Optional[tuple[int, int]]:
+        """Stops counting an item.
+
+        Returns:
+          The estimated count of the item and its error, if counted.
+        """
+        return self._counts.pop(item, None)
+
+    def _pop_smallest(self) -> tuple[str, int]:
+        while True:
+            count, item = heapq.heappop(self._heap)
+            current = self._counts.get(item)
+            if current is not None and current[0] == count:
+                return item, count
+
+
+class LabelLimiter:
+    """Keeps the most frequent values of one label of a metric.
+    """
+
+    def __init__(self, max_values: int, candidates: int, other_value: str) -> None:
+        self._max_values = max_values
+        self._other_value = other_value
+        self._kept: dict[str, int] = {}
+        self._candidates = SpaceSaving(candidates)
+        # A lower bound of the smallest count of kept values, which only
+        # increases as kept counts only increase.
+        self._threshold = 0
+        self._lock = threading.Lock()
+
+    def admit(self, value: str, count: int = 1) -> tuple[str, Optional[str]]:
+        """Counts occurrences of a value, and gets the value to record.
+
+        Args:
+          value: The label value.
+          count: The number of occurrences.
+
+        Returns:
+          The value to record, i.e the value or the other value, and a
+          kept value it replaced, if any.
+        """
+        with self._lock:
+            kept = self._kept
+            if value in kept:
+                kept[value] += count
+                return value, None
+            if len(kept) < self._max_values:
+                kept[value] = count
+                return value, None
+            estimate, error = self._candidates.add(value, count)
+            if estimate - error <= self._threshold:
+                return self._other_value, None
+            weakest = min(kept, key=kept.__getitem__)
+            self._threshold = kept[weakest]
+            if estimate - error <= self._threshold:
+                return self._other_value, None
+            self._candidates.pop(value)
+            kept[value] = estimate
+            self._candidates.put(weakest, kept.pop(weakest), 0)
+            return value, weakest
+
+
+class LimitedInstrument(Instrument):
+    """An instrument that limits the number of values of each label.
+    """
+
+    def __init__(self, instrument: Instrument, metric_name: str,  # pylint: disable=too-many-arguments
+                 max_values: int, cardinality: CardinalityConfig,
+                 collapsed: prometheus_client.Counter):
+        """Initializes the instrument.
+
+        Args:
+          instrument: The instrument to record limited labels to.
+          metric_name: Name of the metric of the instrument.
+          max_values: Largest number of values kept for each label.
+          cardinality: Configuration of the limits.
+          collapsed: Counter of values replaced by the other value.
+        """
+        self.instrument = instrument
+        self._metric_name = metric_name
+        self._max_values = max_values
+        self._cardinality = cardinality
+        self._collapsed = collapsed
+        self._limiters: dict[str, LabelLimiter] = {}
+        self._lock = threading.Lock()
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        self.instrument.record(value, self._limit(labels, 1))
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        self.instrument.record_many(values, self._limit(labels, len(values)))
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        self.instrument.remove_label_value(index, value)
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        self.instrument.unregister(registry)
+        # The limits of the metric, and its counts of replaced values, go
+        # with it.
+        with self._lock:
+            names = list(self._limiters)
+            self._limiters.clear()
+        for name in names:
+            try:
+                self._collapsed.remove(self._metric_name, name)
+            except KeyError:
+                # No value of the label was replaced.
+                pass
+
+    def _limit(self, labels: dict[str, str], count: int) -> dict[str, str]:
+        limited = {}
+        for index, (name, value) in enumerate(labels.items()):
+            kept, replaced = self._limiter(name).admit(value, count)
+            if replaced is not None:
+                self.instrument.remove_label_value(index, replaced)
+            if kept != value:
+                self._collapsed.labels(self._metric_name, name).inc(count)
+            limited[name] = kept
+        return limited
+
+    def _limiter(self, name: str) -> LabelLimiter:
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            with self._lock:
+                limiter = self._limiters.get(name)
+                if limiter is None:
+                    candidates = self._cardinality.candidates
+                    limiter = LabelLimiter(
+                        self._max_values,
+                        candidates if candidates is not None else 4 * self._max_values,
+                        self._cardinality.otherValue)
+                    self._limiters[name] = limiter
+        return limiter
+
+
+class CardinalityLimit:
+    """Limits on the label values of the instruments it wraps.
+    """
+
+    def __init__(self, cardinality: CardinalityConfig,
+                 registry: Optional[prometheus_client.CollectorRegistry] =
+                 prometheus_client.REGISTRY) -> None:
+        """Initializes the limits.
+
+        Args:
+          cardinality: Configuration of the limits.
+          registry: The registry to register the counter of replaced
+            values with, if any.
+        """
+        self._cardinality = cardinality
+        self._collapsed = prometheus_client.Counter(
+            cardinality.counterName,
+            'Number of label values replaced as beyond the limit of values of a label',
+            labelnames=('metric', 'label'),
+            registry=registry)
+
+    def wrap_instrument(self, spec: MetricInstrumentSpec, instrument: Instrument) -> Instrument:
+        """Wraps an instrument to limit its label values, if labeled.
+
+        Args:
+          spec: Specification of the instrument.
+          instrument: The instrument.
+
+        Returns:
+          The wrapped instrument if its metric has labels, else the
+          instrument.
+        """
+        if len(spec.labelNames) == 0:
+            return instrument
+        cardinality = self._cardinality
+        max_values = cardinality.metricMaxValues.get(spec.name, cardinality.maxValues)
+        return LimitedInstrument(instrument, spec.name, max_values, cardinality, self._collapsed)
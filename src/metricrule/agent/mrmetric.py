@@ -1,19 +1,27 @@
 """Module to generate metric specifications and instances.
 
-This module provides three functions:
+This module provides seven functions:
+  - compile_plan to compile a config into an extraction plan, so that
+      paths, specifications and converters are resolved only once.
   - get_instrument_specs to specify metric instruments from config.
   - get_metric_instances to generate instances / values of metrics,
       given a config and data.
   - get_context_labels to generate metric labels, given config and
        data.
+  - is_sampled to check whether a payload is needed for a request.
+  - reads_payload to check whether a payload is ever needed.
+  - get_payload_selection to get the parts of a payload that are read.
 """
-from typing import Any, Optional, NamedTuple
+from typing import Any, Callable, Mapping, Optional, NamedTuple, TYPE_CHECKING, Union
 from enum import Enum
 
-from jsonpath_ng import parse
 import prometheus_client
 
-from ..config_gen import metric_configuration_pb2  # pylint: disable=relative-beyond-top-level
+if TYPE_CHECKING:
+    from ..config_gen import metric_configuration_pb2  # pylint: disable=relative-beyond-top-level
+from .mrconfig import MetricOptions, SamplingConfig
+from .mrpath import compile_path, NativePath, PathEvaluator, PathStep
+from .mrselect import compile_selection, Selection
 
 
 class MetricInstrumentSpec(NamedTuple):
@@ -24,11 +32,13 @@ class MetricInstrumentSpec(NamedTuple):
       metricValueType: The type of value recorder (e.g int, float).
       name: The name of the instrument.
       labelNames: A list of label names associated with the instrument.
+      options: Agent-side options of the instrument, e.g its buckets.
     """
     instrumentType: type
     metricValueType: type
     name: str
     labelNames: tuple[str, ...]
+    options: Optional[MetricOptions] = None
 
 
 class MetricInstance(NamedTuple):
@@ -50,138 +60,388 @@ class MetricContext(Enum):
     OUTPUT = 3
 
 
+class ValuePlan(NamedTuple):
+    """A compiled value configuration.
+
+    Attributes:
+      staticValues: Values produced regardless of payload, for static values.
+      path: Evaluator returning the raw matches of a parsed value path,
+        or None if the value is not parsed from the payload.
+      converter: Converts a raw match to the configured parsed type.
+    """
+    staticValues: tuple[Any, ...]
+    path: Optional[PathEvaluator]
+    converter: Callable[[Any], Any]
+
+
+class LabelPlan(NamedTuple):
+    """A compiled label configuration.
+
+    Attributes:
+      key: The plan to extract label keys.
+      value: The plan to extract label values.
+    """
+    key: ValuePlan
+    value: ValuePlan
+
+
+class MetricPlan(NamedTuple):
+    """A compiled metric configuration.
+
+    Attributes:
+      spec: The instrument specification the metric is recorded to.
+      value: The plan to extract values, or None for counters which
+        always record a single increment.
+      labels: Plans for the labels attached to the metric.
+      sampleRate: Fraction of requests the metric is recorded for.
+    """
+    spec: MetricInstrumentSpec
+    value: Optional[ValuePlan]
+    labels: tuple[LabelPlan, ...]
+    sampleRate: float = 1.0
+
+
+class ContextPlan(NamedTuple):
+    """A compiled set of metrics and labels for one metric context.
+
+    Attributes:
+      contentFilter: Evaluator applied to a payload before extraction,
+        or None if the payload is used as is.
+      metrics: Plans for the metrics of the context.
+      contextLabels: Plans for labels to attach to all metrics.
+      sampleRate: Fraction of requests for which the payload of the
+        context is needed, i.e the largest rate of any dependent metric.
+      selection: The parts of a payload read by the plan, or None if
+        some path is not native and so may read any part.
+    """
+    contentFilter: Optional[PathEvaluator]
+    metrics: tuple[MetricPlan, ...]
+    contextLabels: tuple[LabelPlan, ...]
+    sampleRate: float = 1.0
+    selection: Optional[Selection] = None
+
+
+class ExtractionPlan(NamedTuple):
+    """A config compiled into plain Python objects, ready for execution.
+
+    Attributes:
+      input: The plan for the input (request) context.
+      output: The plan for the output (response) context.
+    """
+    input: ContextPlan
+    output: ContextPlan
+
+    def for_context(self, context: MetricContext) -> Optional[ContextPlan]:
+        """Gets the plan for a context, or None if it has no plan.
+        """
+        if context == MetricContext.INPUT:
+            return self.input
+        if context == MetricContext.OUTPUT:
+            return self.output
+        return None
+
+
+ConfigOrPlan = Union['metric_configuration_pb2.SidecarConfig', ExtractionPlan]
+
+
+def compile_plan(
+    config: 'metric_configuration_pb2.SidecarConfig',
+    sampling: Optional[SamplingConfig] = None,
+    metric_options: Optional[Mapping[str, MetricOptions]] = None,
+) -> ExtractionPlan:
+    """Compiles a configuration into an extraction plan.
+
+    Args:
+      config: A populated config proto.
+      sampling: Optional configuration of sampling rates for metrics.
+      metric_options: Optional options of the instruments of value
+        metrics, by metric name.
+
+    Returns:
+      A plan that can be passed in place of the config to the other
+      functions in this module.
+    """
+    if sampling is None:
+        sampling = SamplingConfig()
+    if metric_options is None:
+        metric_options = {}
+    context_labels = tuple(map(_compile_label, config.context_labels_from_input))
+    label_keys = _label_keys_no_payload(context_labels)
+
+    def compile_metrics_fn(metric_configs, context_rate: Optional[float]):
+        if context_rate is None:
+            context_rate = sampling.rate
+        return tuple(
+            _compile_metric(metric_config, label_keys, sampling.metricRates.get(
+                metric_config.name, context_rate), metric_options.get(metric_config.name))
+            for metric_config in metric_configs)
+    input_metrics = compile_metrics_fn(config.input_metrics, sampling.inputRate)
+    output_metrics = compile_metrics_fn(config.output_metrics, sampling.outputRate)
+    output_rate = max((m.sampleRate for m in output_metrics), default=0.0)
+    input_rate = max((m.sampleRate for m in input_metrics), default=0.0)
+    if len(context_labels) > 0:
+        # Context labels from the input are attached to output metrics.
+        input_rate = max(input_rate, output_rate)
+    input_filter = _compile_filter(config.input_content_filter)
+    output_filter = _compile_filter(config.output_content_filter)
+    return ExtractionPlan(
+        input=ContextPlan(
+            contentFilter=input_filter,
+            metrics=input_metrics,
+            contextLabels=context_labels,
+            sampleRate=input_rate,
+            selection=_compile_selection(input_filter, input_metrics, context_labels),
+        ),
+        output=ContextPlan(
+            contentFilter=output_filter,
+            metrics=output_metrics,
+            contextLabels=(),
+            sampleRate=output_rate,
+            selection=_compile_selection(output_filter, output_metrics, ()),
+        ),
+    )
+
+
 def get_instrument_specs(
-    config: metric_configuration_pb2.SidecarConfig
+    config: ConfigOrPlan
 ) -> dict[MetricContext, tuple[MetricInstrumentSpec, ...]]:
     """Gets instrument specifications needed for a configuration.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
 
     Returns:
       Instrument specifications, mapped to the context they should
       be used in.
     """
+    plan = _as_plan(config)
     specs = {}
-
-    def get_spec_fn(metric_config: metric_configuration_pb2.MetricConfig):
-        return _get_instrument_spec(metric_config, config.context_labels_from_input)
     specs[MetricContext.INPUT] = tuple(
-        map(get_spec_fn, config.input_metrics))
+        metric.spec for metric in plan.input.metrics)
     specs[MetricContext.OUTPUT] = tuple(
-        map(get_spec_fn, config.output_metrics))
+        metric.spec for metric in plan.output.metrics)
     return specs
 
 
 def get_metric_instances(
-    config: metric_configuration_pb2.SidecarConfig,
+    config: ConfigOrPlan,
     payload: Any,
     context: MetricContext,
+    sample_point: float = 0.0,
 ) -> dict[MetricInstrumentSpec, tuple[MetricInstance, ...]]:
     """Gets metric instances to record.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
       payload: Data based on which to generate metrics.
       context: The metric context to generate metrics for.
+      sample_point: A number in [0, 1) drawn for the request. Metrics
+        are only generated if this is below their sample rate, and
+        counter increments are scaled by the inverse of the rate.
 
     Returns:
       A mapping of instrument specifications to a sequence of
       generated metric instances.
     """
-    configs: tuple[metric_configuration_pb2.MetricConfig, ...]
-    filter_str: str
-    ctx_labels_for_spec: tuple[metric_configuration_pb2.LabelConfig, ...]
-    if context == MetricContext.INPUT:
-        configs = tuple(config.input_metrics)
-        filter_str = _format_filter(config.input_content_filter)
-        ctx_labels_for_spec = config.context_labels_from_input
-    elif context == MetricContext.OUTPUT:
-        configs = tuple(config.output_metrics)
-        filter_str = _format_filter(config.output_content_filter)
-        ctx_labels_for_spec = config.context_labels_from_input
-    else:
+    context_plan = _as_plan(config).for_context(context)
+    if context_plan is None:
         return {}
 
-    filtered_values: tuple[Any, ...] = (payload,)
-    if len(filter_str) > 0:
-        filtered_values = _get_filtered_values(filter_str, payload)
+    filtered_values = _get_filtered_values(
+        context_plan.contentFilter, payload)
 
     outputs: dict[MetricInstrumentSpec, list[MetricInstance]] = {}
-    for metric_config in configs:
+    for metric in context_plan.metrics:
+        if sample_point >= metric.sampleRate:
+            continue
+        instances = outputs.setdefault(metric.spec, [])
         for filtered_payload in filtered_values:
-            values = _get_metric_values(metric_config, filtered_payload)
-            labels = _get_metric_labels(metric_config, filtered_payload)
-            spec = _get_instrument_spec(metric_config, ctx_labels_for_spec)
-            if spec in outputs:
-                outputs[spec].append(MetricInstance(values, labels))
-            else:
-                outputs[spec] = [MetricInstance(values, labels)]
-    return {spec: tuple(instances) for spec, instances in outputs.items()}
+            values = _get_metric_values(metric, filtered_payload)
+            labels = _get_labels(metric.labels, filtered_payload)
+            instances.append(MetricInstance(values, labels))
+    return {spec: tuple(instances)
+            for spec, instances in outputs.items() if len(instances) > 0}
 
 
 def get_context_labels(
-    config: metric_configuration_pb2.SidecarConfig,
+    config: ConfigOrPlan,
     payload: Any,
     context: MetricContext,
 ) -> tuple[tuple[str, str], ...]:
     """Gets context labels to attach to metrics.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
       payload: Data based on which to generate labels.
       context: The metric context to generate labels for.
 
     Returns:
       A list of key-value pairs of the labels to attach.
     """
-    configs: tuple[metric_configuration_pb2.LabelConfig, ...]
-    filter_str: str
-    if context == MetricContext.INPUT:
-        configs = tuple(config.context_labels_from_input)
-        filter_str = _format_filter(config.input_content_filter)
-    elif context == MetricContext.OUTPUT:
-        return ()
-    else:
+    context_plan = _as_plan(config).for_context(context)
+    if context_plan is None or len(context_plan.contextLabels) == 0:
         return ()
 
-    filtered_values: tuple[Any, ...] = (payload,)
-    if len(filter_str) > 0:
-        filtered_values = _get_filtered_values(filter_str, payload)
+    filtered_values = _get_filtered_values(
+        context_plan.contentFilter, payload)
 
     labels: list[tuple[str, str]] = []
-    for label_config in configs:
+    for label in context_plan.contextLabels:
         for filtered_payload in filtered_values:
-            labels.extend(_get_labels_for_label_config(
-                label_config, filtered_payload))
+            labels.extend(_get_labels_for_label_plan(label, filtered_payload))
     return tuple(labels)
 
 
-def _format_filter(filter_str: str) -> str:
-    if len(filter_str) > 0 and (filter_str[0] == '.' or filter_str[0] == '['):
-        return '$' + filter_str
-    return filter_str
+def is_sampled(
+    config: ConfigOrPlan,
+    context: MetricContext,
+    sample_point: float,
+) -> bool:
+    """Gets whether the payload of a context is needed for a request.
+
+    Args:
+      config: A populated config proto, or a plan compiled from one.
+      context: The metric context of the payload.
+      sample_point: A number in [0, 1) drawn for the request.
+
+    Returns:
+      False if no metric in the context would be recorded for the
+      request, so the payload need not be parsed.
+    """
+    context_plan = _as_plan(config).for_context(context)
+    return context_plan is not None and sample_point < context_plan.sampleRate
+
+
+def reads_payload(
+    config: ConfigOrPlan,
+    context: MetricContext,
+) -> bool:
+    """Gets whether any metric or context label reads the payload of a context.
+
+    Args:
+      config: A populated config proto, or a plan compiled from one.
+      context: The metric context of the payload.
+
+    Returns:
+      False if the payload is never needed, so it need not be captured.
+    """
+    context_plan = _as_plan(config).for_context(context)
+    return context_plan is not None and (
+        len(context_plan.metrics) > 0 or len(context_plan.contextLabels) > 0)
 
 
-def _get_instrument_spec(
-    config: metric_configuration_pb2.MetricConfig,
-    context_labels: tuple[metric_configuration_pb2.LabelConfig, ...] = ()
-) -> MetricInstrumentSpec:
-    instrument_type = _get_instrument_type(config)
-    metric_value_type = _get_metric_value_type(config)
-    label_names = _get_metric_label_keys_no_payload(
-        config) + _label_keys_no_payload(context_labels)
+def get_payload_selection(
+    config: ConfigOrPlan,
+    context: MetricContext,
+) -> Optional[Selection]:
+    """Gets the parts of a payload read for a context.
 
-    return MetricInstrumentSpec(
-        instrumentType=instrument_type,
-        metricValueType=metric_value_type,
+    Args:
+      config: A populated config proto, or a plan compiled from one.
+      context: The metric context of the payload.
+
+    Returns:
+      A selection to decode payloads with, or None if the whole payload
+      may be read.
+    """
+    context_plan = _as_plan(config).for_context(context)
+    if context_plan is None:
+        return None
+    return context_plan.selection
+
+
+def _as_plan(config: ConfigOrPlan) -> ExtractionPlan:
+    if isinstance(config, ExtractionPlan):
+        return config
+    return compile_plan(config)
+
+
+def _compile_filter(filter_str: str) -> Optional[PathEvaluator]:
+    if len(filter_str) == 0:
+        return None
+    return compile_path(filter_str)
+
+
+def _compile_selection(
+    content_filter: Optional[PathEvaluator],
+    metrics: tuple[MetricPlan, ...],
+    context_labels: tuple[LabelPlan, ...],
+) -> Optional[Selection]:
+    value_plans = [metric.value for metric in metrics if metric.value is not None]
+    for labels in (context_labels,) + tuple(metric.labels for metric in metrics):
+        for label in labels:
+            value_plans.extend((label.key, label.value))
+    filter_steps: tuple[PathStep, ...] = ()
+    if isinstance(content_filter, NativePath):
+        filter_steps = content_filter.steps
+    elif content_filter is not None:
+        return None
+    value_steps = []
+    for value_plan in value_plans:
+        if isinstance(value_plan.path, NativePath):
+            value_steps.append(filter_steps + value_plan.path.steps)
+        elif value_plan.path is not None:
+            # Other paths may read any part of the payload.
+            return None
+    return compile_selection(value_steps, (filter_steps,))
+
+
+def _compile_metric(
+    config: 'metric_configuration_pb2.MetricConfig',
+    context_label_keys: tuple[str, ...] = (),
+    sample_rate: float = 1.0,
+    options: Optional[MetricOptions] = None,
+) -> MetricPlan:
+    labels = tuple(map(_compile_label, config.labels))
+    value = None
+    if config.WhichOneof('metric') == 'value':
+        value = _compile_value(config.value.value)
+    else:
+        # Options only apply to the instruments of value metrics.
+        options = None
+    spec = MetricInstrumentSpec(
+        instrumentType=_get_instrument_type(config),
+        metricValueType=_get_metric_value_type(config),
         name=config.name,
-        labelNames=label_names,
+        labelNames=_label_keys_no_payload(labels) + context_label_keys,
+        options=options,
     )
+    return MetricPlan(spec=spec, value=value, labels=labels,
+                      sampleRate=min(max(sample_rate, 0.0), 1.0))
+
+
+def _compile_label(
+    config: 'metric_configuration_pb2.LabelConfig',
+) -> LabelPlan:
+    return LabelPlan(
+        key=_compile_value(config.label_key),
+        value=_compile_value(config.label_value),
+    )
+
+
+def _compile_value(
+    config: 'metric_configuration_pb2.ValueConfig',
+) -> ValuePlan:
+    if config.HasField('parsed_value'):
+        return ValuePlan(
+            staticValues=(),
+            path=compile_path(config.parsed_value.field_path),
+            converter=_get_typed_converter(config.parsed_value.parsed_type),
+        )
+
+    static_values: tuple[Any, ...] = ()
+    configured_static_type = config.WhichOneof('static_value')
+    if configured_static_type == 'string_value':
+        static_values = (config.string_value,)
+    elif configured_static_type == 'integer_value':
+        static_values = (config.integer_value,)
+    elif configured_static_type == 'float_value':
+        static_values = (config.float_value,)
+    return ValuePlan(staticValues=static_values, path=None, converter=_to_none)
 
 
 def _get_instrument_type(
-    config: metric_configuration_pb2.MetricConfig,
+    config: 'metric_configuration_pb2.MetricConfig',
 ) -> type:
     configured_type = config.WhichOneof('metric')
     if configured_type == 'simple_counter':
@@ -193,7 +453,7 @@ def _get_instrument_type(
 
 
 def _get_metric_value_type(
-    config: metric_configuration_pb2.MetricConfig,
+    config: 'metric_configuration_pb2.MetricConfig',
 ) -> type:
     configured_type = config.WhichOneof('metric')
     if configured_type == 'simple_counter':
@@ -205,104 +465,87 @@ def _get_metric_value_type(
 
 
 def _get_filtered_values(
-    filter_str: str,
+    content_filter: Optional[PathEvaluator],
     payload: Any,
-) -> tuple[Any, ...]:
-    jsonpath_expr = parse(filter_str)
-    values = [match.value for match in jsonpath_expr.find(payload)]
-    return tuple(values)
+) -> list[Any]:
+    if content_filter is None:
+        return [payload]
+    return content_filter(payload)
 
 
 def _get_metric_values(
-    config: metric_configuration_pb2.MetricConfig,
+    metric: MetricPlan,
     payload: Any,
 ) -> tuple[Any, ...]:
-    configured_type = config.WhichOneof('metric')
-    if configured_type == 'simple_counter':
+    if metric.value is None:
+        if metric.sampleRate < 1.0:
+            return (1.0 / metric.sampleRate,)
         return (1,)
-    if configured_type == 'value':
-        return _extract_values(config.value.value, payload)
-    # Default to a counter
-    return (1,)
+    return _extract_values(metric.value, payload)
 
 
-def _get_metric_labels(
-    config: metric_configuration_pb2.MetricConfig,
+def _get_labels(
+    labels: tuple[LabelPlan, ...],
     payload: Any,
 ) -> tuple[tuple[str, str], ...]:
-    labels: list[tuple[str, str]] = []
-    for label_config in config.labels:
-        labels.extend(_get_labels_for_label_config(label_config, payload))
-    return tuple(labels)
-
-
-def _get_metric_label_keys_no_payload(
-    config: metric_configuration_pb2.MetricConfig
-) -> tuple[str, ...]:
-    return _label_keys_no_payload(config.labels)
+    if len(labels) == 0:
+        return ()
+    results: list[tuple[str, str]] = []
+    for label in labels:
+        results.extend(_get_labels_for_label_plan(label, payload))
+    return tuple(results)
 
 
 def _label_keys_no_payload(
-    configs: tuple[metric_configuration_pb2.LabelConfig, ...]
+    labels: tuple[LabelPlan, ...]
 ) -> tuple[str, ...]:
     label_keys: list[str] = []
-    for label_config in configs:
-        key = _extract_values(label_config.label_key, {})
-        label_keys.extend(key)
+    for label in labels:
+        label_keys.extend(str(key) for key in _extract_values(label.key, {}))
     return tuple(label_keys)
 
 
-def _get_labels_for_label_config(
-    config: metric_configuration_pb2.LabelConfig,
+def _get_labels_for_label_plan(
+    label: LabelPlan,
     payload: Any,
 ) -> tuple[tuple[str, str], ...]:
-    keys = _extract_values(config.label_key, payload)
-    values = _extract_values(config.label_value, payload)
+    keys = _extract_values(label.key, payload)
+    values = _extract_values(label.value, payload)
     iterlen = max(len(keys), len(values))
     results = []
     if len(keys) == 0 or len(values) == 0:
         return ()
     for i in range(iterlen):
-        key = keys[i % len(keys)]
-        value = values[i % len(values)]
+        # Parsed and static values may be numbers, but labels are strings.
+        key = str(keys[i % len(keys)])
+        value = str(values[i % len(values)])
         results.append((key, value))
     return tuple(results)
 
 
 def _extract_values(
-    config: metric_configuration_pb2.ValueConfig,
+    value: ValuePlan,
     payload: Any,
 ) -> tuple[Any, ...]:
-    if config.HasField('parsed_value'):
-        value_type = config.parsed_value.parsed_type
-        filter_str = _format_filter(config.parsed_value.field_path)
-        jsonpath_expr = parse(filter_str)
-        matches = jsonpath_expr.find(payload)
-        filtered = []
-        for match in matches:
-            filtered.append(_get_typed_value(match.value, value_type))
-        return tuple(filtered)
-
-    if config.HasField('static_value'):
-        configured_static_type = config.WhichOneof('static_value')
-        if configured_static_type == 'string_value':
-            return (config.string_value,)
-        if configured_static_type == 'integer_value':
-            return (config.integer_value,)
-        if configured_static_type == 'float_value':
-            return (config.float_value,)
-
-    return ()
-
-
-def _get_typed_value(
-    value: Any,
-    parsed_type: metric_configuration_pb2.ParsedValue.ParsedType,
-) -> Optional[Any]:
-    if parsed_type == metric_configuration_pb2.ParsedValue.FLOAT:
-        return float(value)
-    if parsed_type == metric_configuration_pb2.ParsedValue.INTEGER:
-        return int(value)
-    if parsed_type == metric_configuration_pb2.ParsedValue.STRING:
-        return str(value)
+    if value.path is None:
+        return value.staticValues
+    converter = value.converter
+    return tuple(converter(match) for match in value.path(payload))
+
+
+def _get_typed_converter(
+    parsed_type: 'metric_configuration_pb2.ParsedValue.ParsedType',
+) -> Callable[[Any], Any]:
+    # The config was loaded, so this does not import protobuf.
+    from ..config_gen.metric_configuration_pb2 import ParsedValue  # pylint: disable=relative-beyond-top-level,import-outside-toplevel
+    if parsed_type == ParsedValue.FLOAT:
+        return float
+    if parsed_type == ParsedValue.INTEGER:
+        return int
+    if parsed_type == ParsedValue.STRING:
+        return str
+    return _to_none
+
+
+def _to_none(_: Any) -> None:
     return None
@@ -3,13 +3,28 @@
 Methods to initialize a single instrument given a specification, and a
 set of instruments given a configuration, are provided.
 """
-from typing import Any
+from collections import OrderedDict
+from typing import Any, NamedTuple, Sequence, Union
 import abc
 
 import prometheus_client
+from prometheus_client.values import MutexValue
 
-from .mrmetric import MetricInstrumentSpec, MetricContext, get_instrument_specs
-from ..config_gen.metric_configuration_pb2 import SidecarConfig  # pylint: disable=relative-beyond-top-level
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+from .mrconfig import HistogramConfig, SketchConfig
+from .mrhistogram import ExponentialHistogram
+from .mrsketch import QuantileSketch
+from .mrmetric import ConfigOrPlan, MetricInstrumentSpec, MetricContext, get_instrument_specs
+from .mrprocess import get_multiprocess_dir
+
+# Default number of labeled children of a metric kept by an instrument.
+DEFAULT_MAX_CACHED_CHILDREN = 1024
+# Smallest batch of values recorded to a histogram with NumPy.
+MIN_VECTORIZED_BATCH = 16
 
 
 class Instrument(abc.ABC):
@@ -20,35 +35,191 @@ class Instrument(abc.ABC):
         """Associates the metric instrument with a value and labels.
         """
 
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        """Associates the metric instrument with values sharing labels.
+        """
+        for value in values:
+            self.record(value, labels)
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        """Removes the series with a value of a label, releasing them.
+
+        Args:
+          index: Position of the label in the label names of the metric.
+          value: The label value.
+        """
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        """Unregisters the metric of the instrument, e.g to replace it.
+        """
+
+
+class CacheInfo(NamedTuple):
+    """Statistics of a cache of labeled metric children.
+
+    Attributes:
+      hits: Number of lookups served from the cache.
+      misses: Number of lookups that resolved a child from the metric.
+      maxsize: Maximum number of children kept.
+      currsize: Number of children currently kept.
+    """
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class LabeledChildCache:
+    """A bounded LRU cache of children of a metric, by label values.
+
+    Resolving a child through the metric takes the metric's lock, so
+    repeated label values are served from here instead.
+    """
+
+    def __init__(self, metric: Any, maxsize: int = DEFAULT_MAX_CACHED_CHILDREN):
+        self._metric = metric
+        self._maxsize = maxsize
+        self._children: OrderedDict[tuple[str, ...], Any] = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, label_values: tuple[str, ...]) -> Any:
+        """Gets the child of the metric for the given label values.
+        """
+        child = self._children.get(label_values)
+        if child is not None:
+            self._hits += 1
+            try:
+                self._children.move_to_end(label_values)
+            except KeyError:
+                # Evicted concurrently, the child is still valid to use.
+                pass
+            return child
+        self._misses += 1
+        child = self._metric.labels(*label_values)
+        self._children[label_values] = child
+        while len(self._children) > self._maxsize:
+            try:
+                self._children.popitem(last=False)
+            except KeyError:
+                break
+        return child
+
+    def clear(self) -> None:
+        """Removes all cached children.
+        """
+        self._children.clear()
+
+    def remove_matching(self, index: int, value: str) -> None:
+        """Removes children with a label value from the metric and cache.
+
+        Args:
+          index: Position of the label in the label names of the metric.
+          value: The label value.
+        """
+        # pylint: disable=protected-access
+        with self._metric._lock:
+            label_values = [key for key in self._metric._metrics if key[index] == value]
+        for key in label_values:
+            self._children.pop(key, None)
+            try:
+                self._metric.remove(*key)
+            except KeyError:
+                # Removed concurrently.
+                pass
+
+    def cache_info(self) -> CacheInfo:
+        """Gets statistics of the cache.
+        """
+        return CacheInfo(self._hits, self._misses, self._maxsize, len(self._children))
+
 
 class Counter(Instrument):
     """Instrument that maintains a monotonically increasing count of a value.
     """
 
-    def __init__(self, counter: prometheus_client.Counter):
+    def __init__(self, counter: prometheus_client.Counter,
+                 max_cached_children: int = DEFAULT_MAX_CACHED_CHILDREN):
         self.counter = counter
+        self.children = LabeledChildCache(counter, max_cached_children)
 
     def record(self, value: Any, labels: dict[str, str]) -> None:
         if len(labels) > 0:
-            self.counter.labels(*[v for (_, v) in labels.items()]).inc(value)
+            self.children.get(tuple(labels.values())).inc(value)
         else:
             self.counter.inc(value)
 
+    def remove_label_value(self, index: int, value: str) -> None:
+        self.children.remove_matching(index, value)
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        registry.unregister(self.counter)
+
 
 class ValueRecorder(Instrument):
     """An instrument that records a value.
     """
 
-    def __init__(self, recorder: prometheus_client.Histogram):
+    def __init__(self, recorder: Union[prometheus_client.Histogram, ExponentialHistogram],
+                 max_cached_children: int = DEFAULT_MAX_CACHED_CHILDREN):
         self.recorder = recorder
+        self.children = LabeledChildCache(recorder, max_cached_children)
 
     def record(self, value: Any, labels: dict[str, str]) -> None:
         if len(labels) > 0:
-            self.recorder.labels(
-                *[v for (_, v) in labels.items()]).observe(value)
+            self.children.get(tuple(labels.values())).observe(value)
         else:
             self.recorder.observe(value)
 
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        if isinstance(self.recorder, ExponentialHistogram):
+            if len(labels) > 0:
+                self.children.get(tuple(labels.values())).observe_many(values)
+            else:
+                self.recorder.observe_many(values)
+            return
+        if np is None or len(values) < MIN_VECTORIZED_BATCH:
+            super().record_many(values, labels)
+            return
+        if len(labels) > 0:
+            _observe_many(self.children.get(tuple(labels.values())), values)
+        else:
+            _observe_many(self.recorder, values)
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        self.children.remove_matching(index, value)
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        registry.unregister(self.recorder)
+
+
+class QuantileRecorder(Instrument):
+    """An instrument that records values to quantile sketches.
+    """
+
+    def __init__(self, sketch: QuantileSketch,
+                 max_cached_children: int = DEFAULT_MAX_CACHED_CHILDREN):
+        self.sketch = sketch
+        self.children = LabeledChildCache(sketch, max_cached_children)
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        if len(labels) > 0:
+            self.children.get(tuple(labels.values())).observe(value)
+        else:
+            self.sketch.observe(value)
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        if len(labels) > 0:
+            self.children.get(tuple(labels.values())).observe_many(values)
+        else:
+            self.sketch.observe_many(values)
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        self.children.remove_matching(index, value)
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        registry.unregister(self.sketch)
+
 
 class NoOp(Instrument):
     """An instrument that does nothing.
@@ -68,6 +239,10 @@ def initialize_instrument(
 
     Returns:
       The initialized instrument.
+
+    Raises:
+      ValueError: If the options of the instrument are not supported in
+        multi-process mode, as its metric would not be scraped.
     """
     if spec.instrumentType == prometheus_client.Counter:
         counter = prometheus_client.Counter(
@@ -76,22 +251,44 @@ def initialize_instrument(
             labelnames=spec.labelNames)
         return Counter(counter)
     if spec.instrumentType == prometheus_client.Histogram:
+        if isinstance(spec.options, SketchConfig):
+            _check_single_process(spec.name, 'Quantile sketches')
+            return QuantileRecorder(QuantileSketch(
+                name=spec.name,
+                documentation='',
+                labelnames=spec.labelNames,
+                quantiles=spec.options.quantiles,
+                relative_accuracy=spec.options.relativeAccuracy,
+                max_bins=spec.options.maxBins))
+        options = spec.options if isinstance(spec.options, HistogramConfig) else HistogramConfig()
+        if options.exponentialScale is not None:
+            _check_single_process(spec.name, 'Exponential histograms')
+            return ValueRecorder(ExponentialHistogram(
+                name=spec.name,
+                documentation='',
+                labelnames=spec.labelNames,
+                scale=options.exponentialScale,
+                max_buckets=options.maxBuckets))
+        buckets: Sequence[float] = prometheus_client.Histogram.DEFAULT_BUCKETS
+        if options.buckets is not None:
+            buckets = options.buckets
         recorder = prometheus_client.Histogram(
             name=spec.name,
             documentation='',
-            labelnames=spec.labelNames)
+            labelnames=spec.labelNames,
+            buckets=buckets)
         return ValueRecorder(recorder)
     # TODO(jishnu): Add error logging.
     return NoOp()
 
 
 def initialize_all_instruments(
-    config: SidecarConfig
+    config: ConfigOrPlan
 ) -> dict[MetricContext, dict[MetricInstrumentSpec, Instrument]]:
     """Initializes all instruments specified by config.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
 
     Returns:
       A map of specification to instruments, by context.
@@ -107,3 +304,35 @@ def initialize_all_instruments(
         for spec in specs[MetricContext.OUTPUT]
     }
     return output
+
+
+def _check_single_process(name: str, kind: str) -> None:
+    # Metrics kept in process memory are not collected from the metric
+    # files of multi-process mode.
+    if get_multiprocess_dir() is not None:
+        raise ValueError(f'{kind} are not supported in multi-process mode: {name}')
+
+
+def _observe_many(histogram: prometheus_client.Histogram, values: Sequence[Any]) -> None:
+    """Observes values in a histogram, as if observed one at a time.
+    """
+    # pylint: disable=protected-access
+    histogram._raise_if_not_observable()
+    amounts = np.asarray(values, dtype=np.float64)
+    upper_bounds = histogram._upper_bounds
+    # Each value falls in the first bucket with a bound it does not exceed.
+    # NaN sorts past the last bound and is not counted in any bucket.
+    indices = np.searchsorted(upper_bounds, amounts, side='left')
+    counts = np.bincount(indices, minlength=len(upper_bounds) + 1)
+    for index in np.flatnonzero(counts[:len(upper_bounds)]):
+        histogram._buckets[index].inc(int(counts[index]))
+    histogram_sum = histogram._sum
+    if isinstance(histogram_sum, MutexValue):
+        # Accumulate sequentially from the current sum under one lock, so
+        # the result is identical to observing each value in turn.
+        with histogram_sum._lock:
+            histogram_sum._value = float(np.add.accumulate(
+                np.concatenate(([histogram_sum._value], amounts)))[-1])
+    else:
+        for amount in amounts.tolist():
+            histogram_sum.inc(amount)
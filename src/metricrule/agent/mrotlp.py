@@ -0,0 +1,404 @@
+"""Instruments exporting metrics to an OpenTelemetry collector.
+
+Instead of recording to prometheus_client, instruments aggregate values
+in memory, by label values: counters keep a sum, and value metrics keep
+the bucket counts, sum, count, minimum and maximum of a histogram. An
+exporter collects all instruments at an interval, and sends them in one
+OTLP/HTTP JSON request. With delta temporality, aggregates are reset at
+each export, otherwise they accumulate since their series was created.
+
+Failed exports are kept in a bounded buffer, and sent again before the
+next export, up to a number of attempts.
+"""
+from collections import deque
+from typing import Any, Deque, NamedTuple, Optional, Sequence
+import abc
+import bisect
+import json
+import logging
+import math
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import prometheus_client
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+from .mrconfig import HistogramConfig, OTLPConfig, Temporality
+from .mrmetric import MetricInstrumentSpec
+from .mrotel import Instrument, MIN_VECTORIZED_BATCH, NoOp
+
+_logger = logging.getLogger(__name__)
+
+# Status codes of export responses that may succeed if sent again.
+_RETRYABLE_STATUS_CODES = frozenset((429, 502, 503, 504))
+_SCOPE_NAME = 'metricrule'
+
+
+class ExportStats(NamedTuple):
+    """Counts of exports handled by an exporter.
+
+    Attributes:
+      exported: Number of exports accepted by the collector.
+      failed: Number of attempts that failed.
+      dropped: Number of exports discarded after failing, or as the
+        buffer of failed exports was full.
+    """
+    exported: int
+    failed: int
+    dropped: int
+
+
+class OTLPExporter:  # pylint: disable=too-many-instance-attributes
+    """Exports the aggregates of its instruments to an OTLP collector.
+    """
+
+    def __init__(self, otlp: OTLPConfig, *, start: bool = True) -> None:
+        """Initializes the exporter.
+
+        Args:
+          otlp: Configuration of the collector and exports.
+          start: Whether to start a thread exporting at each interval.
+            If not, flush must be called instead.
+        """
+        self._otlp = otlp
+        self._instruments: dict[str, '_Aggregate'] = {}
+        self._lock = threading.Lock()
+        # Failed exports, and the number of times each was sent.
+        self._pending: Deque[list[Any]] = deque()
+        self._export_lock = threading.Lock()
+        self._stats = ExportStats(0, 0, 0)
+        self._last_export = time.time_ns()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if start:
+            self._thread = threading.Thread(
+                target=self._run, name='metricrule-otlp-export', daemon=True)
+            self._thread.start()
+
+    @property
+    def stats(self) -> ExportStats:
+        """Counts of exports handled by this exporter so far.
+        """
+        with self._export_lock:
+            return self._stats
+
+    def initialize_instrument(self, spec: MetricInstrumentSpec) -> Instrument:
+        """Initializes an instrument exported by this exporter.
+
+        Args:
+          spec: Specification of the instrument to create.
+
+        Returns:
+          The initialized instrument.
+
+        Raises:
+          ValueError: If an instrument of the same name is exported.
+        """
+        instrument: _Aggregate
+        if spec.instrumentType == prometheus_client.Counter:
+            instrument = OTLPCounter(spec.name, spec.labelNames, self)
+        elif spec.instrumentType == prometheus_client.Histogram:
+            options = spec.options if isinstance(spec.options, HistogramConfig) else None
+            buckets: Sequence[float] = prometheus_client.Histogram.DEFAULT_BUCKETS
+            if options is not None and options.buckets is not None:
+                buckets = options.buckets
+            instrument = OTLPHistogram(spec.name, spec.labelNames, self,
+                                       [bound for bound in buckets if math.isfinite(bound)])
+        else:
+            return NoOp()
+        with self._lock:
+            if spec.name in self._instruments:
+                raise ValueError(f'Duplicated metric name: {spec.name}')
+            self._instruments[spec.name] = instrument
+        return instrument
+
+    def remove(self, instrument: '_Aggregate') -> None:
+        """Stops exporting an instrument.
+        """
+        with self._lock:
+            if self._instruments.get(instrument.name) is instrument:
+                del self._instruments[instrument.name]
+
+    def flush(self) -> ExportStats:
+        """Exports the current aggregates, and failed exports before them.
+
+        Returns:
+          The counts of exports so far.
+        """
+        with self._export_lock:
+            export = self._collect()
+            if export is not None:
+                if self._otlp.temporality == Temporality.CUMULATIVE:
+                    # Superseded by the new export.
+                    self._pending.clear()
+                elif len(self._pending) >= max(self._otlp.maxPendingExports, 1):
+                    self._pending.popleft()
+                    self._count(dropped=1)
+                self._pending.append([export, 0])
+            while len(self._pending) > 0:
+                pending = self._pending[0]
+                pending[1] += 1
+                retryable = self._send(pending[0])
+                if retryable is None:
+                    self._pending.popleft()
+                    self._count(exported=1)
+                    continue
+                self._count(failed=1)
+                if retryable and pending[1] < self._otlp.maxAttempts:
+                    # Sent again at the next interval, before newer exports.
+                    break
+                self._pending.popleft()
+                self._count(dropped=1)
+            return self._stats
+
+    def stop(self) -> None:
+        """Stops the thread exporting at each interval, if started, after
+        a last export of the current aggregates.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self.flush()
+
+    def _collect(self) -> Optional[bytes]:
+        now = time.time_ns()
+        delta_start, self._last_export = self._last_export, now
+        with self._lock:
+            instruments = list(self._instruments.values())
+        temporality = self._otlp.temporality
+        metrics = [metric for metric in (
+            instrument.collect(temporality, delta_start, now) for instrument in instruments)
+            if metric is not None]
+        if len(metrics) == 0:
+            return None
+        request = {'resourceMetrics': [{
+            'resource': {'attributes': [
+                _attribute('service.name', self._otlp.serviceName)]},
+            'scopeMetrics': [{'scope': {'name': _SCOPE_NAME}, 'metrics': metrics}],
+        }]}
+        return json.dumps(request, separators=(',', ':')).encode('utf-8')
+
+    def _send(self, data: bytes) -> Optional[bool]:
+        # Returns None on success, else whether the export may be retried.
+        request = urllib.request.Request(
+            self._otlp.endpoint, data=data, method='POST',
+            headers=dict(self._otlp.headers, **{'Content-Type': 'application/json'}))
+        try:
+            with urllib.request.urlopen(request, timeout=self._otlp.timeoutSeconds) as response:
+                response.read()
+            return None
+        except urllib.error.HTTPError as error:
+            _logger.warning('OTLP export to %s failed with status %d',
+                            self._otlp.endpoint, error.code)
+            return error.code in _RETRYABLE_STATUS_CODES
+        except OSError as error:
+            _logger.warning('OTLP export to %s failed: %s', self._otlp.endpoint, error)
+            return True
+
+    def _count(self, exported: int = 0, failed: int = 0, dropped: int = 0) -> None:
+        stats = self._stats
+        self._stats = ExportStats(stats.exported + exported, stats.failed + failed,
+                                  stats.dropped + dropped)
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self._otlp.intervalSeconds):
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception('Failed to export metrics')
+
+
+class _Aggregate(Instrument, abc.ABC):
+    """An instrument aggregating values by label values.
+
+    Attributes:
+      name: Name of the metric.
+    """
+
+    def __init__(self, name: str, label_names: Sequence[str], exporter: OTLPExporter):
+        self.name = name
+        self._label_names = tuple(label_names)
+        self._exporter = exporter
+        self._points: dict[tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        with self._lock:
+            for key in [key for key in self._points if key[index] == value]:
+                del self._points[key]
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        self._exporter.remove(self)
+
+    def collect(self, temporality: Temporality, delta_start: int,
+                now: int) -> Optional[dict[str, Any]]:
+        """Collects the aggregates of all label values.
+
+        Args:
+          temporality: The temporality of the collected aggregates. With
+            delta temporality, aggregates are reset.
+          delta_start: Time of the previous collection, in nanoseconds.
+          now: Time of the collection, in nanoseconds.
+
+        Returns:
+          The OTLP JSON metric, or None if there are no aggregates.
+        """
+        with self._lock:
+            if temporality == Temporality.DELTA:
+                points, self._points = self._points, {}
+            else:
+                points = {key: self._copy(point) for key, point in self._points.items()}
+        if len(points) == 0:
+            return None
+        data_points = []
+        for key, point in points.items():
+            data_point = self._data_point(point)
+            data_point['attributes'] = [
+                _attribute(name, value) for name, value in zip(self._label_names, key)]
+            start = delta_start if temporality == Temporality.DELTA else point[0]
+            data_point['startTimeUnixNano'] = str(start)
+            data_point['timeUnixNano'] = str(now)
+            data_points.append(data_point)
+        return self._metric(temporality, data_points)
+
+    @abc.abstractmethod
+    def _copy(self, point: Any) -> Any:
+        """Copies an aggregate, to collect it while values are recorded.
+        """
+
+    @abc.abstractmethod
+    def _data_point(self, point: Any) -> dict[str, Any]:
+        """Makes the OTLP JSON data point of an aggregate, without its
+        attributes and times.
+        """
+
+    @abc.abstractmethod
+    def _metric(self, temporality: Temporality,
+                data_points: list[dict[str, Any]]) -> dict[str, Any]:
+        """Makes the OTLP JSON metric of data points.
+        """
+
+
+class OTLPCounter(_Aggregate):
+    """An instrument aggregating the sum of a monotonic counter.
+    """
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        key = tuple(labels.values())
+        with self._lock:
+            point = self._points.get(key)
+            if point is None:
+                self._points[key] = [time.time_ns(), float(value)]
+            else:
+                point[1] += value
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        self.record(math.fsum(values), labels)
+
+    def _copy(self, point: Any) -> Any:
+        return list(point)
+
+    def _data_point(self, point: Any) -> dict[str, Any]:
+        return {'asDouble': point[1]}
+
+    def _metric(self, temporality: Temporality,
+                data_points: list[dict[str, Any]]) -> dict[str, Any]:
+        return {'name': self.name, 'sum': {
+            'aggregationTemporality': temporality.value,
+            'isMonotonic': True,
+            'dataPoints': data_points,
+        }}
+
+
+class OTLPHistogram(_Aggregate):
+    """An instrument aggregating values in a histogram of explicit buckets.
+
+    Non-finite values are not recorded, as they have no JSON encoding.
+    """
+
+    def __init__(self, name: str, label_names: Sequence[str], exporter: OTLPExporter,
+                 bounds: Sequence[float]):
+        """Initializes the instrument.
+
+        Args:
+          name: Name of the metric.
+          label_names: Names of the labels of the metric.
+          exporter: The exporter of the instrument.
+          bounds: Upper bounds of the buckets, in increasing order, with
+            a last bucket above all bounds.
+        """
+        super().__init__(name, label_names, exporter)
+        self._bounds = tuple(float(bound) for bound in bounds)
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        value = float(value)
+        if not math.isfinite(value):
+            return
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            point = self._point(tuple(labels.values()))
+            point[1][index] += 1
+            point[2] += value
+            point[3] += 1
+            point[4] = min(point[4], value)
+            point[5] = max(point[5], value)
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        if np is None or len(values) < MIN_VECTORIZED_BATCH:
+            super().record_many(values, labels)
+            return
+        amounts = np.asarray(values, dtype=np.float64)
+        amounts = amounts[np.isfinite(amounts)]
+        if len(amounts) == 0:
+            return
+        counts = np.bincount(np.searchsorted(self._bounds, amounts, side='left'),
+                             minlength=len(self._bounds) + 1).tolist()
+        total, smallest, largest = float(amounts.sum()), float(amounts.min()), float(amounts.max())
+        with self._lock:
+            point = self._point(tuple(labels.values()))
+            bucket_counts = point[1]
+            for index, count in enumerate(counts):
+                bucket_counts[index] += count
+            point[2] += total
+            point[3] += len(amounts)
+            point[4] = min(point[4], smallest)
+            point[5] = max(point[5], largest)
+
+    def _point(self, key: tuple[str, ...]) -> list[Any]:
+        # Start time, bucket counts, sum, count, minimum and maximum.
+        point = self._points.get(key)
+        if point is None:
+            point = [time.time_ns(), [0] * (len(self._bounds) + 1), 0.0, 0, math.inf, -math.inf]
+            self._points[key] = point
+        return point
+
+    def _copy(self, point: Any) -> Any:
+        return [point[0], list(point[1])] + point[2:]
+
+    def _data_point(self, point: Any) -> dict[str, Any]:
+        return {
+            'count': str(point[3]),
+            'sum': point[2],
+            'bucketCounts': [str(count) for count in point[1]],
+            'explicitBounds': list(self._bounds),
+            'min': point[4],
+            'max': point[5],
+        }
+
+    def _metric(self, temporality: Temporality,
+                data_points: list[dict[str, Any]]) -> dict[str, Any]:
+        return {'name': self.name, 'histogram': {
+            'aggregationTemporality': temporality.value,
+            'dataPoints': data_points,
+        }}
+
+
+def _attribute(key: Any, value: Any) -> dict[str, Any]:
+    # Collectors reject the whole export if a string value is not a string.
+    return {'key': str(key), 'value': {'stringValue': str(value)}}
@@ -0,0 +1,177 @@
+"""Evaluation of JSONPath expressions against parsed payloads.
+
+Paths that are chains of field, index and wildcard steps, like
+`.instances[*].Breed1[0]`, are compiled to a native evaluator returning raw
+values. Any other path falls back to jsonpath_ng, with the same results.
+"""
+from typing import Any, Callable, Optional, Union
+import re
+
+PathEvaluator = Callable[[Any], list[Any]]
+
+# Step kinds of a native path.
+FIELD = 'field'
+FIELD_WILDCARD = 'field_wildcard'
+INDEX = 'index'
+WILDCARD = 'wildcard'
+
+PathStep = tuple[str, Union[str, int, None]]
+
+_STEP_PATTERNS = (
+    (FIELD, re.compile(r'\.([A-Za-z_][A-Za-z0-9_]*)')),
+    (FIELD_WILDCARD, re.compile(r'\.\*')),
+    (INDEX, re.compile(r'\[\s*(-?\d+)\s*\]')),
+    (WILDCARD, re.compile(r'\[\s*\*\s*\]')),
+    (FIELD, re.compile(r'\[\s*\'([^\'\\\[\]]*)\'\s*\]')),
+    (FIELD, re.compile(r'\[\s*"([^"\\\[\]]*)"\s*\]')),
+)
+_NOT_SET = object()
+
+
+class NativePath:
+    """A compiled chain of field, index and wildcard steps.
+
+    Attributes:
+      steps: The sequence of (kind, argument) steps of the path.
+    """
+
+    def __init__(self, steps: tuple[PathStep, ...]) -> None:
+        self.steps = steps
+        self._ops = tuple((_FIND_FNS[kind], arg) for kind, arg in steps)
+
+    def __call__(self, payload: Any) -> list[Any]:
+        current = [payload]
+        for find_fn, arg in self._ops:
+            current = find_fn(current, arg)
+            if len(current) == 0:
+                break
+        return current
+
+
+class FallbackPath:
+    """A path evaluated by jsonpath_ng.
+    """
+
+    def __init__(self, path: str) -> None:
+        # Imported only once a path needs it, as it is slow to import.
+        from jsonpath_ng import parse  # pylint: disable=import-outside-toplevel
+        self._expr = parse(path)
+
+    def __call__(self, payload: Any) -> list[Any]:
+        return [match.value for match in self._expr.find(payload)]
+
+
+def compile_path(path: str) -> PathEvaluator:
+    """Compiles a path expression to an evaluator.
+
+    Args:
+      path: A JSONPath expression. A leading `$` is optional.
+
+    Returns:
+      A callable returning the values in a payload matched by the path.
+    """
+    steps = parse_native_steps(path)
+    if steps is not None:
+        return NativePath(steps)
+    return FallbackPath(_format_path(path))
+
+
+def parse_native_steps(path: str) -> Optional[tuple[PathStep, ...]]:
+    """Parses a path into the steps of a native path.
+
+    Args:
+      path: A JSONPath expression. A leading `$` is optional.
+
+    Returns:
+      The steps of the path, or None if the path needs jsonpath_ng.
+    """
+    path = path.strip()
+    if path.startswith('$'):
+        path = path[1:]
+    elif len(path) > 0 and path[0] not in '.[':
+        path = '.' + path
+    steps: list[PathStep] = []
+    pos = 0
+    while pos < len(path):
+        for kind, pattern in _STEP_PATTERNS:
+            match = pattern.match(path, pos)
+            if match is None:
+                continue
+            arg: Union[str, int, None] = None
+            if kind == INDEX:
+                arg = int(match.group(1))
+            elif kind == FIELD:
+                arg = match.group(1)
+            steps.append((kind, arg))
+            pos = match.end()
+            break
+        else:
+            return None
+    return tuple(steps)
+
+
+def _format_path(path: str) -> str:
+    if len(path) > 0 and (path[0] == '.' or path[0] == '['):
+        return '$' + path
+    return path
+
+
+def _find_field(values: list[Any], field: Any) -> list[Any]:
+    matches: list[Any] = []
+    for value in values:
+        try:
+            child = value.get(field, _NOT_SET)
+        except (TypeError, AttributeError):
+            continue
+        if child is not _NOT_SET:
+            matches.append(child)
+    return matches
+
+
+def _find_field_wildcard(values: list[Any], _: Any) -> list[Any]:
+    matches: list[Any] = []
+    for value in values:
+        if isinstance(value, dict):
+            matches.extend(value.values())
+    return matches
+
+
+def _find_index(values: list[Any], index: Any) -> list[Any]:
+    matches: list[Any] = []
+    for value in values:
+        # Integer indices apply to sequences, not mappings.
+        if isinstance(value, dict):
+            continue
+        try:
+            if value and -len(value) <= index < len(value):
+                matches.append(value[index])
+        except TypeError:
+            continue
+    return matches
+
+
+def _find_wildcard(values: list[Any], _: Any) -> list[Any]:
+    matches: list[Any] = []
+    for value in values:
+        if value is None:
+            continue
+        # Mappings and scalars match themselves, as a single-element list.
+        if isinstance(value, (dict, int, float, str, bool)):
+            matches.append(value)
+            continue
+        if isinstance(value, list):
+            matches.extend(value)
+            continue
+        try:
+            matches.extend(value[i] for i in range(len(value)))
+        except TypeError:
+            continue
+    return matches
+
+
+_FIND_FNS = {
+    FIELD: _find_field,
+    FIELD_WILDCARD: _find_field_wildcard,
+    INDEX: _find_index,
+    WILDCARD: _find_wildcard,
+}
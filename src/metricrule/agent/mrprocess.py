@@ -0,0 +1,165 @@
+"""Support for recording metrics from multiple worker processes.
+
+Pre-fork servers like gunicorn serve requests from several worker
+processes, each of which would otherwise only expose its own metrics.
+In multi-process mode, every worker writes its values to memory-mapped
+files in a shared directory, which are aggregated when metrics are
+scraped.
+
+Usage:
+  # In gunicorn.conf.py, so that workers inherit the mode when forked.
+  from metricrule.agent.mrprocess import enable_multiprocess
+  from metricrule.agent.mrprocess import on_starting, child_exit
+
+  enable_multiprocess('/tmp/metricrule')
+
+The metrics applications made by WSGIApplication.make and
+ASGIApplication.make then serve the aggregate of all workers.
+"""
+from typing import Any, Iterable, Optional
+import contextlib
+import glob
+import os
+
+import prometheus_client
+from prometheus_client import multiprocess, values
+from prometheus_client.mmap_dict import MmapedDict
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - pre-fork servers need POSIX.
+    fcntl = None  # type: ignore
+
+MULTIPROCESS_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+# Types of metrics whose values from dead processes are kept.
+_ARCHIVED_TYPES = ('counter', 'histogram', 'summary')
+_ARCHIVE_ID = 'archive'
+_LOCK_FILE = '.metricrule.lock'
+
+
+def enable_multiprocess(directory: str) -> None:
+    """Enables recording metrics to files shared between processes.
+
+    This must be called before any instrument is initialized, and should
+    be called before worker processes are forked.
+
+    Args:
+      directory: The directory to write metric files to. It is created
+        if it does not exist.
+    """
+    os.makedirs(directory, exist_ok=True)
+    os.environ[MULTIPROCESS_DIR_ENV] = directory
+    values.ValueClass = values.MultiProcessValue()
+
+
+def get_multiprocess_dir() -> Optional[str]:
+    """Gets the directory of metric files shared between processes.
+
+    Returns:
+      The directory, or None if not in multi-process mode.
+    """
+    return os.environ.get(MULTIPROCESS_DIR_ENV, os.environ.get(MULTIPROCESS_DIR_ENV.lower()))
+
+
+def get_scrape_registry() -> prometheus_client.CollectorRegistry:
+    """Gets the registry to expose to scrapes.
+
+    Returns:
+      The default registry, or in multi-process mode, a registry that
+      aggregates the metric files of all processes.
+    """
+    directory = get_multiprocess_dir()
+    if directory is None:
+        return prometheus_client.REGISTRY
+    registry = prometheus_client.CollectorRegistry()
+    ArchivingCollector(registry, directory)
+    return registry
+
+
+class ArchivingCollector(multiprocess.MultiProcessCollector):
+    """Collector of the metric files of live and dead processes.
+
+    Collection is serialized with archival of files of dead processes,
+    so that their values are neither missed nor counted twice.
+    """
+
+    def collect(self) -> Iterable[Any]:
+        with _locked(self._path, shared=True):
+            return list(super().collect())
+
+
+def mark_process_dead(pid: int, directory: Optional[str] = None) -> None:
+    """Cleans up the metric files of a process that has exited.
+
+    Values of live gauges of the process are removed. Values of counters,
+    histograms and summaries are added to a single archive file per type,
+    and the files of the process are removed, so that files do not
+    accumulate as workers are restarted.
+
+    Args:
+      pid: The process ID of the exited process.
+      directory: The directory of metric files, by default that of the
+        current process.
+    """
+    directory = directory or get_multiprocess_dir()
+    if directory is None:
+        return
+    with _locked(directory, shared=False):
+        multiprocess.mark_process_dead(pid, directory)
+        for metric_type in _ARCHIVED_TYPES:
+            path = os.path.join(directory, f'{metric_type}_{pid}.db')
+            if not os.path.exists(path):
+                continue
+            _archive(path, os.path.join(directory, f'{metric_type}_{_ARCHIVE_ID}.db'))
+            os.remove(path)
+
+
+def clear_multiprocess_dir(directory: Optional[str] = None) -> None:
+    """Removes all metric files, e.g left over from a previous run.
+
+    Args:
+      directory: The directory of metric files, by default that of the
+        current process.
+    """
+    directory = directory or get_multiprocess_dir()
+    if directory is None:
+        return
+    with _locked(directory, shared=False):
+        for path in glob.glob(os.path.join(directory, '*.db')):
+            os.remove(path)
+
+
+def on_starting(server: Any) -> None:  # pylint: disable=unused-argument
+    """A gunicorn server hook, to clear metric files of previous runs.
+    """
+    clear_multiprocess_dir()
+
+
+def child_exit(server: Any, worker: Any) -> None:  # pylint: disable=unused-argument
+    """A gunicorn server hook, to clean up metric files of exited workers.
+    """
+    mark_process_dead(worker.pid)
+
+
+def _archive(source_path: str, archive_path: str) -> None:
+    archive = MmapedDict(archive_path)
+    try:
+        for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(source_path):
+            current_value, _ = archive.read_value(key)
+            archive.write_value(key, current_value + value, timestamp)
+    finally:
+        archive.close()
+
+
+@contextlib.contextmanager
+def _locked(directory: str, shared: bool):
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(directory, _LOCK_FILE), 'a', encoding='utf-8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -2,77 +2,238 @@
 
 
 """
-import json
-from typing import MutableSequence, Optional, Tuple, Union
+from collections import deque
+import random
+import zlib
+from typing import Any, Deque, MutableSequence, Optional, Tuple, Union
 
-from ..config_gen.metric_configuration_pb2 import SidecarConfig  # pylint: disable=relative-beyond-top-level
-from .mrmetric import get_context_labels, get_metric_instances, MetricContext, MetricInstrumentSpec
+from .mrconfig import SamplingConfig
+from .mrjson import get_default_decoder, JSONDecoder, may_be_json
+from .mrmetric import ConfigOrPlan, MetricContext, MetricInstance, MetricInstrumentSpec
+from .mrmetric import get_context_labels, get_metric_instances, get_payload_selection, is_sampled
+from .mrmetric import reads_payload
 from .mrotel import Instrument
+from .mrselect import select_json, Selection
+
+# Default largest request or response body kept for recording, in bytes.
+DEFAULT_MAX_CAPTURE_BYTES = 16 * 1024 * 1024
 
 InstrumentMap = dict[MetricInstrumentSpec, Instrument]
 MutableLabelSequence = Optional[MutableSequence[Tuple[Tuple[str, str], ...]]]
 
+_default_decoder = get_default_decoder()
+
 
-def log_request_metrics(config: SidecarConfig,
+def log_request_metrics(config: ConfigOrPlan,  # pylint: disable=too-many-arguments
                         input_instruments: InstrumentMap,
                         request_body: Union[str, bytes],
-                        context_label_sink: MutableLabelSequence = None) -> None:
+                        context_label_sink: MutableLabelSequence = None,
+                        sample_point: float = 0.0,
+                        *,
+                        content_type: Optional[str] = None,
+                        decoder: Optional[JSONDecoder] = None,
+                        selective: bool = False) -> None:
     """Logs metrics for a request payload.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
       input_instruments: A map of instrument specifications to their
         equivalent initialized instruments.
       request_body: Content of the request payload received.
       context_label_sink: A mutable sequence to which any context labels
-        will be appended.
+        will be appended. This should be specific to the request, e.g
+        a new deque per request, so concurrent requests do not mix labels.
+      sample_point: The number drawn for the request by get_sample_point.
+      content_type: The Content-Type header of the request, if known.
+        Payloads of a non-JSON content type are not decoded.
+      decoder: The JSON decoder to use, by default the fastest installed.
+      selective: Whether to only decode the parts of the payload read by
+        the config, when the config only has native paths.
     """
-    try:
-        json_obj = json.loads(request_body)
-    except ValueError:
+    if not is_sampled(config, MetricContext.INPUT, sample_point):
+        return
+    selection = None
+    if selective:
+        selection = get_payload_selection(config, MetricContext.INPUT)
+    json_obj = _decode(request_body, content_type, decoder, selection)
+    if json_obj is None:
         return
     # TODO(jishnu): Cache these labels to use with response.
     context_labels = get_context_labels(
         config, json_obj, MetricContext.INPUT)
     metric_instances = get_metric_instances(
-        config, json_obj, MetricContext.INPUT)
+        config, json_obj, MetricContext.INPUT, sample_point)
     for spec, instances in metric_instances.items():
-        instrument = input_instruments[spec]
-        for instance in instances:
-            labels = {label[0]: label[1] for label in instance.labels}
-            labels.update({label[0]: label[1] for label in context_labels})
-            _ = [instrument.record(val, labels)
-                 for val in instance.metricValues]
+        _record_instances(input_instruments[spec], instances, context_labels)
     if context_label_sink is not None:
         context_label_sink.append(context_labels)
 
 
-def log_response_metrics(config: SidecarConfig,
+def log_response_metrics(config: ConfigOrPlan,  # pylint: disable=too-many-arguments
                          output_instruments: InstrumentMap,
                          response_body: Union[str, bytes],
-                         context_label_source: MutableLabelSequence = None) -> None:
+                         context_label_source: MutableLabelSequence = None,
+                         sample_point: float = 0.0,
+                         *,
+                         content_type: Optional[str] = None,
+                         decoder: Optional[JSONDecoder] = None,
+                         selective: bool = False) -> None:
     """Logs metrics for a response payload.
 
     Args:
-      config: A populated config proto.
+      config: A populated config proto, or a plan compiled from one.
       output_instruments: A map of instrument specifications to their
         equivalent initialized instruments.
       response_body: Content of the response payload sent.
       context_label_source: A mutable source from which any context labels
-        will be popped.
+        will be popped, i.e the sink passed for the same request.
+      sample_point: The number drawn for the request by get_sample_point.
+      content_type: The Content-Type header of the response, if known.
+        Payloads of a non-JSON content type are not decoded.
+      decoder: The JSON decoder to use, by default the fastest installed.
+      selective: Whether to only decode the parts of the payload read by
+        the config, when the config only has native paths.
     """
-    try:
-        json_obj = json.loads(response_body)
-    except ValueError:
+    if not is_sampled(config, MetricContext.OUTPUT, sample_point):
         return
+    selection = None
+    if selective:
+        selection = get_payload_selection(config, MetricContext.OUTPUT)
+    json_obj = _decode(response_body, content_type, decoder, selection)
+    if json_obj is None:
+        return
+    context_labels: tuple[tuple[str, str], ...] = ()
+    if context_label_source is not None and len(context_label_source) > 0:
+        # Labels from the request apply to every instance of the response.
+        context_labels = context_label_source.pop()
     metric_instances = get_metric_instances(
-        config, json_obj, MetricContext.OUTPUT)
+        config, json_obj, MetricContext.OUTPUT, sample_point)
     for spec, instances in metric_instances.items():
-        instrument = output_instruments[spec]
-        for instance in instances:
-            labels = {label[0]: label[1] for label in instance.labels}
-            if context_label_source is not None and len(context_label_source) > 0:
-                context_labels = context_label_source.pop()
-                labels.update({label[0]: label[1] for label in context_labels})
-            _ = [instrument.record(val, labels)
-                 for val in instance.metricValues]
+        _record_instances(output_instruments[spec], instances, context_labels)
+
+
+def log_exchange_metrics(config: ConfigOrPlan,  # pylint: disable=too-many-arguments
+                         instruments: dict[MetricContext, InstrumentMap],
+                         request_body: Optional[Union[str, bytes]],
+                         response_body: Optional[Union[str, bytes]],
+                         sample_point: float = 0.0,
+                         *,
+                         request_content_type: Optional[str] = None,
+                         decoder: Optional[JSONDecoder] = None,
+                         selective: bool = False) -> None:
+    """Logs metrics for a request payload and its response payload.
+
+    Args:
+      config: A populated config proto, or a plan compiled from one.
+      instruments: Maps of instrument specifications to their equivalent
+        initialized instruments, by context.
+      request_body: Content of the request payload received, or None if
+        it is not recorded.
+      response_body: Content of the response payload sent, or None if
+        it is not recorded.
+      sample_point: The number drawn for the request by get_sample_point.
+      request_content_type: The Content-Type header of the request, if
+        known.
+      decoder: The JSON decoder to use, by default the fastest installed.
+      selective: Whether to only decode the parts of payloads read by the
+        config, when the config only has native paths.
+    """
+    # Labels are kept per exchange, as exchanges may be recorded concurrently.
+    context_labels: Deque[tuple[tuple[str, str], ...]] = deque()
+    if request_body is not None:
+        log_request_metrics(
+            config, instruments[MetricContext.INPUT], request_body, context_labels,
+            sample_point, content_type=request_content_type, decoder=decoder,
+            selective=selective)
+    if response_body is not None:
+        log_response_metrics(
+            config, instruments[MetricContext.OUTPUT], response_body, context_labels,
+            sample_point, decoder=decoder, selective=selective)
+
+
+def needs_request_body(config: ConfigOrPlan, sampling: Optional[SamplingConfig]) -> bool:
+    """Gets whether request bodies must be captured to record a config.
+
+    Args:
+      config: A populated config proto, or a plan compiled from one.
+      sampling: The sampling configuration, if any.
+
+    Returns:
+      False if no input metric or context label reads the request, and
+      requests are not sampled by their body.
+    """
+    if sampling is not None and sampling.deterministic:
+        return True
+    return reads_payload(config, MetricContext.INPUT)
+
+
+def get_sample_point(sampling: Optional[SamplingConfig],
+                     request_body: Optional[Union[str, bytes]]) -> float:
+    """Draws the number used to sample metrics for a request.
+
+    Args:
+      sampling: The sampling configuration, if any.
+      request_body: Content of the request payload received, needed if
+        sampling is deterministic.
+
+    Returns:
+      A number in [0, 1), to pass to both log_request_metrics and
+      log_response_metrics for the request.
+    """
+    if sampling is None:
+        return 0.0
+    if sampling.deterministic:
+        if request_body is None:
+            raise ValueError('Deterministic sampling needs the request body')
+        if isinstance(request_body, str):
+            request_body = request_body.encode('utf-8')
+        return zlib.crc32(request_body) / 2**32
+    return random.random()
+
+
+def is_json_content_type(content_type: Optional[str]) -> bool:
+    """Gets whether a payload of a content type may hold JSON.
+
+    Args:
+      content_type: The value of a Content-Type header, if any.
+
+    Returns:
+      True if the content type is a JSON media type, or is not known.
+    """
+    if content_type is None or len(content_type) == 0:
+        return True
+    media_type = content_type.split(';', 1)[0].strip().lower()
+    return media_type == 'application/json' or media_type.endswith('+json')
+
+
+def _decode(body: Union[str, bytes],
+            content_type: Optional[str],
+            decoder: Optional[JSONDecoder],
+            selection: Optional[Selection]) -> Any:
+    # Non-JSON payloads are skipped without attempting to decode them.
+    if not is_json_content_type(content_type) or not may_be_json(body):
+        return None
+    try:
+        if selection is not None:
+            return select_json(body, selection)
+        return (decoder or _default_decoder)(body)
+    except ValueError:
+        return None
+
+
+def _record_instances(instrument: Instrument,
+                      instances: tuple[MetricInstance, ...],
+                      context_labels: tuple[tuple[str, str], ...]) -> None:
+    # Values sharing a label set are recorded as one batch.
+    batches: dict[tuple[tuple[str, str], ...], tuple[dict[str, str], list]] = {}
+    for instance in instances:
+        labels = {label[0]: label[1] for label in instance.labels}
+        labels.update({label[0]: label[1] for label in context_labels})
+        key = tuple(labels.items())
+        batch = batches.get(key)
+        if batch is None:
+            batches[key] = (labels, list(instance.metricValues))
+        else:
+            batch[1].extend(instance.metricValues)
+    for labels, values in batches.values():
+        instrument.record_many(values, labels)
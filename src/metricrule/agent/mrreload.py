@@ -0,0 +1,265 @@
+"""A compiled config and its instruments, reloaded as the config changes.
+
+The active state, a plan and the instruments it records to, is replaced
+as a whole by a single assignment. Requests read it once, so a request in
+flight is recorded with the state it started with, and never waits for a
+reload. On reload, the instrument specs of the old and new configs are
+compared: instruments of unchanged specs are kept with their values,
+instruments of new specs are registered, and those of removed specs are
+unregistered, along with their drift windows and cardinality limits. In
+multi-process mode, prometheus_client cannot remove values from metric
+files, so the values of removed metrics are still scraped until the files
+are cleared, e.g by on_starting when the server restarts.
+
+Instruments are held in a pool shared by the configs of an agent, e.g
+those of several endpoints, so that configs recording the same metric
+share its instrument.
+"""
+from typing import Callable, NamedTuple, Mapping, Optional
+import logging
+import os
+import threading
+
+import prometheus_client
+
+from .mrconfig import load_config, CardinalityConfig, DriftConfig, MetricOptions, OTLPConfig
+from .mrconfig import SamplingConfig
+from .mrdrift import DriftMonitor
+from .mrlimit import CardinalityLimit
+from .mrmetric import compile_plan, get_instrument_specs, ExtractionPlan, MetricContext
+from .mrmetric import MetricInstrumentSpec
+from .mrotel import initialize_instrument, Instrument
+from .mrotlp import OTLPExporter
+from .mrprocess import get_multiprocess_dir
+from .mrshard import initialize_sharded_instrument
+
+_logger = logging.getLogger(__name__)
+
+InstrumentWrapper = Callable[[MetricInstrumentSpec, Instrument], Instrument]
+
+
+class AgentState(NamedTuple):
+    """A compiled config and the instruments it records to.
+
+    Attributes:
+      config: The compiled config.
+      instruments: A map of specification to instruments, by context.
+    """
+    config: ExtractionPlan
+    instruments: dict[MetricContext, dict[MetricInstrumentSpec, Instrument]]
+
+
+class InstrumentPool:
+    """Instruments shared by the configs of an agent, by specification.
+
+    An instrument is registered when a config first acquires it, and
+    unregistered once every config that acquired it released it.
+
+    Attributes:
+      drift_monitor: The monitor of drift scores, if any.
+      exporter: The exporter of instruments to an OTLP collector, if
+        instruments are not recorded to prometheus_client.
+    """
+
+    def __init__(self, *, drift: Optional[DriftConfig] = None,
+                 cardinality: Optional[CardinalityConfig] = None,
+                 otlp: Optional[OTLPConfig] = None, sharded: bool = False):
+        """Initializes an empty pool.
+
+        Args:
+          drift: Configuration to export drift scores of value metrics.
+          cardinality: Configuration to limit the number of values of
+            each label of a metric.
+          otlp: Configuration to export instruments to an OTLP collector
+            instead of recording them to prometheus_client.
+          sharded: Whether instruments accumulate values in a shard per
+            thread, merged when scraped, instead of in children shared
+            by all threads.
+
+        Raises:
+          ValueError: If sharded in multi-process mode, as shards are
+            not collected from other processes.
+        """
+        if sharded and get_multiprocess_dir() is not None:
+            raise ValueError('Sharded instruments cannot be used in multi-process mode')
+        self.exporter: Optional[OTLPExporter] = None
+        self._initialize: Callable[[MetricInstrumentSpec], Instrument] = initialize_instrument
+        if otlp is not None:
+            self.exporter = OTLPExporter(otlp)
+            self._initialize = self.exporter.initialize_instrument
+        elif sharded:
+            self._initialize = initialize_sharded_instrument
+        self._wrappers: list[InstrumentWrapper] = []
+        if cardinality is not None:
+            self._wrappers.append(CardinalityLimit(cardinality).wrap_instrument)
+        self.drift_monitor: Optional[DriftMonitor] = None
+        if drift is not None:
+            self.drift_monitor = DriftMonitor(drift)
+            self._wrappers.append(self.drift_monitor.wrap_instrument)
+        self._instruments: dict[MetricInstrumentSpec, Instrument] = {}
+        self._references: dict[MetricInstrumentSpec, int] = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, spec: MetricInstrumentSpec) -> Instrument:
+        """Gets the instrument of a specification, creating it if needed.
+
+        Raises:
+          ValueError: If the instrument cannot be registered, e.g as
+            another instrument has the same name.
+        """
+        with self._lock:
+            instrument = self._instruments.get(spec)
+            if instrument is None:
+                instrument = self._initialize(spec)
+                for wrap in self._wrappers:
+                    instrument = wrap(spec, instrument)
+                self._instruments[spec] = instrument
+            self._references[spec] = self._references.get(spec, 0) + 1
+            return instrument
+
+    def release(self, spec: MetricInstrumentSpec) -> None:
+        """Releases an acquired instrument, unregistering it if unused.
+
+        The wrappers of an unregistered instrument drop the state they
+        keep for its metric. In multi-process mode, its values are still
+        scraped from the metric files.
+        """
+        with self._lock:
+            references = self._references[spec] - 1
+            if references > 0:
+                self._references[spec] = references
+                return
+            del self._references[spec]
+            self._instruments.pop(spec).unregister(prometheus_client.REGISTRY)
+
+    def stop(self) -> None:
+        """Stops the drift monitor and the exporter, if any.
+        """
+        if self.drift_monitor is not None:
+            self.drift_monitor.stop()
+        if self.exporter is not None:
+            self.exporter.stop()
+
+
+class ReloadableConfig:  # pylint: disable=too-many-instance-attributes
+    """The state of an agent, reloaded when its config file changes.
+    """
+
+    def __init__(self, config_path: Optional[str] = None, *,  # pylint: disable=too-many-arguments
+                 sampling: Optional[SamplingConfig] = None,
+                 metric_options: Optional[Mapping[str, MetricOptions]] = None,
+                 instruments: Optional[InstrumentPool] = None,
+                 reload_interval: Optional[float] = None):
+        """Loads the config, and starts watching it for changes if enabled.
+
+        Args:
+          config_path: The path to read agent config from.
+          sampling: Configuration to record metrics for only a fraction
+            of requests.
+          metric_options: Options of the instruments of value metrics.
+          instruments: The pool to acquire instruments from, by default
+            a pool of this config only.
+          reload_interval: If set, the config file is polled for changes
+            at this interval in seconds, and reloaded when it changes.
+        """
+        self._config_path = config_path or ''
+        self._sampling = sampling
+        self._metric_options = metric_options
+        self._pool = instruments if instruments is not None else InstrumentPool()
+        # Instruments acquired from the pool.
+        self._instruments: dict[MetricInstrumentSpec, Instrument] = {}
+        self._reload_lock = threading.Lock()
+        self._file_version = self._get_file_version()
+        config = self._compile()
+        self._acquire(config)
+        self.state = self._make_state(config)
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        if reload_interval is not None and len(self._config_path) > 0:
+            self._thread = threading.Thread(
+                target=self._watch, args=(reload_interval,),
+                name='metricrule-config-reload', daemon=True)
+            self._thread.start()
+
+    def reload(self) -> AgentState:
+        """Reloads the config, and swaps it in with its instruments.
+
+        Returns:
+          The new state.
+
+        Raises:
+          Exception: If the config cannot be loaded or compiled, in which
+            case the current state is kept.
+        """
+        with self._reload_lock:
+            self._file_version = self._get_file_version()
+            config = self._compile()
+            specs = _get_all_specs(config)
+            # Removed instruments are released first, so that changed
+            # specs of the same name can be registered.
+            removed = [spec for spec in self._instruments if spec not in specs]
+            for spec in removed:
+                del self._instruments[spec]
+                self._pool.release(spec)
+            try:
+                self._acquire(config)
+            except Exception:
+                # Instruments of the current config are acquired again, so
+                # that they are released with it.
+                current = _get_all_specs(self.state.config)
+                for spec in [spec for spec in self._instruments if spec not in current]:
+                    del self._instruments[spec]
+                    self._pool.release(spec)
+                self._acquire(self.state.config)
+                self.state = self._make_state(self.state.config)
+                raise
+            self.state = self._make_state(config)
+            return self.state
+
+    def stop(self) -> None:
+        """Stops watching the config file.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _compile(self) -> ExtractionPlan:
+        return compile_plan(load_config(self._config_path), self._sampling, self._metric_options)
+
+    def _acquire(self, config: ExtractionPlan) -> None:
+        for spec in _get_all_specs(config):
+            if spec not in self._instruments:
+                self._instruments[spec] = self._pool.acquire(spec)
+
+    def _make_state(self, config: ExtractionPlan) -> AgentState:
+        specs = get_instrument_specs(config)
+        return AgentState(config, {
+            context: {spec: self._instruments[spec] for spec in specs[context]}
+            for context in (MetricContext.INPUT, MetricContext.OUTPUT)
+        })
+
+    def _get_file_version(self) -> Optional[tuple[int, int]]:
+        try:
+            stat = os.stat(self._config_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _watch(self, interval: float) -> None:
+        while not self._stopped.wait(interval):
+            version = self._get_file_version()
+            if version is None or version == self._file_version:
+                continue
+            try:
+                self.reload()
+                _logger.info('Reloaded config from %s', self._config_path)
+            except Exception:  # pylint: disable=broad-except
+                # Not retried until the file changes again.
+                self._file_version = version
+                _logger.exception('Failed to reload config from %s', self._config_path)
+
+
+def _get_all_specs(config: ExtractionPlan) -> dict[MetricInstrumentSpec, None]:
+    # Specs of all contexts, in order.
+    specs = get_instrument_specs(config)
+    return dict.fromkeys(specs[MetricContext.INPUT] + specs[MetricContext.OUTPUT])
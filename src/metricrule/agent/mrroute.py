@@ -0,0 +1,121 @@
+"""Agent configs by route, for servers of several endpoints.
+
+A route table maps the method and path of a request to the config of its
+endpoint. Requests of unmatched routes are not recorded, so the
+middlewares pass them through without capturing their bodies, e.g for
+health checks, static files or the metrics scrape itself. Configs of all
+routes acquire instruments from one pool, so that endpoints recording the
+same metric share its instrument.
+"""
+from typing import Mapping, NamedTuple, Optional, Sequence
+
+from .mrconfig import CardinalityConfig, DriftConfig, MetricOptions, OTLPConfig, RouteConfig
+from .mrconfig import SamplingConfig
+from .mrreload import InstrumentPool, ReloadableConfig
+
+
+class _Route(NamedTuple):
+    # The path prefix, without trailing slashes.
+    prefix: str
+    methods: frozenset[str]
+    agent: ReloadableConfig
+
+
+class RouteTable:
+    """The reloadable configs of a server, by route.
+
+    Attributes:
+      instruments: The pool of the instruments of all configs.
+    """
+
+    def __init__(self, config_path: Optional[str] = None,  # pylint: disable=too-many-arguments
+                 routes: Optional[Sequence[RouteConfig]] = None, *,
+                 sampling: Optional[SamplingConfig] = None,
+                 metric_options: Optional[Mapping[str, MetricOptions]] = None,
+                 drift: Optional[DriftConfig] = None,
+                 cardinality: Optional[CardinalityConfig] = None,
+                 reload_interval: Optional[float] = None,
+                 otlp: Optional[OTLPConfig] = None, sharded: bool = False):
+        """Loads the configs of all routes.
+
+        Args:
+          config_path: The path to read the config of all requests from,
+            if no routes are given.
+          routes: The routes of the endpoints to record, with their
+            configs. Routes of the same config path share one config.
+          sampling: Configuration to record metrics for only a fraction
+            of requests.
+          metric_options: Options of the instruments of value metrics.
+          drift: Configuration to export drift scores of value metrics.
+          cardinality: Configuration to limit the number of values of
+            each label of a metric.
+          reload_interval: If set, config files are polled for changes at
+            this interval in seconds, and reloaded when they change.
+          otlp: Configuration to export metrics to an OTLP collector
+            instead of recording them to prometheus_client.
+          sharded: Whether values are accumulated in a shard per thread,
+            merged when scraped, instead of in metrics shared by threads.
+
+        Raises:
+          ValueError: If both a config path and routes are given, or if
+            sharded in multi-process mode.
+        """
+        if routes is None:
+            routes = (RouteConfig('', config_path or ''),)
+        elif config_path is not None:
+            raise ValueError('A config path cannot be given with routes')
+        self.instruments = InstrumentPool(
+            drift=drift, cardinality=cardinality, otlp=otlp, sharded=sharded)
+        self._agents: dict[str, ReloadableConfig] = {}
+        compiled = []
+        try:
+            for route in routes:
+                agent = self._agents.get(route.configPath)
+                if agent is None:
+                    agent = ReloadableConfig(
+                        route.configPath, sampling=sampling, metric_options=metric_options,
+                        instruments=self.instruments, reload_interval=reload_interval)
+                    self._agents[route.configPath] = agent
+                compiled.append(_Route(
+                    route.pathPrefix.rstrip('/'),
+                    frozenset(method.upper() for method in route.methods), agent))
+        except Exception:
+            self.stop()
+            raise
+        # Longest prefixes first, so that the most specific route matches.
+        self._routes = tuple(sorted(compiled, key=lambda route: len(route.prefix), reverse=True))
+
+    def match(self, method: str, path: str) -> Optional[ReloadableConfig]:
+        """Gets the config of the route of a request.
+
+        Args:
+          method: The HTTP method of the request.
+          path: The path of the request.
+
+        Returns:
+          The config, or None if no route matches.
+        """
+        for route in self._routes:
+            # Prefixes match whole segments, so that /predict does not
+            # match /predictions.
+            if (path == route.prefix or path.startswith(route.prefix + '/')) and (
+                    len(route.methods) == 0 or method.upper() in route.methods):
+                return route.agent
+        return None
+
+    def reload(self) -> None:
+        """Reloads the configs of all routes.
+
+        Raises:
+          Exception: If a config cannot be loaded, in which case the
+            current state of that config is kept.
+        """
+        for agent in self._agents.values():
+            agent.reload()
+
+    def stop(self) -> None:
+        """Stops watching config files, and the drift monitor, if any.
+        """
+        for agent in self._agents.values():
+            agent.stop()
+        self.instruments.stop()
@@ -0,0 +1,301 @@
+"""Selective decoding of JSON payloads.
+
+A selection is compiled from the native paths a config reads. Decoding a
+payload with it only materializes the values those paths can reach: other
+object members are skipped without being decoded, and other array elements
+are decoded as None placeholders, so array indices are unchanged. Skipped
+values are only scanned for the characters that delimit them, which is
+much cheaper than building them for large strings and arrays such as
+images and embeddings. Small objects and arrays are decoded completely,
+as the standard library decoder is faster than selecting from them.
+
+Skipped values are not validated, so a payload that is not valid JSON may
+be decoded as long as the selected values are valid.
+"""
+from typing import Any, Iterable, NamedTuple, Optional, Union
+import json
+import re
+
+from .mrpath import FIELD, FIELD_WILDCARD, INDEX, WILDCARD, PathStep
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_SCALAR = re.compile(
+    r'(?:-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?'
+    r'|true|false|null|NaN|-?Infinity)')
+_STRUCTURAL_CHARS = '"[]{}'
+# Containers with at least this many structural characters in the window
+# after their start are skipped by decoding them, as finding characters one
+# by one is slower than the standard library decoder where they are dense.
+_DENSE_WINDOW_CHARS = 256
+_DENSE_STRUCTURAL_CHARS = 8
+
+_raw_decode = json.JSONDecoder().raw_decode
+
+# Objects and arrays shorter than this are decoded completely by default.
+DEFAULT_SMALL_VALUE_CHARS = 4096
+
+
+class Selection(NamedTuple):
+    """A compiled set of values to materialize when decoding a payload.
+
+    Attributes:
+      keepAll: Whether the value is materialized completely.
+      fields: Selections of the members of an object, by name.
+      anyField: Selection of object members not in fields, if any.
+      indices: Selections of the elements of an array, by index.
+      anyIndex: Selection of array elements not in indices, if any.
+    """
+    keepAll: bool
+    fields: dict[str, 'Selection']
+    anyField: Optional['Selection']
+    indices: dict[int, 'Selection']
+    anyIndex: Optional['Selection']
+
+
+def compile_selection(value_paths: Iterable[tuple[PathStep, ...]],
+                      visit_paths: Iterable[tuple[PathStep, ...]] = ()) -> Selection:
+    """Compiles the paths read from a payload into a selection.
+
+    Args:
+      value_paths: Steps of paths whose matches are read, and so are
+        materialized completely.
+      visit_paths: Steps of paths whose matches only need to be present,
+        e.g a content filter whose matches are counted.
+
+    Returns:
+      A selection materializing everything the paths can match.
+    """
+    return _build([(steps, True) for steps in value_paths] +
+                  [(steps, False) for steps in visit_paths])
+
+
+def select_json(body: Union[str, bytes], selection: Selection,
+                small_value_chars: int = DEFAULT_SMALL_VALUE_CHARS) -> Any:
+    """Decodes the selected values of a JSON payload.
+
+    Args:
+      body: Content of the payload.
+      selection: The values to materialize.
+      small_value_chars: Objects and arrays shorter than this are decoded
+        completely, which is faster than selecting from them.
+
+    Returns:
+      The decoded payload, without values not in the selection.
+
+    Raises:
+      ValueError: If the payload is not JSON.
+    """
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode('utf-8-sig')
+    decoder = _SelectingDecoder(body, small_value_chars)
+    try:
+        pos = _skip_whitespace(body, 0)
+        value, pos = decoder.decode_value(pos, selection)
+    except IndexError as exc:
+        raise ValueError('Unexpected end of JSON payload') from exc
+    if _skip_whitespace(body, pos) != len(body):
+        raise ValueError(f'Extra data in JSON payload at {pos}')
+    return value
+
+
+def _build(paths: list[tuple[tuple[PathStep, ...], bool]]) -> Selection:
+    keep_all = False
+    field_paths: dict[str, list] = {}
+    any_field_paths: list = []
+    index_paths: dict[int, list] = {}
+    any_index_paths: list = []
+    pending = list(paths)
+    while len(pending) > 0:
+        steps, keep = pending.pop()
+        if len(steps) == 0:
+            keep_all = keep_all or keep
+            continue
+        (kind, arg), rest = steps[0], (steps[1:], keep)
+        if kind == FIELD:
+            field_paths.setdefault(str(arg), []).append(rest)
+        elif kind == FIELD_WILDCARD:
+            any_field_paths.append(rest)
+        elif kind == INDEX and isinstance(arg, int) and arg >= 0:
+            index_paths.setdefault(arg, []).append(rest)
+        elif kind in (INDEX, WILDCARD):
+            # Negative indices depend on the length of the array, so
+            # select every element.
+            any_index_paths.append(rest)
+            if kind == WILDCARD:
+                # Wildcards also match objects and scalars themselves.
+                pending.append(rest)
+    if keep_all:
+        return Selection(True, {}, None, {}, None)
+    return Selection(
+        keepAll=False,
+        fields={name: _build(field_path + any_field_paths)
+                for name, field_path in field_paths.items()},
+        anyField=_build(any_field_paths) if len(any_field_paths) > 0 else None,
+        indices={index: _build(index_path + any_index_paths)
+                 for index, index_path in index_paths.items()},
+        anyIndex=_build(any_index_paths) if len(any_index_paths) > 0 else None,
+    )
+
+
+class _SelectingDecoder:
+    """Decoder of the selected values of one payload.
+
+    Structural characters are found with str.find, which is much faster
+    than matching a regular expression over long strings and arrays. The
+    next position of each character is kept, as positions only increase.
+    """
+
+    def __init__(self, body: str, small_value_chars: int) -> None:
+        self._body = body
+        self._small_value_chars = small_value_chars
+        self._next = dict.fromkeys(_STRUCTURAL_CHARS, -2)
+
+    def decode_value(self, pos: int, selection: Selection) -> tuple[Any, int]:
+        """Decodes the value at a position, and gets the position after it.
+        """
+        body = self._body
+        if not selection.keepAll:
+            char = body[pos]
+            if char in '{[':
+                small_value = self._decode_small(pos)
+                if small_value is not None:
+                    return small_value
+                if char == '{':
+                    return self._decode_object(pos, selection)
+                return self._decode_array(pos, selection)
+        try:
+            return _raw_decode(body, pos)
+        except json.JSONDecodeError as exc:
+            raise ValueError(str(exc)) from exc
+
+    def skip_value(self, pos: int) -> int:
+        """Gets the position after the value at a position.
+        """
+        char = self._body[pos]
+        if char == '"':
+            return self._skip_string(pos)
+        if char in '{[':
+            return self._skip_container(pos)
+        match = _SCALAR.match(self._body, pos)
+        if match is None:
+            raise ValueError(f'Unexpected character in JSON payload at {pos}')
+        return match.end()
+
+    def _decode_small(self, pos: int) -> Optional[tuple[Any, int]]:
+        # Decoding fails if the value does not end within the window.
+        window = self._body[pos:pos + self._small_value_chars]
+        try:
+            value, end = _raw_decode(window)
+        except json.JSONDecodeError:
+            return None
+        return value, pos + end
+
+    def _decode_object(self, pos: int, selection: Selection) -> tuple[Any, int]:
+        body = self._body
+        result: dict[str, Any] = {}
+        pos = _skip_whitespace(body, pos + 1)
+        if body[pos] == '}':
+            return result, pos + 1
+        while True:
+            if body[pos] != '"':
+                raise ValueError(f'Expected a member name in JSON payload at {pos}')
+            end = self._skip_string(pos)
+            key = body[pos + 1:end - 1]
+            if '\\' in key:
+                key = json.loads(body[pos:end])
+            pos = _skip_whitespace(body, end)
+            if body[pos] != ':':
+                raise ValueError(f'Expected ":" in JSON payload at {pos}')
+            pos = _skip_whitespace(body, pos + 1)
+            child = selection.fields.get(key, selection.anyField)
+            if child is None:
+                pos = self.skip_value(pos)
+            else:
+                result[key], pos = self.decode_value(pos, child)
+            pos = _skip_whitespace(body, pos)
+            char = body[pos]
+            if char == '}':
+                return result, pos + 1
+            if char != ',':
+                raise ValueError(f'Expected "," or "}}" in JSON payload at {pos}')
+            pos = _skip_whitespace(body, pos + 1)
+
+    def _decode_array(self, pos: int, selection: Selection) -> tuple[Any, int]:
+        body = self._body
+        result: list[Any] = []
+        pos = _skip_whitespace(body, pos + 1)
+        if body[pos] == ']':
+            return result, pos + 1
+        while True:
+            child = selection.indices.get(len(result), selection.anyIndex)
+            if child is None:
+                pos = self.skip_value(pos)
+                result.append(None)
+            else:
+                value, pos = self.decode_value(pos, child)
+                result.append(value)
+            pos = _skip_whitespace(body, pos)
+            char = body[pos]
+            if char == ']':
+                return result, pos + 1
+            if char != ',':
+                raise ValueError(f'Expected "," or "]" in JSON payload at {pos}')
+            pos = _skip_whitespace(body, pos + 1)
+
+    def _find(self, char: str, pos: int) -> int:
+        found = self._next[char]
+        if found < pos and found != -1:
+            found = self._body.find(char, pos)
+            self._next[char] = found
+        return found
+
+    def _skip_string(self, pos: int) -> int:
+        body = self._body
+        end = self._find('"', pos + 1)
+        while end != -1:
+            # A quote is escaped by an odd number of backslashes.
+            start = end - 1
+            while body[start] == '\\':
+                start -= 1
+            if (end - start) % 2 == 1:
+                return end + 1
+            end = self._find('"', end + 1)
+        raise ValueError(f'Unterminated string in JSON payload at {pos}')
+
+    def _skip_container(self, pos: int) -> int:
+        body = self._body
+        depth = 0
+        while True:
+            char = body[pos]
+            if char == '"':
+                pos = self._skip_string(pos)
+            elif char in '{[':
+                if self._is_dense(pos):
+                    try:
+                        pos = _raw_decode(body, pos)[1]
+                    except json.JSONDecodeError as exc:
+                        raise ValueError(str(exc)) from exc
+                else:
+                    depth += 1
+                    pos += 1
+            else:
+                depth -= 1
+                pos += 1
+            if depth == 0:
+                return pos
+            next_pos = -1
+            for structural_char in _STRUCTURAL_CHARS:
+                found = self._find(structural_char, pos)
+                if found != -1 and (next_pos == -1 or found < next_pos):
+                    next_pos = found
+            if next_pos == -1:
+                raise ValueError(f'Unterminated value in JSON payload at {pos}')
+            pos = next_pos
+
+    def _is_dense(self, pos: int) -> bool:
+        window = self._body[pos + 1:pos + 1 + _DENSE_WINDOW_CHARS]
+        return sum(map(window.count, _STRUCTURAL_CHARS)) >= _DENSE_STRUCTURAL_CHARS
+
+
+def _skip_whitespace(body: str, pos: int) -> int:
+    return _WHITESPACE.match(body, pos).end()  # type: ignore
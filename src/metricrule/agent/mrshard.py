@@ -0,0 +1,312 @@
+"""Instruments accumulating values in a shard per recording thread.
+
+The children of prometheus_client metrics each hold a lock, taken by
+every thread recording to them, so threads serving requests for the same
+label values contend on it. Instead, these instruments accumulate values
+in a map owned by the recording thread, by label values, which no other
+thread writes to while the thread is running. Each instrument is also a
+collector: when metrics are scraped, the shards of all threads are merged
+into the exported samples. Shards of threads that have exited are folded
+into a single retired shard, so that their values are kept, when metrics
+are scraped or a new thread starts recording, so there are no more shards
+than running threads. Servers starting a thread per request still create
+a shard, under a lock shared by all threads, on each request: sharding is
+meant for servers running requests on a thread pool. Label values
+removed from a metric are dropped by each thread from its own shard when
+it next records, and skipped meanwhile when shards are merged.
+
+Only counters and histograms of explicit buckets are sharded; value
+metrics of other options are recorded with the regular instruments.
+Shards are not shared across processes, so this mode cannot be used in
+multi-process mode.
+"""
+from typing import Any, Optional, Sequence
+import abc
+import bisect
+import math
+import threading
+
+import prometheus_client
+from prometheus_client.metrics_core import CounterMetricFamily, HistogramMetricFamily, Metric
+from prometheus_client.utils import floatToGoString
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+from .mrconfig import HistogramConfig
+from .mrmetric import MetricInstrumentSpec
+from .mrotel import initialize_instrument, Instrument, MIN_VECTORIZED_BATCH
+
+
+class _Shard:  # pylint: disable=too-few-public-methods
+    """The values accumulated by a thread, by label values.
+
+    Attributes:
+      thread: The thread owning the shard, the only one writing to it.
+      points: The accumulated values, by label values.
+      applied: Number of label value removals applied to the points.
+    """
+    __slots__ = ('thread', 'points', 'applied')
+
+    def __init__(self, thread: threading.Thread, applied: int) -> None:
+        self.thread = thread
+        self.points: dict[tuple[str, ...], Any] = {}
+        self.applied = applied
+
+
+class _ShardedMetric(Instrument, abc.ABC):  # pylint: disable=too-many-instance-attributes
+    """An instrument accumulating values in a shard per thread, and the
+    collector merging them.
+    """
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str],
+                 registry: Optional[prometheus_client.CollectorRegistry]):
+        self._name = name
+        self._documentation = documentation
+        self._label_names = tuple(label_names)
+        self._local = threading.local()
+        # Shards of running threads.
+        self._shards: list[_Shard] = []
+        self._retired: dict[tuple[str, ...], Any] = {}
+        # Removed label values, as (index, value), from the first one not
+        # yet applied to every shard, and the number of removals.
+        self._removals: list[tuple[int, str]] = []
+        self._removal_count = 0
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def remove_label_value(self, index: int, value: str) -> None:
+        with self._lock:
+            _remove(self._retired, [(index, value)])
+            # Other threads may be writing to their shards.
+            self._removals.append((index, value))
+            self._removal_count += 1
+
+    def unregister(self, registry: prometheus_client.CollectorRegistry) -> None:
+        registry.unregister(self)
+
+    def describe(self) -> list[Metric]:
+        """Describes the metric, without samples, for registration.
+        """
+        return [self._family()]
+
+    def collect(self) -> list[Metric]:
+        """Collects the merged values of all threads, by label values.
+        """
+        with self._lock:
+            self._retire_shards()
+            running = [(shard.points, self._pending_removals(shard)) for shard in self._shards]
+            merged = {key: self._copy(point) for key, point in self._retired.items()}
+        for points, removals in running:
+            # A copy, as the thread may add label values meanwhile.
+            points = points.copy()
+            _remove(points, removals)
+            self._merge(merged, points)
+        family = self._family()
+        for key, point in merged.items():
+            self._add_metric(family, list(key), point)
+        return [family]
+
+    def _shard(self) -> dict[tuple[str, ...], Any]:
+        # The points of the calling thread, created on its first record.
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            with self._lock:
+                self._retire_shards()
+                shard = _Shard(threading.current_thread(), self._removal_count)
+                self._shards.append(shard)
+            self._local.shard = shard
+        if shard.applied != self._removal_count:
+            with self._lock:
+                removals = self._pending_removals(shard)
+                shard.applied = self._removal_count
+            _remove(shard.points, removals)
+        return shard.points
+
+    def _retire_shards(self) -> None:
+        # Folds the shards of exited threads into the retired shard, which
+        # bounds shards by running threads. Called with the lock held.
+        running = []
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                running.append(shard)
+            else:
+                # The thread no longer writes to its shard.
+                _remove(shard.points, self._pending_removals(shard))
+                self._merge(self._retired, shard.points)
+        self._shards = running
+        self._trim_removals()
+
+    def _pending_removals(self, shard: _Shard) -> list[tuple[int, str]]:
+        # The removals not yet applied to a shard. Called with the lock held.
+        return self._removals[len(self._removals) - (self._removal_count - shard.applied):]
+
+    def _trim_removals(self) -> None:
+        # Forgets removals applied to every shard. Called with the lock held.
+        applied = min((shard.applied for shard in self._shards), default=self._removal_count)
+        del self._removals[:len(self._removals) - (self._removal_count - applied)]
+
+    def _merge(self, into: dict[tuple[str, ...], Any],
+               points: dict[tuple[str, ...], Any]) -> None:
+        for key, point in points.items():
+            current = into.get(key)
+            into[key] = self._copy(point) if current is None else self._add(current, point)
+
+    @abc.abstractmethod
+    def _family(self) -> Metric:
+        """Makes the family of the metric, without samples.
+        """
+
+    @abc.abstractmethod
+    def _add_metric(self, family: Any, label_values: list[str], point: Any) -> None:
+        """Adds the samples of a point to the family of the metric.
+        """
+
+    @abc.abstractmethod
+    def _copy(self, point: Any) -> Any:
+        """Copies a point, to merge other points into.
+        """
+
+    @abc.abstractmethod
+    def _add(self, point: Any, other: Any) -> Any:
+        """Adds a point to another, returning the sum.
+        """
+
+
+class ShardedCounter(_ShardedMetric):
+    """A counter accumulating increments in a shard per thread.
+    """
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        if value < 0:
+            raise ValueError('Counters can only be incremented by non-negative amounts.')
+        points = self._shard()
+        key = tuple(labels.values())
+        points[key] = points.get(key, 0.0) + value
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        # Each value is an increment, even if the sum is non-negative.
+        if min(values, default=0) < 0:
+            raise ValueError('Counters can only be incremented by non-negative amounts.')
+        self.record(math.fsum(values), labels)
+
+    def _family(self) -> Metric:
+        return CounterMetricFamily(self._name, self._documentation, labels=self._label_names)
+
+    def _add_metric(self, family: Any, label_values: list[str], point: Any) -> None:
+        family.add_metric(label_values, point)
+
+    def _copy(self, point: Any) -> Any:
+        return point
+
+    def _add(self, point: Any, other: Any) -> Any:
+        return point + other
+
+
+class ShardedHistogram(_ShardedMetric):
+    """A histogram of explicit buckets accumulating values in a shard
+    per thread.
+    """
+
+    def __init__(self, name: str, documentation: str,  # pylint: disable=too-many-arguments
+                 label_names: Sequence[str], buckets: Sequence[float],
+                 registry: Optional[prometheus_client.CollectorRegistry]):
+        """Initializes the metric, and registers it to be collected.
+
+        Args:
+          name: Name of the metric.
+          documentation: Help text of the metric.
+          label_names: Names of the labels of the metric.
+          buckets: Upper bounds of the buckets, in increasing order. A
+            bucket of infinite bound is added if missing.
+          registry: The registry to register the metric with, if any.
+        """
+        bounds = [float(bound) for bound in buckets]
+        if len(bounds) == 0 or bounds[-1] != math.inf:
+            bounds.append(math.inf)
+        self._bounds = tuple(bounds)
+        super().__init__(name, documentation, label_names, registry)
+
+    def record(self, value: Any, labels: dict[str, str]) -> None:
+        value = float(value)
+        # A point is the count of each bucket, of NaN values, and the sum.
+        points = self._shard()
+        key = tuple(labels.values())
+        point = points.get(key)
+        if point is None:
+            point = [0] * (len(self._bounds) + 1) + [0.0]
+            points[key] = point
+        index = len(self._bounds) if math.isnan(value) else bisect.bisect_left(self._bounds, value)
+        point[index] += 1
+        point[-1] += value
+
+    def record_many(self, values: Sequence[Any], labels: dict[str, str]) -> None:
+        if np is None or len(values) < MIN_VECTORIZED_BATCH:
+            super().record_many(values, labels)
+            return
+        amounts = np.asarray(values, dtype=np.float64)
+        # NaN sorts past the last bound, in the count of NaN values.
+        counts = np.bincount(np.searchsorted(self._bounds, amounts, side='left'),
+                             minlength=len(self._bounds) + 1).tolist()
+        points = self._shard()
+        key = tuple(labels.values())
+        point = points.get(key)
+        if point is None:
+            points[key] = counts + [float(amounts.sum())]
+            return
+        for index, count in enumerate(counts):
+            point[index] += count
+        point[-1] += float(amounts.sum())
+
+    def _family(self) -> Metric:
+        return HistogramMetricFamily(self._name, self._documentation, labels=self._label_names)
+
+    def _add_metric(self, family: Any, label_values: list[str], point: Any) -> None:
+        buckets, count = [], 0
+        for bound, bucket_count in zip(self._bounds, point):
+            count += bucket_count
+            buckets.append((floatToGoString(bound), count))
+        family.add_metric(label_values, buckets, point[-1])
+
+    def _copy(self, point: Any) -> Any:
+        return list(point)
+
+    def _add(self, point: Any, other: Any) -> Any:
+        for index, value in enumerate(other):
+            point[index] += value
+        return point
+
+
+def _remove(points: dict[tuple[str, ...], Any], removals: list[tuple[int, str]]) -> None:
+    for index, value in removals:
+        for key in [key for key in points if key[index] == value]:
+            del points[key]
+
+
+def initialize_sharded_instrument(
+    spec: MetricInstrumentSpec,
+    registry: Optional[prometheus_client.CollectorRegistry] = prometheus_client.REGISTRY
+) -> Instrument:
+    """Initializes an instrument to the given spec, sharded if supported.
+
+    Args:
+      spec: Specification of the instrument to create.
+      registry: The registry to register the metric with, if any.
+
+    Returns:
+      The initialized instrument.
+    """
+    if spec.instrumentType == prometheus_client.Counter:
+        return ShardedCounter(spec.name, '', spec.labelNames, registry)
+    if spec.instrumentType == prometheus_client.Histogram:
+        options = spec.options if spec.options is not None else HistogramConfig()
+        if isinstance(options, HistogramConfig) and options.exponentialScale is None:
+            buckets: Sequence[float] = prometheus_client.Histogram.DEFAULT_BUCKETS
+            if options.buckets is not None:
+                buckets = options.buckets
+            return ShardedHistogram(spec.name, '', spec.labelNames, buckets, registry)
+    return initialize_instrument(spec)
@@ -0,0 +1,316 @@
+"""A mergeable quantile sketch, and a metric of sketches.
+
+The sketch is a DDSketch: values are counted in logarithmic bins, so that
+any quantile is estimated within a relative error of the true value,
+whatever the distribution of values. Bins are only allocated as values
+fall in them, and the number of bins is bounded by collapsing the bins of
+the smallest magnitudes, which only loses accuracy for the lowest
+quantiles of positive values (and highest of negative values). Sketches
+with the same accuracy can be merged without further loss.
+
+The metric has the interface of a prometheus_client summary, and is
+exported as one, with estimates of configured quantiles.
+"""
+from typing import Any, Iterable, Optional, Sequence
+import math
+import sys
+import threading
+
+import prometheus_client
+from prometheus_client.metrics_core import Metric
+from prometheus_client.utils import floatToGoString
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None  # type: ignore
+
+# Default relative error of estimated quantiles.
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Default largest number of bins for each sign of values.
+DEFAULT_MAX_BINS = 2048
+# Default quantiles exported.
+DEFAULT_QUANTILES = (0.01, 0.5, 0.99)
+# Smallest batch of values indexed with NumPy.
+_MIN_VECTORIZED_BATCH = 16
+
+
+class QuantileSketch:  # pylint: disable=too-many-instance-attributes
+    """A metric, optionally with labels, of quantile sketches.
+    """
+
+    def __init__(self, name: str, documentation: str,  # pylint: disable=too-many-arguments
+                 labelnames: Iterable[str] = (), *,
+                 quantiles: Sequence[float] = DEFAULT_QUANTILES,
+                 relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+                 max_bins: int = DEFAULT_MAX_BINS,
+                 registry: Optional[prometheus_client.CollectorRegistry] =
+                 prometheus_client.REGISTRY):
+        """Initializes the metric, and registers it to be collected.
+
+        Args:
+          name: Name of the metric.
+          documentation: Help text of the metric.
+          labelnames: Names of the labels of the metric.
+          quantiles: Quantiles to export, between 0 and 1.
+          relative_accuracy: Relative error of estimated quantiles,
+            between 0 and 1.
+          max_bins: Largest number of bins for each sign of values.
+          registry: The registry to register the metric with, if any.
+
+        Raises:
+          ValueError: If a quantile or the accuracy is out of range.
+        """
+        if any(not 0.0 <= quantile <= 1.0 for quantile in quantiles):
+            raise ValueError('Quantiles must be between 0 and 1')
+        self._name = name
+        self._documentation = documentation
+        self._labelnames = tuple(labelnames)
+        self._quantiles = tuple(sorted(quantiles))
+        self._relative_accuracy = relative_accuracy
+        self._max_bins = max_bins
+        self._lock = threading.Lock()
+        self._metrics: dict[tuple[str, ...], DDSketch] = {}
+        if len(self._labelnames) == 0:
+            self._metrics[()] = DDSketch(relative_accuracy, max_bins)
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *labelvalues: Any) -> 'DDSketch':
+        """Gets the sketch of the given label values.
+        """
+        if len(labelvalues) != len(self._labelnames):
+            raise ValueError('Incorrect label count')
+        key = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            child = self._metrics.get(key)
+            if child is None:
+                child = DDSketch(self._relative_accuracy, self._max_bins)
+                self._metrics[key] = child
+            return child
+
+    def remove(self, *labelvalues: Any) -> None:
+        """Removes the sketch of the given label values.
+        """
+        key = tuple(str(value) for value in labelvalues)
+        with self._lock:
+            self._metrics.pop(key, None)
+
+    def observe(self, amount: float) -> None:
+        """Observes a value in the sketch of a metric without labels.
+        """
+        self._unlabeled().observe(amount)
+
+    def observe_many(self, amounts: Sequence[float]) -> None:
+        """Observes values in the sketch of a metric without labels.
+        """
+        self._unlabeled().observe_many(amounts)
+
+    def describe(self) -> list[Metric]:
+        """Describes the metric, without samples, for registration.
+        """
+        return [Metric(self._name, self._documentation, 'summary')]
+
+    def collect(self) -> list[Metric]:
+        """Collects the quantiles, count and sum of all label values.
+        """
+        metric = Metric(self._name, self._documentation, 'summary')
+        with self._lock:
+            children = list(self._metrics.items())
+        for labelvalues, child in children:
+            labels = dict(zip(self._labelnames, labelvalues))
+            estimates, count, sum_value = child.summarize(self._quantiles)
+            for quantile, estimate in zip(self._quantiles, estimates):
+                metric.add_sample(self._name, dict(labels, quantile=floatToGoString(quantile)),
+                                  estimate)
+            metric.add_sample(self._name + '_count', labels, count)
+            metric.add_sample(self._name + '_sum', labels, sum_value)
+        return [metric]
+
+    def _unlabeled(self) -> 'DDSketch':
+        if len(self._labelnames) > 0:
+            raise ValueError('No label values specified for a labeled metric')
+        return self._metrics[()]
+
+
+class DDSketch:  # pylint: disable=too-many-instance-attributes
+    """A quantile sketch with relative error guarantees.
+
+    Attributes:
+      relative_accuracy: Relative error of estimated quantiles.
+    """
+
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY,
+                 max_bins: int = DEFAULT_MAX_BINS) -> None:
+        """Initializes an empty sketch.
+
+        Args:
+          relative_accuracy: Relative error of estimated quantiles,
+            between 0 and 1.
+          max_bins: Largest number of bins for each sign of values.
+
+        Raises:
+          ValueError: If the accuracy is out of range.
+        """
+        if not 0.0 < relative_accuracy < 1.0:
+            raise ValueError('Relative accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._multiplier = 1 / math.log(self._gamma)
+        # Smaller magnitudes are counted as zeros.
+        self._min_indexable = sys.float_info.min * self._gamma
+        self._positive = _Bins(max_bins)
+        self._negative = _Bins(max_bins)
+        self._zero_count = 0
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, amount: float) -> None:
+        """Observes a value. Non-finite values are only counted and summed.
+        """
+        amount = float(amount)
+        with self._lock:
+            self._count += 1
+            self._sum += amount
+            if not math.isfinite(amount):
+                return
+            if abs(amount) < self._min_indexable:
+                self._zero_count += 1
+            elif amount > 0:
+                self._positive.add(self._index(amount), 1)
+            else:
+                self._negative.add(self._index(-amount), 1)
+
+    def observe_many(self, amounts: Sequence[float]) -> None:
+        """Observes values, as if observed one at a time.
+        """
+        if np is None or len(amounts) < _MIN_VECTORIZED_BATCH:
+            for amount in amounts:
+                self.observe(amount)
+        else:
+            self._observe_array(np.asarray(amounts, dtype=np.float64))
+
+    def _observe_array(self, values: Any) -> None:
+        finite = values[np.isfinite(values)]
+        # Sum sequentially from the current sum, as single observations do.
+        sums = np.empty(len(values) + 1)
+        with self._lock:
+            sums[0] = self._sum
+            sums[1:] = values
+            with np.errstate(invalid='ignore'):
+                self._sum = float(np.add.accumulate(sums)[-1])
+            self._count += len(values)
+            self._zero_count += int(np.count_nonzero(np.abs(finite) < self._min_indexable))
+            for bins, magnitudes in (
+                    (self._positive, finite[finite >= self._min_indexable]),
+                    (self._negative, -finite[finite <= -self._min_indexable])):
+                if len(magnitudes) == 0:
+                    continue
+                indices, counts = np.unique(
+                    np.ceil(np.log(magnitudes) * self._multiplier).astype(np.int64),
+                    return_counts=True)
+                for index, count in zip(indices.tolist(), counts.tolist()):
+                    bins.add(index, count)
+
+    def merge(self, other: 'DDSketch') -> None:
+        """Adds the values of another sketch of the same accuracy.
+
+        Raises:
+          ValueError: If the sketches have different accuracies.
+        """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Only sketches of the same accuracy can be merged')
+        snapshot = other._snapshot()  # pylint: disable=protected-access
+        positive, negative, zero_count, count, sum_value = snapshot
+        with self._lock:
+            for index, bin_count in positive:
+                self._positive.add(index, bin_count)
+            for index, bin_count in negative:
+                self._negative.add(index, bin_count)
+            self._zero_count += zero_count
+            self._count += count
+            self._sum += sum_value
+
+    def quantile(self, quantile: float) -> float:
+        """Estimates a quantile of the observed values.
+
+        Args:
+          quantile: The quantile, between 0 and 1.
+
+        Returns:
+          The estimate, or NaN if no finite value was observed.
+        """
+        return self.summarize((quantile,))[0][0]
+
+    def summarize(self, quantiles: Sequence[float]) -> tuple[list[float], int, float]:
+        """Estimates quantiles, and gets the count and sum of values.
+
+        Args:
+          quantiles: The quantiles, in increasing order.
+
+        Returns:
+          The estimates of the quantiles, NaN if no finite value was
+          observed, the number of values and their sum.
+        """
+        with self._lock:
+            # In increasing order of value.
+            bins = [(-self._value(index), count)
+                    for index, count in sorted(self._negative.counts.items(), reverse=True)]
+            if self._zero_count > 0:
+                bins.append((0.0, self._zero_count))
+            bins.extend((self._value(index), count)
+                        for index, count in sorted(self._positive.counts.items()))
+            count, sum_value = self._count, self._sum
+        total = sum(bin_count for _, bin_count in bins)
+        estimates = []
+        position, cumulative = 0, 0
+        for quantile in quantiles:
+            if total == 0:
+                estimates.append(math.nan)
+                continue
+            rank = quantile * (total - 1)
+            while position < len(bins) - 1 and cumulative + bins[position][1] <= rank:
+                cumulative += bins[position][1]
+                position += 1
+            estimates.append(bins[position][0])
+        return estimates, count, sum_value
+
+    def _snapshot(self) -> tuple[list[tuple[int, int]], list[tuple[int, int]], int, int, float]:
+        with self._lock:
+            return (list(self._positive.counts.items()), list(self._negative.counts.items()),
+                    self._zero_count, self._count, self._sum)
+
+    def _index(self, magnitude: float) -> int:
+        return math.ceil(math.log(magnitude) * self._multiplier)
+
+    def _value(self, index: int) -> float:
+        # The value with equal relative error to both bounds of the bin.
+        return 2 * self._gamma ** index / (self._gamma + 1)
+
+
+class _Bins:
+    """Counts by bin index, collapsing the lowest indices when too many.
+    """
+
+    def __init__(self, max_bins: int) -> None:
+        self.counts: dict[int, int] = {}
+        self._max_bins = max(max_bins, 1)
+        self._floor: Optional[int] = None
+
+    def add(self, index: int, count: int) -> None:
+        """Adds a count to the bin of an index.
+        """
+        if self._floor is not None and index < self._floor:
+            index = self._floor
+        self.counts[index] = self.counts.get(index, 0) + count
+        if len(self.counts) > self._max_bins:
+            self._collapse()
+
+    def _collapse(self) -> None:
+        indices = sorted(self.counts)
+        excess = len(indices) - self._max_bins
+        floor = indices[excess]
+        for index in indices[:excess]:
+            self.counts[floor] += self.counts.pop(index)
+        self._floor = floor
@@ -0,0 +1,170 @@
+"""Background worker to record metrics off the request thread.
+
+Captured payloads are pushed to a bounded queue, which is drained by one
+or more daemon threads that run the (potentially expensive) recording.
+Counts of work handled by the workers of a process are exported as the
+metricrule_background_recordings counter, labeled by outcome.
+"""
+from enum import Enum
+from typing import Any, Callable, NamedTuple
+import logging
+import queue
+import threading
+
+import prometheus_client
+
+_logger = logging.getLogger(__name__)
+
+RECORDINGS_COUNTER_NAME = 'metricrule_background_recordings'
+_OUTCOMES = ('enqueued', 'dropped', 'processed', 'failed')
+
+# The counter shared by the workers of the process, once one is started.
+_RECORDINGS: dict[str, prometheus_client.Counter] = {}
+_RECORDINGS_LOCK = threading.Lock()
+
+
+class DropPolicy(Enum):
+    """Enumerations of what to do when the queue of work is full.
+    """
+    # Discard the work being submitted.
+    DROP_NEWEST = 1
+    # Discard the oldest queued work to make room for the new work.
+    DROP_OLDEST = 2
+    # Wait until there is room in the queue.
+    BLOCK = 3
+
+
+class WorkerStats(NamedTuple):
+    """Counts of work handled by a worker.
+
+    Attributes:
+      enqueued: Number of items accepted into the queue.
+      dropped: Number of items discarded due to a full queue.
+      processed: Number of items taken off the queue and recorded.
+      failed: Number of processed items whose recording raised.
+    """
+    enqueued: int
+    dropped: int
+    processed: int
+    failed: int = 0
+
+
+class RecordingWorker:
+    """A bounded queue of recording work, drained by worker threads.
+    """
+
+    def __init__(self,
+                 record_fn: Callable[..., None],
+                 max_queue_size: int = 1024,
+                 num_threads: int = 1,
+                 drop_policy: DropPolicy = DropPolicy.DROP_NEWEST) -> None:
+        """Initializes and starts the worker.
+
+        Args:
+          record_fn: Callable invoked on a worker thread with the
+            arguments of each submitted item.
+          max_queue_size: Maximum number of items waiting to be recorded.
+          num_threads: Number of threads draining the queue.
+          drop_policy: What to do when submitting to a full queue.
+        """
+        self._record_fn = record_fn
+        self._drop_policy = drop_policy
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._stats = WorkerStats(0, 0, 0)
+        counter = _get_recordings_counter()
+        self._outcomes = {outcome: counter.labels(outcome) for outcome in _OUTCOMES}
+        self._threads = [
+            threading.Thread(target=self._run,
+                             name=f'metricrule-recorder-{i}',
+                             daemon=True)
+            for i in range(max(num_threads, 1))
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def stats(self) -> WorkerStats:
+        """Counts of work handled by this worker so far.
+        """
+        with self._lock:
+            return self._stats
+
+    def submit(self, *args: Any) -> bool:
+        """Submits an item to be recorded in the background.
+
+        Args:
+          args: Arguments to invoke the record function with.
+
+        Returns:
+          Whether the item was accepted into the queue.
+        """
+        if self._drop_policy == DropPolicy.BLOCK:
+            self._queue.put(args)
+            self._count(enqueued=1)
+            return True
+        try:
+            self._queue.put_nowait(args)
+            self._count(enqueued=1)
+            return True
+        except queue.Full:
+            pass
+        if self._drop_policy == DropPolicy.DROP_OLDEST:
+            try:
+                self._queue.get_nowait()
+                self._queue.task_done()
+                self._count(dropped=1)
+            except queue.Empty:
+                pass
+            try:
+                self._queue.put_nowait(args)
+                self._count(enqueued=1)
+                return True
+            except queue.Full:
+                pass
+        self._count(dropped=1)
+        return False
+
+    def flush(self) -> None:
+        """Blocks until all items submitted so far have been recorded.
+        """
+        self._queue.join()
+
+    def _count(self, enqueued: int = 0, dropped: int = 0, processed: int = 0,
+               failed: int = 0) -> None:
+        with self._lock:
+            self._stats = WorkerStats(
+                self._stats.enqueued + enqueued,
+                self._stats.dropped + dropped,
+                self._stats.processed + processed,
+                self._stats.failed + failed)
+        for outcome, amount in zip(_OUTCOMES, (enqueued, dropped, processed, failed)):
+            if amount > 0:
+                self._outcomes[outcome].inc(amount)
+
+    def _run(self) -> None:
+        while True:
+            args = self._queue.get()
+            failed = 0
+            try:
+                self._record_fn(*args)
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception('Failed to record metrics')
+                failed = 1
+            finally:
+                self._count(processed=1, failed=failed)
+                self._queue.task_done()
+
+
+def _get_recordings_counter() -> prometheus_client.Counter:
+    # Created on first use, so that it is recorded to metric files if
+    # multi-process mode is enabled after import.
+    with _RECORDINGS_LOCK:
+        counter = _RECORDINGS.get(RECORDINGS_COUNTER_NAME)
+        if counter is None:
+            counter = prometheus_client.Counter(
+                RECORDINGS_COUNTER_NAME,
+                'Number of requests handled by background recorders, by outcome',
+                labelnames=('outcome',))
+            _RECORDINGS[RECORDINGS_COUNTER_NAME] = counter
+        return counter
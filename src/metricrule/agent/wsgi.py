@@ -8,6 +8,10 @@ This module provides two classes:
       # app is some WSGI application.
       app = WSGIMetricsMiddleware(app, config_path=/some/path/to/config/file)
 
+      # Optionally, record metrics on a background thread.
+      app = WSGIMetricsMiddleware(app, config_path=/some/path/to/config/file,
+                                  background=True)
+
 2) An application that provides a view of the recorded metrics.
 
    Usage:
@@ -15,46 +19,159 @@ This module provides two classes:
      app.wsgi_app = WSGIApplication.make()
      app.run('127.0.0.1', '9001', debug=True)
 """
-from collections import deque
-from typing import Deque
+import io
+from typing import Callable, Iterable, Mapping, Optional, Sequence
 
-from prometheus_client import make_wsgi_app
 from werkzeug.wsgi import get_input_stream
 
-from .mrconfig import load_config
-from .mrotel import initialize_all_instruments
-from .mrmetric import MetricContext
-from .mrrecorder import log_request_metrics, log_response_metrics
+from .mrconfig import CardinalityConfig, DriftConfig, ExpositionConfig, MetricOptions, OTLPConfig
+from .mrconfig import RouteConfig, SamplingConfig
+from .mrexpose import ExpositionCache
+from .mrjson import JSONDecoder
+from .mrprocess import get_scrape_registry
+from .mrreload import AgentState
+from .mrroute import RouteTable
+from .mrmetric import is_sampled, MetricContext
+from .mrrecorder import DEFAULT_MAX_CAPTURE_BYTES, get_sample_point, is_json_content_type
+from .mrrecorder import needs_request_body
+from .mrrecorder import log_exchange_metrics
+from .mrworker import DropPolicy, RecordingWorker, WorkerStats
+
+# Size of reads from the request input stream.
+_READ_CHUNK_BYTES = 64 * 1024
 
 
 class WSGIApplication:
     """A WSGI application to view collected metrics.
     """
     @staticmethod
-    def make():
+    def make(exposition: Optional[ExpositionConfig] = None):
         """Makes a new WSGI application.
+
+        In multi-process mode, the application serves the metrics of all
+        processes. Expositions are cached for a short time, and served
+        gzipped, in OpenMetrics or in protobuf as negotiated by scrapers.
+
+        Args:
+          exposition: Configuration of the cache and compression of
+            expositions.
         """
-        return make_wsgi_app()
+        cache = ExpositionCache(get_scrape_registry(), exposition or ExpositionConfig())
 
+        def metrics_app(environ, start_response):
+            response = cache.respond(
+                environ['REQUEST_METHOD'], environ.get('QUERY_STRING', ''),
+                environ.get('HTTP_ACCEPT', ''), environ.get('HTTP_ACCEPT_ENCODING', ''))
+            start_response(response.status_line, response.headers)
+            return [response.body]
+        return metrics_app
 
-class WSGIMetricsMiddleware:
+
+class WSGIMetricsMiddleware:  # pylint: disable=too-many-instance-attributes
     """WSGI application middleware for requests and responses.
 
+    The request body is read up front and handed to the application as a
+    re-readable stream. Response chunks are forwarded to the server as the
+    application yields them, and a copy is kept up to a capture limit.
+    Metrics are recorded when the server closes the response.
+
     Attributes:
         app: The WSGI application callable to forward requests to.
     """
 
-    def __init__(self, app, config_path=None) -> None:
+    def __init__(self, app, config_path=None, *, background=False,  # pylint: disable=too-many-arguments,too-many-locals
+                 max_queue_size=1024, num_workers=1,
+                 drop_policy=DropPolicy.DROP_NEWEST,
+                 sampling: Optional[SamplingConfig] = None,
+                 max_capture_bytes: Optional[int] = DEFAULT_MAX_CAPTURE_BYTES,
+                 json_decoder: Optional[JSONDecoder] = None,
+                 selective_decoding: bool = False,
+                 metric_options: Optional[Mapping[str, MetricOptions]] = None,
+                 drift: Optional[DriftConfig] = None,
+                 cardinality: Optional[CardinalityConfig] = None,
+                 reload_interval: Optional[float] = None,
+                 routes: Optional[Sequence[RouteConfig]] = None,
+                 otlp: Optional[OTLPConfig] = None,
+                 sharded: bool = False) -> None:
         """Initializes middleware for the given app.
 
         Args:
           app: The WSGI application to be called.
           config_path: The path to read agent config from.
+          background: Whether to record metrics on background threads
+            instead of the request thread.
+          max_queue_size: Maximum number of requests waiting to be recorded,
+            when recording in the background.
+          num_workers: Number of threads recording in the background.
+          drop_policy: What to do with requests when the background queue
+            is full.
+          sampling: Configuration to record metrics for only a fraction
+            of requests.
+          max_capture_bytes: Largest request or response body to keep for
+            recording, or None for no limit. Requests with a larger body
+            are not recorded.
+          json_decoder: The JSON decoder to use for payloads, by default
+            orjson when installed, else the standard library.
+          selective_decoding: Whether to only decode the parts of payloads
+            read by the config, skipping e.g large unused arrays.
+          metric_options: Options of the instruments of value metrics,
+            e.g histogram buckets or quantile sketches, by metric name.
+          drift: Configuration to export drift scores of value metrics
+            against baseline distributions.
+          cardinality: Configuration to limit the number of values of
+            each label of a metric.
+          reload_interval: If set, config files are polled for changes at
+            this interval in seconds, and reloaded without interrupting
+            requests when they change.
+          routes: If set, only requests of these routes are recorded, each
+            with the config of its route instead of config_path. Requests
+            of other routes are passed through without capturing them.
+          otlp: If set, metrics are aggregated in memory and exported to
+            an OTLP collector, instead of recorded to prometheus_client.
+          sharded: If set, each thread accumulates values in its own
+            shard, merged when metrics are scraped, so that threads
+            recording the same series do not contend on its lock. Meant
+            for servers running requests on a pool of threads.
+
+        Raises:
+          ValueError: If both config_path and routes are given, or if
+            sharded in multi-process mode.
         """
         self.app = app
-        self._config = load_config(config_path)
-        self._instruments = initialize_all_instruments(self._config)
-        self._context_labels: Deque[tuple[tuple[str, str], ...]] = deque()
+        self._json_decoder = json_decoder
+        self._selective_decoding = selective_decoding
+        self._sampling = sampling
+        self._max_capture_bytes = max_capture_bytes
+        self._routes = RouteTable(
+            config_path, routes, sampling=sampling, metric_options=metric_options, drift=drift,
+            cardinality=cardinality, reload_interval=reload_interval, otlp=otlp, sharded=sharded)
+        self._worker: Optional[RecordingWorker] = None
+        if background:
+            self._worker = RecordingWorker(
+                self._record,
+                max_queue_size=max_queue_size,
+                num_threads=num_workers,
+                drop_policy=drop_policy)
+
+    def reload_config(self) -> None:
+        """Reloads config files, keeping instruments of unchanged metrics.
+
+        Raises:
+          Exception: If a config cannot be loaded, in which case the
+            current config is kept.
+        """
+        self._routes.reload()
+
+    @property
+    def recording_stats(self) -> Optional[WorkerStats]:
+        """Counts of requests handled by the background recorder, if any.
+
+        Counts of all recorders of the process are also exported as the
+        metricrule_background_recordings counter.
+        """
+        if self._worker is None:
+            return None
+        return self._worker.stats
 
     def __call__(self, environ, start_response):
         """The WSGI application
@@ -63,25 +180,149 @@ class WSGIMetricsMiddleware:
             environ: A WSGI environment.
             start_response: The WSGI start_response callable.
         """
+        agent = self._routes.match(environ.get('REQUEST_METHOD', ''),
+                                   environ.get('PATH_INFO', ''))
+        if agent is None:
+            return self.app(environ, start_response)
+        # The request is recorded with the state it started with.
+        state = agent.state
+        request_body = None
+        if needs_request_body(state.config, self._sampling):
+            request_body = self._capture_request(environ)
+            if request_body is None:
+                return self.app(environ, start_response)
+        request_content_type = environ.get('CONTENT_TYPE')
+        sample_point = get_sample_point(self._sampling, request_body)
+        if not (is_sampled(state.config, MetricContext.INPUT, sample_point) or
+                is_sampled(state.config, MetricContext.OUTPUT, sample_point)):
+            return self.app(environ, start_response)
+
+        def on_close(response_body: Optional[bytes]) -> None:
+            if self._worker is not None:
+                self._worker.submit(state, request_body, request_content_type,
+                                    response_body, sample_point)
+            else:
+                self._record(state, request_body, request_content_type,
+                             response_body, sample_point)
+
+        response = _CapturingResponse(self._max_capture_bytes, on_close)
+        response.iterable = self.app(
+            environ, response.wrap_start_response(start_response))
+        return response
+
+    def _capture_request(self, environ) -> Optional[bytes]:
         request_stream = get_input_stream(environ, safe_fallback=True)
-        request_body = request_stream.read()
-        self._get_request_metrics(request_body)
-        response_stream = self.app(environ, start_response)
-        response_body = b''.join(response_stream)
-        self._get_response_metrics(response_body)
-        return [response_body]
-
-    def _get_request_metrics(self, request_body) -> None:
-        self._context_labels.clear()
-        log_request_metrics(
-            self._config,
-            self._instruments[MetricContext.INPUT],
-            request_body,
-            self._context_labels)
-
-    def _get_response_metrics(self, response_body) -> None:
-        log_response_metrics(
-            self._config,
-            self._instruments[MetricContext.OUTPUT],
-            response_body,
-            self._context_labels)
+        limit = self._max_capture_bytes
+        request_body = _read_up_to(
+            request_stream, None if limit is None else limit + 1)
+        if limit is not None and len(request_body) > limit:
+            environ['wsgi.input'] = _PrefixedStream(request_body, request_stream)
+            return None
+        environ['wsgi.input'] = io.BytesIO(request_body)
+        return request_body
+
+    def _record(self, state: AgentState, request_body: Optional[bytes],  # pylint: disable=too-many-arguments
+                request_content_type, response_body, sample_point) -> None:
+        log_exchange_metrics(
+            state.config, state.instruments, request_body, response_body, sample_point,
+            request_content_type=request_content_type, decoder=self._json_decoder,
+            selective=self._selective_decoding)
+
+
+class _CapturingResponse:
+    """A response iterable that keeps a copy of chunks as they are yielded.
+
+    Attributes:
+      iterable: The response iterable of the wrapped application.
+    """
+
+    def __init__(self, max_capture_bytes: Optional[int],
+                 on_close: Callable[[Optional[bytes]], None]) -> None:
+        self.iterable: Iterable[bytes] = ()
+        self._max_capture_bytes = max_capture_bytes
+        self._on_close: Optional[Callable[[Optional[bytes]], None]] = on_close
+        self._chunks: list[bytes] = []
+        self._captured_bytes = 0
+        self._capturing = True
+        self._complete = False
+
+    def wrap_start_response(self, start_response):
+        """Wraps start_response to only capture JSON responses.
+        """
+        def capturing_start_response(status, headers, exc_info=None):
+            content_type = None
+            for key, value in headers:
+                if key.lower() == 'content-type':
+                    content_type = value
+            self._capturing = is_json_content_type(content_type)
+            return start_response(status, headers, exc_info)
+        return capturing_start_response
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            if self._capturing:
+                self._capture(chunk)
+            yield chunk
+        self._complete = True
+
+    def close(self) -> None:
+        """Closes the wrapped iterable, and records the exchange.
+        """
+        try:
+            close_fn = getattr(self.iterable, 'close', None)
+            if close_fn is not None:
+                close_fn()
+        finally:
+            on_close, self._on_close = self._on_close, None
+            if on_close is not None:
+                response_body = None
+                if self._capturing and self._complete:
+                    response_body = b''.join(self._chunks)
+                self._chunks = []
+                on_close(response_body)
+
+    def _capture(self, chunk: bytes) -> None:
+        self._captured_bytes += len(chunk)
+        if (self._max_capture_bytes is not None and
+                self._captured_bytes > self._max_capture_bytes):
+            self._capturing = False
+            self._chunks = []
+            return
+        if len(chunk) > 0:
+            self._chunks.append(chunk)
+
+
+class _PrefixedStream(io.RawIOBase):
+    """A readable stream of some already read bytes, then a stream.
+    """
+
+    def __init__(self, prefix: bytes, stream) -> None:
+        super().__init__()
+        self._prefix = io.BytesIO(prefix)
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._prefix.read(len(buffer))
+        if len(data) == 0:
+            data = self._stream.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def _read_up_to(stream, size: Optional[int]) -> bytes:
+    if size is None:
+        return stream.read()
+    chunks = []
+    remaining = size
+    while remaining > 0:
+        # Streams may allocate a buffer of the requested size up front,
+        # so read in bounded chunks rather than up to the capture limit.
+        chunk = stream.read(min(remaining, _READ_CHUNK_BYTES))
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b''.join(chunks)
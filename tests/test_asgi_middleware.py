@@ -0,0 +1,324 @@
+import asyncio
+import json
+import os
+import tempfile
+from unittest import TestCase, main
+
+import httpx
+import prometheus_client
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from metricrule.agent import ASGIMetricsMiddleware
+from metricrule.agent.mrconfig import RouteConfig, SamplingConfig
+
+
+def _write_config(config_data):
+    with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+        config_file.write(config_data)
+    return config_file.name
+
+
+async def _json_endpoint(request):
+    return Response(b'{"prediction": 0.5}', media_type='application/json')
+
+
+async def _streaming_endpoint(request):
+    async def chunks():
+        yield b'{"prediction": '
+        yield b'0.25}'
+    return StreamingResponse(chunks(), media_type='application/json')
+
+
+async def _text_endpoint(request):
+    await request.body()
+    return PlainTextResponse('{"prediction": 0.5}')
+
+
+async def _echo_endpoint(request):
+    return Response(await request.body(), media_type='application/json')
+
+
+async def _error_endpoint(request):
+    await request.body()
+    return Response(b'{"prediction": 0.5}', status_code=500, media_type='application/json')
+
+
+class TestAsgiMiddleware(TestCase):
+    def setUp(self):
+        self.config_path = None
+
+    def tearDown(self):
+        if self.config_path is not None:
+            os.remove(self.config_path)
+
+    def _make_client(self, name, **kwargs):
+        self.config_path = _write_config(f'''
+        input_metrics {{
+            name: "{name}_input"
+            simple_counter {{}}
+        }}
+        output_metrics {{
+            name: "{name}_output"
+            value {{
+                value {{
+                    parsed_value {{
+                        field_path: ".prediction"
+                        parsed_type: FLOAT
+                    }}
+                }}
+            }}
+        }}
+        ''')
+        app = Starlette(routes=[
+            Route('/json', _json_endpoint, methods=['POST']),
+            Route('/stream', _streaming_endpoint, methods=['POST']),
+            Route('/text', _text_endpoint, methods=['POST']),
+            Route('/echo', _echo_endpoint, methods=['POST']),
+            Route('/error', _error_endpoint, methods=['POST']),
+        ])
+        app.add_middleware(ASGIMetricsMiddleware,
+                           config_path=self.config_path, **kwargs)
+        return TestClient(app)
+
+    def test_records_request_and_response(self):
+        client = self._make_client('asgi_sync')
+
+        response = client.post('/json', content=json.dumps({}))
+
+        self.assertEqual(response.content, b'{"prediction": 0.5}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_sync_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('asgi_sync_output_sum'), 0.5)
+
+    def test_records_streamed_response(self):
+        client = self._make_client('asgi_stream')
+
+        response = client.post('/stream', content=json.dumps({}))
+
+        self.assertEqual(response.content, b'{"prediction": 0.25}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_stream_output_sum'), 0.25)
+
+    def test_skips_non_json_response(self):
+        client = self._make_client('asgi_text')
+
+        response = client.post('/text', content=json.dumps({}))
+
+        self.assertEqual(response.content, b'{"prediction": 0.5}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_text_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('asgi_text_output_count'), 0)
+
+    def test_skips_response_over_capture_limit(self):
+        client = self._make_client('asgi_capped', max_capture_bytes=16)
+
+        response = client.post('/stream', content=json.dumps({}))
+
+        self.assertEqual(response.content, b'{"prediction": 0.25}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_capped_output_count'), 0)
+
+    def test_app_reads_request_body(self):
+        client = self._make_client('asgi_echo')
+
+        response = client.post('/echo', content=json.dumps({'prediction': 0.75}))
+
+        self.assertEqual(json.loads(response.content), {'prediction': 0.75})
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_echo_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('asgi_echo_output_sum'), 0.75)
+
+    def test_request_over_capture_limit_is_passed_through(self):
+        client = self._make_client('asgi_large', max_capture_bytes=16)
+
+        body = json.dumps({'prediction': 0.75, 'padding': 'x' * 32})
+        response = client.post('/echo', content=body)
+
+        self.assertEqual(response.content, body.encode())
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_large_input_total'), 0)
+        self.assertEqual(registry.get_sample_value('asgi_large_output_count'), 0)
+
+    def test_skips_error_response(self):
+        client = self._make_client('asgi_error')
+
+        response = client.post('/error', content=json.dumps({}))
+
+        self.assertEqual(response.status_code, 500)
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_error_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('asgi_error_output_count'), 0)
+
+    def test_body_read_after_response_start(self):
+        self.config_path = _write_config('''
+        input_metrics {
+            name: "asgi_late_input"
+            simple_counter {}
+        }
+        ''')
+        chunks = [{'type': 'http.request', 'body': b'{}', 'more_body': True},
+                  {'type': 'http.request', 'body': b'', 'more_body': False}]
+        sent = []
+
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            received = [await receive(), await receive()]
+            await send({'type': 'http.response.body', 'body': b''.join(
+                message['body'] for message in received)})
+
+        async def receive():
+            return chunks.pop(0)
+
+        async def send(message):
+            sent.append(message)
+        middleware = ASGIMetricsMiddleware(app, self.config_path)
+        asyncio.run(middleware(
+            {'type': 'http', 'method': 'POST', 'path': '/', 'headers': []}, receive, send))
+
+        self.assertEqual(sent[-1]['body'], b'{}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_late_input_total'), 1)
+
+    def test_unrecorded_response_is_sent_before_body_is_read(self):
+        self.config_path = _write_config('''
+        input_metrics {
+            name: "asgi_rejected_input"
+            simple_counter {}
+        }
+        ''')
+        events = []
+
+        async def app(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 413, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def receive():
+            events.append('receive')
+            return {'type': 'http.request', 'body': b'{}', 'more_body': False}
+
+        async def send(message):
+            events.append(message['type'])
+        middleware = ASGIMetricsMiddleware(app, self.config_path)
+        asyncio.run(middleware(
+            {'type': 'http', 'method': 'POST', 'path': '/', 'headers': []}, receive, send))
+
+        self.assertEqual(events, ['http.response.start', 'http.response.body'])
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_rejected_input_total'), 0)
+
+    def test_sampled_out_request_is_not_captured(self):
+        self.config_path = _write_config('''
+        input_metrics {
+            name: "asgi_unsampled_input"
+            simple_counter {}
+        }
+        ''')
+        received = []
+
+        async def app(scope, receive, send):
+            received.append((receive, send))
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'{}', 'more_body': False}
+
+        async def send(message):
+            pass
+        middleware = ASGIMetricsMiddleware(app, self.config_path,
+                                           sampling=SamplingConfig(rate=0.0))
+        asyncio.run(middleware(
+            {'type': 'http', 'method': 'POST', 'path': '/', 'headers': []}, receive, send))
+
+        self.assertEqual(received, [(receive, send)])
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_unsampled_input_total'), 0)
+
+    def test_routes(self):
+        self.config_path = _write_config('''
+        input_metrics {
+            name: "asgi_routed_input"
+            simple_counter {}
+        }
+        ''')
+        app = Starlette(routes=[
+            Route('/v1/echo', _echo_endpoint, methods=['POST']),
+            Route('/v2/echo', _echo_endpoint, methods=['POST']),
+        ])
+        app.add_middleware(ASGIMetricsMiddleware, routes=[
+            RouteConfig('/v1/', self.config_path)])
+        client = TestClient(app)
+
+        for path in ('/v1/echo', '/v2/echo'):
+            response = client.post(path, content=json.dumps({}))
+            self.assertEqual(response.content, b'{}')
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('asgi_routed_input_total'), 1)
+
+    def test_passes_through_other_scopes(self):
+        calls = []
+
+        async def app(scope, receive, send):
+            calls.append(scope['type'])
+        middleware = ASGIMetricsMiddleware(app)
+        asyncio.run(middleware({'type': 'lifespan'}, None, None))
+
+        self.assertEqual(calls, ['lifespan'])
+
+    def test_context_labels_are_per_request(self):
+        self.config_path = _write_config('''
+        output_metrics {
+            name: "asgi_concurrent_output"
+            value {
+                value {
+                    parsed_value {
+                        field_path: ".prediction"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        context_labels_from_input {
+            label_key { string_value: "PetType" }
+            label_value {
+                parsed_value {
+                    field_path: ".Type"
+                    parsed_type: STRING
+                }
+            }
+        }
+        ''')
+        second_request_logged = asyncio.Event()
+
+        async def ordered_endpoint(request):
+            payload = await request.json()
+            if payload['Type'] == 'Cat':
+                await second_request_logged.wait()
+            else:
+                second_request_logged.set()
+            return Response(json.dumps({'prediction': payload['value']}),
+                            media_type='application/json')
+        app = Starlette(routes=[
+            Route('/ordered', ordered_endpoint, methods=['POST'])])
+        app.add_middleware(ASGIMetricsMiddleware, config_path=self.config_path)
+
+        async def send_concurrently():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport,
+                                         base_url='http://test') as client:
+                await asyncio.gather(
+                    client.post('/ordered', json={'Type': 'Cat', 'value': 1.0}),
+                    client.post('/ordered', json={'Type': 'Dog', 'value': 2.0}))
+        asyncio.run(send_concurrently())
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value(
+            'asgi_concurrent_output_sum', {'PetType': 'Cat'}), 1.0)
+        self.assertEqual(registry.get_sample_value(
+            'asgi_concurrent_output_sum', {'PetType': 'Dog'}), 2.0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+from unittest import TestCase, main
+
+_HEAVY_MODULES = ('starlette', 'werkzeug', 'jsonpath_ng', 'google.protobuf')
+
+
+def _imported_modules(statement):
+    # Run in a new interpreter, as this one has already imported them all.
+    script = f'''
+import sys
+{statement}
+print(' '.join(name for name in {_HEAVY_MODULES!r} if name in sys.modules))
+'''
+    output = subprocess.run([sys.executable, '-c', script], check=True,
+                            capture_output=True, text=True).stdout
+    return set(output.split())
+
+
+class TestLazyImports(TestCase):
+    def test_package_imports_no_integration(self):
+        self.assertEqual(_imported_modules('import metricrule.agent'), set())
+
+    def test_wsgi_does_not_import_asgi(self):
+        self.assertEqual(
+            _imported_modules('from metricrule.agent import WSGIMetricsMiddleware'),
+            {'werkzeug'})
+
+    def test_asgi_does_not_import_wsgi(self):
+        # The middleware is a plain ASGI application, without starlette.
+        self.assertEqual(
+            _imported_modules('from metricrule.agent import ASGIMetricsMiddleware'),
+            set())
+
+    def test_loading_config_imports_protobuf(self):
+        modules = _imported_modules(
+            'from metricrule.agent.mrconfig import load_config; load_config("")')
+        self.assertIn('google.protobuf', modules)
+
+    def test_unknown_attribute(self):
+        import metricrule.agent  # pylint: disable=import-outside-toplevel
+        with self.assertRaises(AttributeError):
+            getattr(metricrule.agent, 'UnknownMiddleware')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import contextlib
+import io
+import os
+import tempfile
+from unittest import TestCase, main
+
+from metricrule.agent.mrcompile import main as compile_main
+from metricrule.agent.mrconfig import get_cache_path, load_config
+
+_CONFIG = '''
+input_metrics {
+    name: "config_counter"
+    simple_counter {}
+}
+'''
+
+
+class TestMrConfig(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.config_path = self._path('config.textproto')
+        with open(self.config_path, 'w', encoding='utf-8') as config_file:
+            config_file.write(_CONFIG)
+
+    def _path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def test_loads_binary_config(self):
+        binary_path = self._path('config.binpb')
+        with open(binary_path, 'wb') as binary_file:
+            binary_file.write(load_config(self.config_path).SerializeToString())
+
+        self.assertEqual(load_config(binary_path), load_config(self.config_path))
+
+    def test_caches_parsed_config(self):
+        cache_dir = self._path('cache')
+        os.mkdir(cache_dir)
+        with open(self.config_path, 'rb') as config_file:
+            cache_path = get_cache_path(cache_dir, config_file.read())
+
+        config = load_config(self.config_path, cache_dir)
+
+        self.assertEqual(config.input_metrics[0].name, 'config_counter')
+        self.assertTrue(os.path.exists(cache_path))
+        # Read from the cache, not the textproto.
+        cached = load_config(self.config_path, cache_dir)
+        cached.input_metrics[0].name = 'cached_counter'
+        with open(cache_path, 'wb') as cache_file:
+            cache_file.write(cached.SerializeToString())
+        self.assertEqual(load_config(self.config_path, cache_dir).input_metrics[0].name,
+                         'cached_counter')
+
+    def test_cached_config_is_readable_by_others(self):
+        cache_dir = self._path('cache')
+        os.mkdir(cache_dir)
+        with open(self.config_path, 'rb') as config_file:
+            cache_path = get_cache_path(cache_dir, config_file.read())
+        umask = os.umask(0o022)
+        try:
+            load_config(self.config_path, cache_dir)
+        finally:
+            os.umask(umask)
+
+        self.assertEqual(os.stat(cache_path).st_mode & 0o777, 0o644)
+
+    def test_corrupt_cache_is_overwritten(self):
+        cache_dir = self._path('cache')
+        os.mkdir(cache_dir)
+        with open(self.config_path, 'rb') as config_file:
+            cache_path = get_cache_path(cache_dir, config_file.read())
+        with open(cache_path, 'wb') as cache_file:
+            cache_file.write(b'\xff\xff\xff')
+
+        config = load_config(self.config_path, cache_dir)
+
+        self.assertEqual(config.input_metrics[0].name, 'config_counter')
+        with open(cache_path, 'rb') as cache_file:
+            self.assertEqual(cache_file.read(), config.SerializeToString())
+
+    def test_unwritable_cache_is_ignored(self):
+        config = load_config(self.config_path, self._path('missing'))
+
+        self.assertEqual(config.input_metrics[0].name, 'config_counter')
+
+    def test_compile_command(self):
+        output_path = self._path('config.pb')
+        cache_dir = self._path('cache')
+        with contextlib.redirect_stdout(io.StringIO()):
+            status = compile_main([self.config_path, '-o', output_path, '--cache-dir', cache_dir])
+
+        self.assertEqual(status, 0)
+        self.assertEqual(load_config(output_path), load_config(self.config_path))
+        self.assertEqual(os.listdir(cache_dir), [os.path.basename(
+            get_cache_path(cache_dir, _CONFIG.encode('utf-8')))])
+
+    def test_compile_command_rejects_invalid_config(self):
+        with open(self.config_path, 'w', encoding='utf-8') as config_file:
+            config_file.write('input_metrics { unknown_field: 1 }')
+
+        with contextlib.redirect_stderr(io.StringIO()) as stderr:
+            status = compile_main([self.config_path])
+
+        self.assertEqual(status, 1)
+        self.assertIn('Invalid config', stderr.getvalue())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import json
+import math
+import os
+import tempfile
+from unittest import TestCase, main
+
+from google.protobuf import text_format
+import prometheus_client
+
+from metricrule.config_gen import metric_configuration_pb2
+from metricrule.agent.mrconfig import DriftConfig
+from metricrule.agent.mrdrift import baseline_from_values, divergences, load_baselines
+from metricrule.agent.mrdrift import make_baseline, DriftMonitor
+from metricrule.agent.mrmetric import compile_plan, MetricContext
+from metricrule.agent.mrotel import initialize_all_instruments
+
+
+def _write_baselines(baselines):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as baseline_file:
+        json.dump({'metrics': baselines}, baseline_file)
+    return baseline_file.name
+
+
+class TestMrDrift(TestCase):
+    def setUp(self):
+        self.baseline_path = None
+
+    def tearDown(self):
+        if self.baseline_path is not None:
+            os.remove(self.baseline_path)
+
+    def test_divergences(self):
+        same = divergences([10, 20, 30], [1, 2, 3], epsilon=0)
+        self.assertAlmostEqual(same.psi, 0)
+        self.assertAlmostEqual(same.kl, 0)
+        self.assertAlmostEqual(same.js, 0)
+
+        shifted = divergences([50, 50], [90, 10], epsilon=0)
+        self.assertAlmostEqual(shifted.psi, 0.4 * math.log(1.8) - 0.4 * math.log(0.2))
+        self.assertAlmostEqual(shifted.kl, 0.9 * math.log(1.8) + 0.1 * math.log(0.2))
+        self.assertLess(shifted.js, math.log(2))
+
+        disjoint = divergences([1, 0], [0, 1])
+        self.assertTrue(math.isfinite(disjoint.kl))
+        self.assertAlmostEqual(disjoint.js, math.log(2), places=2)
+        self.assertTrue(math.isnan(divergences([1, 1], [0, 0]).psi))
+
+    def test_load_baselines(self):
+        self.baseline_path = _write_baselines({
+            'binned': {'bounds': [0.5, 1.0], 'counts': [10, 30, 5]},
+            'sampled': {'values': list(range(100)), 'bins': 4},
+        })
+
+        baselines = load_baselines(self.baseline_path)
+
+        self.assertEqual(baselines['binned'], make_baseline([0.5, 1.0], [10, 30, 5]))
+        self.assertEqual(baselines['sampled'], baseline_from_values(range(100), 4))
+        self.assertEqual(baselines['sampled'].bounds, (24.0, 49.0, 74.0))
+        self.assertEqual(baselines['sampled'].counts, (25.0, 25.0, 25.0, 25.0))
+        with self.assertRaises(ValueError):
+            make_baseline([1.0, 0.5], [1, 1, 1])
+        with self.assertRaises(ValueError):
+            make_baseline([1.0], [1])
+
+    def test_monitor_scores_sliding_window(self):
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse('''
+        input_metrics {
+            name: "drift_feature"
+            value: {
+                value: {
+                    parsed_value: {
+                        field_path: ".x"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        input_metrics {
+            name: "drift_count"
+            simple_counter: {}
+        }
+        ''', config_proto)
+        plan = compile_plan(config_proto)
+        self.baseline_path = _write_baselines({
+            'drift_feature': {'bounds': [1.0], 'counts': [50, 50]},
+            'drift_count': {'bounds': [1.0], 'counts': [50, 50]},
+        })
+        registry = prometheus_client.CollectorRegistry()
+        monitor = DriftMonitor(DriftConfig(self.baseline_path, slices=2, epsilon=0),
+                               registry=registry, start=False)
+        feature, count = [
+            monitor.wrap_instrument(spec, instrument)
+            for spec, instrument in initialize_all_instruments(plan)[MetricContext.INPUT].items()]
+
+        feature.record(0.5, {})
+        feature.record_many([2.0] * 20 + [0.5] * 19, {})
+        count.record(1, {})
+        scores = monitor.update()
+
+        self.assertEqual(list(scores), ['drift_feature'])
+        self.assertAlmostEqual(scores['drift_feature'].psi, 0)
+        self.assertEqual(registry.get_sample_value(
+            'metricrule_feature_drift', {'metric': 'drift_feature', 'measure': 'psi'}),
+            scores['drift_feature'].psi)
+
+        feature.record_many([2.0] * 60, {})
+        skewed = monitor.update()['drift_feature']
+        self.assertAlmostEqual(skewed.psi, divergences([50, 50], [20, 80], 0).psi)
+        # Slices expire from the window.
+        only_skewed = monitor.update()['drift_feature']
+        self.assertAlmostEqual(only_skewed.kl, divergences([50, 50], [0, 60], 0).kl)
+        empty = monitor.update()['drift_feature']
+        self.assertTrue(math.isnan(empty.js))
+        self.assertTrue(math.isnan(registry.get_sample_value(
+            'metricrule_feature_drift', {'metric': 'drift_feature', 'measure': 'js'})))
+
+        # Drift of unregistered metrics is no longer computed.
+        feature.unregister(prometheus_client.REGISTRY)
+        count.unregister(prometheus_client.REGISTRY)
+        self.assertEqual(monitor.update(), {})
+        self.assertIsNone(registry.get_sample_value(
+            'metricrule_feature_drift', {'metric': 'drift_feature', 'measure': 'psi'}))
+        monitor.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+import asyncio
+import gzip
+from unittest import TestCase, main
+
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory, text_format
+from google.protobuf.internal.decoder import _DecodeVarint
+import prometheus_client
+from werkzeug.test import Client
+
+from metricrule.agent import ASGIApplication, WSGIApplication
+from metricrule.agent.mrconfig import ExpositionConfig
+from metricrule.agent.mrexpose import ExpositionCache, generate_protobuf, PROTOBUF_CONTENT_TYPE
+
+# The messages of io.prometheus.client used by the protobuf format.
+_METRICS_PROTO = '''
+name: "metrics.proto"
+package: "io.prometheus.client"
+message_type {
+  name: "LabelPair"
+  field { name: "name" number: 1 label: LABEL_OPTIONAL type: TYPE_STRING }
+  field { name: "value" number: 2 label: LABEL_OPTIONAL type: TYPE_STRING }
+}
+message_type {
+  name: "Value"
+  field { name: "value" number: 1 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+}
+message_type {
+  name: "Quantile"
+  field { name: "quantile" number: 1 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+  field { name: "value" number: 2 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+}
+message_type {
+  name: "Summary"
+  field { name: "sample_count" number: 1 label: LABEL_OPTIONAL type: TYPE_UINT64 }
+  field { name: "sample_sum" number: 2 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+  field { name: "quantile" number: 3 label: LABEL_REPEATED type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Quantile" }
+}
+message_type {
+  name: "Bucket"
+  field { name: "cumulative_count" number: 1 label: LABEL_OPTIONAL type: TYPE_UINT64 }
+  field { name: "upper_bound" number: 2 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+}
+message_type {
+  name: "Histogram"
+  field { name: "sample_count" number: 1 label: LABEL_OPTIONAL type: TYPE_UINT64 }
+  field { name: "sample_sum" number: 2 label: LABEL_OPTIONAL type: TYPE_DOUBLE }
+  field { name: "bucket" number: 3 label: LABEL_REPEATED type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Bucket" }
+}
+message_type {
+  name: "Metric"
+  field { name: "label" number: 1 label: LABEL_REPEATED type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.LabelPair" }
+  field { name: "gauge" number: 2 label: LABEL_OPTIONAL type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Value" }
+  field { name: "counter" number: 3 label: LABEL_OPTIONAL type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Value" }
+  field { name: "summary" number: 4 label: LABEL_OPTIONAL type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Summary" }
+  field { name: "untyped" number: 5 label: LABEL_OPTIONAL type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Value" }
+  field { name: "timestamp_ms" number: 6 label: LABEL_OPTIONAL type: TYPE_INT64 }
+  field { name: "histogram" number: 7 label: LABEL_OPTIONAL type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Histogram" }
+}
+message_type {
+  name: "MetricFamily"
+  field { name: "name" number: 1 label: LABEL_OPTIONAL type: TYPE_STRING }
+  field { name: "help" number: 2 label: LABEL_OPTIONAL type: TYPE_STRING }
+  field { name: "type" number: 3 label: LABEL_OPTIONAL type: TYPE_INT32 }
+  field { name: "metric" number: 4 label: LABEL_REPEATED type: TYPE_MESSAGE
+          type_name: ".io.prometheus.client.Metric" }
+}
+'''
+
+
+def _metric_family_class():
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(text_format.Parse(_METRICS_PROTO, descriptor_pb2.FileDescriptorProto()))
+    descriptor = pool.FindMessageTypeByName('io.prometheus.client.MetricFamily')
+    if hasattr(message_factory, 'GetMessageClass'):
+        return message_factory.GetMessageClass(descriptor)
+    return message_factory.MessageFactory(pool).GetPrototype(descriptor)
+
+
+def _decode_families(data):
+    metric_family = _metric_family_class()
+    families, position = {}, 0
+    while position < len(data):
+        length, position = _DecodeVarint(data, position)
+        family = metric_family.FromString(data[position:position + length])
+        families[family.name] = family
+        position += length
+    return families
+
+
+class TestMrExpose(TestCase):
+    def setUp(self):
+        self.registry = prometheus_client.CollectorRegistry()
+        self.counter = prometheus_client.Counter(
+            'expose_requests', 'Requests.', ('Tag',), registry=self.registry)
+        self.counter.labels('a').inc(2)
+        self.gauge = prometheus_client.Gauge('expose_level', '', registry=self.registry)
+        self.gauge.set(-1.5)
+
+    def _text(self, response):
+        self.assertEqual(response.status, 200)
+        return response.body.decode('utf-8')
+
+    def test_caches_renderings(self):
+        cache = ExpositionCache(self.registry, ExpositionConfig(cacheSeconds=60))
+        self.assertIsNone(cache.respond_cached('GET', '', '', ''))
+        first = cache.respond('GET', '', '', '')
+        self.counter.labels('a').inc()
+
+        self.assertIs(cache.respond('GET', '', '', '').body, first.body)
+        self.assertIs(cache.respond_cached('GET', '', '', '').body, first.body)
+        self.assertIn('expose_requests_total{Tag="a"} 2.0', self._text(first))
+        # Other formats and names are rendered separately.
+        self.assertIn('expose_requests_total{Tag="a"} 3.0',
+                      self._text(cache.respond('GET', 'name[]=expose_requests_total', '', '')))
+
+    def test_uncached(self):
+        cache = ExpositionCache(self.registry, ExpositionConfig(cacheSeconds=0))
+        cache.respond('GET', '', '', '')
+        self.counter.labels('a').inc()
+
+        self.assertIsNone(cache.respond_cached('GET', '', '', ''))
+        self.assertIn('expose_requests_total{Tag="a"} 3.0',
+                      self._text(cache.respond('GET', '', '', '')))
+
+    def test_bounds_cached_renderings(self):
+        cache = ExpositionCache(self.registry, ExpositionConfig(maxCachedResponses=1))
+        cache.respond('GET', 'name[]=expose_level', '', '')
+        cache.respond('GET', '', '', '')
+
+        self.assertIsNone(cache.respond_cached('GET', 'name[]=expose_level', '', ''))
+        self.assertIsNotNone(cache.respond_cached('GET', '', '', ''))
+
+    def test_gzip(self):
+        cache = ExpositionCache(self.registry)
+        response = cache.respond('GET', '', '', 'gzip, deflate')
+        self.assertIn(('Content-Encoding', 'gzip'), response.headers)
+        self.assertIn(b'expose_level -1.5', gzip.decompress(response.body))
+
+        uncompressed = ExpositionCache(self.registry, ExpositionConfig(compress=False))
+        response = uncompressed.respond('GET', '', '', 'gzip')
+        self.assertNotIn(('Content-Encoding', 'gzip'), response.headers)
+        self.assertIn(b'expose_level -1.5', response.body)
+
+    def test_filters_names(self):
+        cache = ExpositionCache(self.registry)
+        text = self._text(cache.respond('GET', 'name[]=expose_level', '', ''))
+        self.assertIn('expose_level', text)
+        self.assertNotIn('expose_requests', text)
+
+    def test_openmetrics(self):
+        cache = ExpositionCache(self.registry)
+        response = cache.respond('GET', '', 'application/openmetrics-text; version=1.0.0', '')
+        self.assertTrue(dict(response.headers)['Content-Type'].startswith(
+            'application/openmetrics-text'))
+        self.assertTrue(self._text(response).endswith('# EOF\n'))
+
+    def test_protobuf(self):
+        histogram = prometheus_client.Histogram(
+            'expose_values', '', buckets=(1.0, 2.0), registry=self.registry)
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        histogram.observe(3.0)
+        summary = prometheus_client.Summary('expose_latency', '', registry=self.registry)
+        summary.observe(4.0)
+        cache = ExpositionCache(self.registry)
+        response = cache.respond(
+            'GET', '', f'{PROTOBUF_CONTENT_TYPE};q=0.9,text/plain;version=0.0.4;q=0.3', '')
+        self.assertEqual(dict(response.headers)['Content-Type'], PROTOBUF_CONTENT_TYPE)
+
+        families = _decode_families(response.body)
+        self.assertEqual(response.body, generate_protobuf(self.registry))
+        counter = families['expose_requests_total']
+        self.assertEqual((counter.help, counter.type), ('Requests.', 0))
+        self.assertEqual([(label.name, label.value) for label in counter.metric[0].label],
+                         [('Tag', 'a')])
+        self.assertEqual(counter.metric[0].counter.value, 2)
+        self.assertEqual(families['expose_level'].metric[0].gauge.value, -1.5)
+        values = families['expose_values']
+        self.assertEqual(values.type, 4)
+        self.assertEqual(values.metric[0].histogram.sample_count, 3)
+        self.assertEqual(values.metric[0].histogram.sample_sum, 5.0)
+        self.assertEqual([(bucket.upper_bound, bucket.cumulative_count)
+                          for bucket in values.metric[0].histogram.bucket],
+                         [(1.0, 1), (2.0, 2)])
+        latency = families['expose_latency'].metric[0].summary
+        self.assertEqual((latency.sample_count, latency.sample_sum), (1, 4.0))
+
+    def test_methods(self):
+        cache = ExpositionCache(self.registry)
+        self.assertEqual(cache.respond('POST', '', '', '').status, 405)
+        self.assertEqual(cache.respond_cached('OPTIONS', '', '', '').status, 200)
+
+    def test_wsgi_application(self):
+        counter = prometheus_client.Counter('expose_wsgi', '')
+        self.addCleanup(prometheus_client.REGISTRY.unregister, counter)
+        counter.inc()
+        client = Client(WSGIApplication.make())
+
+        response = client.get('/?name[]=expose_wsgi_total', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn(b'expose_wsgi_total 1.0', gzip.decompress(response.get_data()))
+        self.assertEqual(client.post('/').status_code, 405)
+
+    def test_asgi_application(self):
+        counter = prometheus_client.Counter('expose_asgi', '')
+        self.addCleanup(prometheus_client.REGISTRY.unregister, counter)
+        app = ASGIApplication.make(ExpositionConfig(cacheSeconds=60))
+
+        async def scrape():
+            messages = []
+
+            async def send(message):
+                messages.append(message)
+            scope = {'type': 'http', 'method': 'GET', 'path': '/',
+                     'query_string': b'name[]=expose_asgi_total', 'headers': []}
+            await app(scope, None, send)
+            return messages
+
+        counter.inc()
+        start, body = asyncio.run(scrape())
+        counter.inc()
+        self.assertEqual(start['status'], 200)
+        self.assertTrue(dict(start['headers'])[b'content-type'].startswith(b'text/plain'))
+        self.assertIn(b'expose_asgi_total 1.0', body['body'])
+        # Served from the cache, on the event loop.
+        self.assertEqual(asyncio.run(scrape())[1]['body'], body['body'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import math
+import random
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrhistogram import bucket_index, bucket_lower_bound
+from metricrule.agent.mrhistogram import ExponentialBuckets, ExponentialHistogram
+
+
+class TestMrHistogram(TestCase):
+    def test_bucket_index_within_bounds(self):
+        rng = random.Random(7)
+        values = [2.0 ** rng.uniform(-40, 40) for _ in range(2000)]
+        values += [1.0, 2.0, 0.5, 1024.0, 3.0, 1e-300, 1e300]
+        for scale in (-3, -1, 0, 1, 3, 8):
+            for value in values:
+                index = bucket_index(value, scale)
+                lower = bucket_lower_bound(index, scale)
+                upper = bucket_lower_bound(index + 1, scale)
+                self.assertLess(lower, value * (1 + 1e-12), (value, scale))
+                self.assertLessEqual(value, upper * (1 + 1e-12), (value, scale))
+
+    def test_powers_of_two_are_upper_bounds(self):
+        self.assertEqual(bucket_index(1.0, 0), -1)
+        self.assertEqual(bucket_index(4.0, 0), 1)
+        self.assertEqual(bucket_index(4.0, 2), 7)
+        self.assertEqual(bucket_index(4.0, -1), 0)
+        self.assertEqual(bucket_index(4.5, -1), 1)
+
+    def test_cumulative_buckets(self):
+        buckets = ExponentialBuckets(scale=0)
+        for value in (-3.0, -0.75, 0.0, 1.5, 1.75, 3.0, float('nan')):
+            buckets.observe(value)
+
+        counts, sum_value = buckets.cumulative_buckets()
+
+        self.assertEqual(counts, [('-2.0', 1), ('-1.0', 1), ('-0.5', 2), ('0', 3),
+                                  ('2.0', 5), ('4.0', 6), ('+Inf', 7)])
+        self.assertTrue(math.isnan(sum_value))
+
+    def test_negative_bounds_include_their_value(self):
+        buckets = ExponentialBuckets(scale=0)
+        for value in (-4.0, -2.0, -1.0, float('-inf')):
+            buckets.observe(value)
+
+        counts, _ = buckets.cumulative_buckets()
+
+        self.assertEqual(counts, [('-4.0', 2), ('-2.0', 3), ('-1.0', 4), ('0', 4),
+                                  ('+Inf', 4)])
+
+    def test_bounds_are_kept_beyond_max_buckets(self):
+        buckets = ExponentialBuckets(scale=0, max_buckets=4)
+        buckets.observe(1.5)
+        bounds = [bound for bound, _ in buckets.cumulative_buckets()[0]]
+        for value in (100.0, 0.01, -2.0, -1e6, -1e-3, float('-inf')):
+            buckets.observe(value)
+
+        counts, _ = buckets.cumulative_buckets()
+
+        self.assertEqual(buckets.scale, 0)
+        self.assertTrue(set(bounds) <= {bound for bound, _ in counts})
+        self.assertEqual(counts, [('-16.0', 2), ('-8.0', 2), ('-4.0', 2), ('-2.0', 3),
+                                  ('0', 4), ('2.0', 6), ('4.0', 6), ('8.0', 6), ('16.0', 6),
+                                  ('+Inf', 7)])
+
+    def test_batched_observations_match_single(self):
+        rng = random.Random(3)
+        values = [rng.lognormvariate(0, 4) * rng.choice((-1, 1)) for _ in range(1000)]
+        values += [0.0, 8.0, -8.0, float('inf'), float('-inf')]
+        one_at_a_time = ExponentialBuckets(scale=6, max_buckets=40)
+        batched = ExponentialBuckets(scale=6, max_buckets=40)
+
+        for value in values:
+            one_at_a_time.observe(value)
+        batched.observe_many(values)
+
+        self.assertEqual(batched.scale, one_at_a_time.scale)
+        self.assertEqual(batched.cumulative_buckets()[0], one_at_a_time.cumulative_buckets()[0])
+        self.assertTrue(math.isnan(batched.cumulative_buckets()[1]))
+
+    def test_histogram_is_collected(self):
+        registry = prometheus_client.CollectorRegistry()
+        histogram = ExponentialHistogram(
+            'test_exponential', '', labelnames=('Breed',), scale=0, registry=registry)
+
+        histogram.labels('Tabby').observe(3.0)
+        histogram.labels('Tabby').observe(0.75)
+        histogram.labels('Husky').observe_many([100.0])
+
+        self.assertEqual(registry.get_sample_value(
+            'test_exponential_bucket', {'Breed': 'Tabby', 'le': '1.0'}), 1)
+        self.assertEqual(registry.get_sample_value(
+            'test_exponential_bucket', {'Breed': 'Tabby', 'le': '4.0'}), 2)
+        self.assertEqual(registry.get_sample_value(
+            'test_exponential_count', {'Breed': 'Tabby'}), 2)
+        self.assertEqual(registry.get_sample_value(
+            'test_exponential_sum', {'Breed': 'Husky'}), 100.0)
+        self.assertIn(b'le="128.0"', prometheus_client.generate_latest(registry))
+        with self.assertRaises(ValueError):
+            ExponentialHistogram('test_exponential', '', registry=registry)
+
+
+if __name__ == '__main__':
+    main()
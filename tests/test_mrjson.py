@@ -0,0 +1,58 @@
+from unittest import mock, skipUnless, TestCase, main
+
+from metricrule.agent import mrjson
+from metricrule.agent.mrjson import get_default_decoder, may_be_json, orjson_decode, stdlib_decode
+
+PAYLOADS = (
+    b'{"instances": [{"a": [1.5, "x"]}]}',
+    b' \r\n[0.5, null, true, false]',
+    '{"text": "café"}',
+    b'{"nan": NaN, "inf": Infinity}',
+    b'\xef\xbb\xbf{"bom": 1}',
+    b'-1',
+)
+
+
+class TestMrJson(TestCase):
+    def _assert_matches_stdlib(self, decoder):
+        for payload in PAYLOADS:
+            self.assertEqual(repr(decoder(payload)), repr(stdlib_decode(payload)),
+                             f'{decoder.__name__} on {payload!r}')
+
+    def _assert_raises_value_error(self, decoder):
+        for payload in (b'{"a": ', b'\xff\xfe', '[1,]'):
+            with self.assertRaises(ValueError):
+                decoder(payload)
+
+    def test_decoders_match_stdlib(self):
+        for decoder in (get_default_decoder(), stdlib_decode):
+            self._assert_matches_stdlib(decoder)
+
+    def test_decoders_raise_value_error(self):
+        for decoder in (get_default_decoder(), stdlib_decode):
+            self._assert_raises_value_error(decoder)
+
+    @skipUnless(mrjson.orjson is not None, 'requires orjson')
+    def test_orjson_matches_stdlib(self):
+        self.assertIs(get_default_decoder(), orjson_decode)
+        self._assert_matches_stdlib(orjson_decode)
+
+    @skipUnless(mrjson.orjson is not None, 'requires orjson')
+    def test_orjson_raises_value_error(self):
+        self._assert_raises_value_error(orjson_decode)
+
+    def test_orjson_not_installed(self):
+        with mock.patch.object(mrjson, 'orjson', None):
+            self.assertIs(get_default_decoder(), stdlib_decode)
+            with self.assertRaises(ImportError):
+                orjson_decode(b'{}')
+
+    def test_may_be_json(self):
+        for payload in PAYLOADS:
+            self.assertTrue(may_be_json(payload), payload)
+        for payload in (b'', b'   ', b'<html></html>', 'a=1&b=2', b'--boundary\r\n', b'\x00{'):
+            self.assertFalse(may_be_json(payload), payload)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import json
+import random
+from unittest import TestCase, main
+
+from google.protobuf import text_format
+import prometheus_client
+
+from metricrule.config_gen import metric_configuration_pb2
+from metricrule.agent.mrconfig import CardinalityConfig
+from metricrule.agent.mrlimit import CardinalityLimit, LabelLimiter, SpaceSaving
+from metricrule.agent.mrmetric import compile_plan, MetricContext, MetricInstrumentSpec
+from metricrule.agent.mrotel import initialize_all_instruments, initialize_instrument
+from metricrule.agent.mrrecorder import log_request_metrics
+
+
+class TestMrLimit(TestCase):
+    def test_space_saving_bounds_counts(self):
+        rng = random.Random(4)
+        stream = [f'heavy{i}' for i in range(5) for _ in range(200)]
+        stream += [f'tail{rng.randrange(10000)}' for _ in range(3000)]
+        rng.shuffle(stream)
+        sketch = SpaceSaving(20)
+
+        for item in stream:
+            sketch.add(item)
+
+        for i in range(5):
+            estimate, error = sketch.add(f'heavy{i}', 0)
+            self.assertGreaterEqual(estimate, 200)
+            self.assertLessEqual(estimate - error, 200)
+
+    def test_limiter_keeps_heavy_hitters(self):
+        limiter = LabelLimiter(max_values=3, candidates=10, other_value='__other__')
+        for value in ('a', 'b', 'c'):
+            self.assertEqual(limiter.admit(value), (value, None))
+
+        self.assertEqual(limiter.admit('d'), ('__other__', None))
+        self.assertEqual(limiter.admit('a', 5), ('a', None))
+        self.assertEqual(limiter.admit('b', 5), ('b', None))
+        # 'd' becomes certainly more frequent than 'c', and replaces it.
+        self.assertEqual(limiter.admit('d'), ('d', 'c'))
+        self.assertEqual(limiter.admit('c'), ('__other__', None))
+        self.assertEqual(limiter.admit('d'), ('d', None))
+
+    def test_limited_instrument_bounds_series(self):
+        registry = prometheus_client.REGISTRY
+        spec = MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'test_limited_counter', ('User', 'Region'))
+        limit = CardinalityLimit(
+            CardinalityConfig(maxValues=100, metricMaxValues={'test_limited_counter': 2},
+                              counterName='test_limited_collapsed'))
+        counter = limit.wrap_instrument(spec, initialize_instrument(spec))
+
+        counter.record_many([1] * 3, {'User': 'alice', 'Region': 'eu'})
+        counter.record_many([1] * 4, {'User': 'bob', 'Region': 'eu'})
+        counter.record(1, {'User': 'carol', 'Region': 'eu'})
+        counter.record_many([1, 1], {'User': 'dave', 'Region': 'eu'})
+
+        def value(user):
+            return registry.get_sample_value(
+                'test_limited_counter_total', {'User': user, 'Region': 'eu'})
+        self.assertEqual(value('alice'), 3)
+        self.assertEqual(value('bob'), 4)
+        self.assertEqual(value('__other__'), 3)
+        self.assertEqual(registry.get_sample_value(
+            'test_limited_collapsed_total', {'metric': 'test_limited_counter', 'label': 'User'}), 3)
+
+        # A heavy hitter replaces the least frequent kept value, whose
+        # series are removed.
+        counter.record_many([1] * 3, {'User': 'erin', 'Region': 'eu'})
+        self.assertEqual(value('__other__'), 6)
+        counter.record_many([1] * 3, {'User': 'erin', 'Region': 'eu'})
+        self.assertEqual(value('erin'), 3)
+        self.assertIsNone(value('alice'))
+        self.assertEqual(value('bob'), 4)
+        self.assertEqual(value('__other__'), 6)
+
+        counter.unregister(registry)
+        self.assertIsNone(value('bob'))
+        self.assertIsNone(registry.get_sample_value(
+            'test_limited_collapsed_total', {'metric': 'test_limited_counter', 'label': 'User'}))
+
+    def test_parsed_integer_labels_are_bounded(self):
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse('''
+        input_metrics {
+            name: "test_limited_integer"
+            simple_counter {}
+            labels {
+                label_key { string_value: "User" }
+                label_value {
+                    parsed_value {
+                        field_path: ".user"
+                        parsed_type: INTEGER
+                    }
+                }
+            }
+        }
+        ''', config_proto)
+        plan = compile_plan(config_proto)
+        limit = CardinalityLimit(CardinalityConfig(
+            maxValues=3, counterName='test_limited_integer_collapsed'))
+        instruments = {spec: limit.wrap_instrument(spec, instrument) for spec, instrument
+                       in initialize_all_instruments(plan)[MetricContext.INPUT].items()}
+
+        for user in list(range(10)) * 2 + [7] * 10:
+            log_request_metrics(plan, instruments, json.dumps({'user': user}))
+
+        users = [sample.labels['User'] for metric in prometheus_client.REGISTRY.collect()
+                 if metric.name == 'test_limited_integer' for sample in metric.samples
+                 if sample.name == 'test_limited_integer_total']
+        self.assertLessEqual(len(users), 4)
+        self.assertIn('7', users)
+        self.assertIn('__other__', users)
+
+    def test_unlabeled_instruments_are_not_wrapped(self):
+        spec = MetricInstrumentSpec(prometheus_client.Counter, int, 'test_unlimited', ())
+        instrument = initialize_instrument(spec)
+
+        limit = CardinalityLimit(CardinalityConfig(counterName='test_unlimited_collapsed'))
+
+        self.assertIs(limit.wrap_instrument(spec, instrument), instrument)
+
+
+if __name__ == '__main__':
+    main()
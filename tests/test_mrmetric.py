@@ -5,7 +5,9 @@ from google.protobuf import text_format
 import prometheus_client
 
 from metricrule.config_gen import metric_configuration_pb2
-from metricrule.agent.mrmetric import get_instrument_specs, get_context_labels, get_metric_instances, MetricContext
+from metricrule.agent.mrconfig import HistogramConfig, SamplingConfig
+from metricrule.agent.mrmetric import compile_plan, get_instrument_specs, get_context_labels, get_metric_instances, get_payload_selection, is_sampled, MetricContext
+from metricrule.agent.mrselect import select_json
 
 
 class TestMrMetric(TestCase):
@@ -549,6 +551,256 @@ class TestMrMetric(TestCase):
                 value = instance.metricValues[0]
                 self.assertEqual(value, 1)
 
+    def test_compiled_plan_matches_config(self):
+        config_data = '''
+        input_content_filter: ".instances[*]"
+        input_metrics {
+            name: "input_counts"
+            simple_counter: {}
+            labels: {
+                label_key: { string_value: "Breed" }
+                label_value: {
+                    parsed_value: {
+                        field_path: ".Breed1[0]"
+                        parsed_type: STRING
+                    }
+                }
+            }
+        }
+        output_content_filter: ".predictions[*]"
+        output_metrics {
+            name: "output_values"
+            value {
+                value {
+                    parsed_value {
+                        field_path: "[0]"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        context_labels_from_input {
+            label_key: { string_value: "PetType" }
+            label_value: {
+                parsed_value: {
+                    field_path: ".Type[0]"
+                    parsed_type: STRING
+                }
+            }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto)
+        input_payload = json.loads(
+            '{"instances": [{"Type": ["Cat"], "Breed1": ["Tabby"]},'
+            ' {"Type": ["Dog"], "Breed1": ["Husky"]}]}')
+        output_payload = json.loads('{"predictions": [[0.25], [0.75]]}')
+
+        self.assertEqual(get_instrument_specs(plan),
+                         get_instrument_specs(config_proto))
+        for context, payload in ((MetricContext.INPUT, input_payload),
+                                 (MetricContext.OUTPUT, output_payload)):
+            self.assertEqual(
+                get_metric_instances(plan, payload, context),
+                get_metric_instances(config_proto, payload, context))
+            self.assertEqual(
+                get_context_labels(plan, payload, context),
+                get_context_labels(config_proto, payload, context))
+
+        output_spec = get_instrument_specs(plan)[MetricContext.OUTPUT][0]
+        self.assertEqual(output_spec.labelNames, ('PetType',))
+        self.assertEqual(
+            get_context_labels(plan, input_payload, MetricContext.INPUT),
+            (('PetType', 'Cat'), ('PetType', 'Dog')))
+
+    def test_compiled_plan_is_reusable(self):
+        config_data = '''
+        output_metrics {
+            name: "output_values"
+            value {
+                value {
+                    parsed_value {
+                        field_path: "$.prediction"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto)
+
+        for prediction in (0.1, 0.2, 0.3):
+            payload = {'prediction': prediction}
+            result = get_metric_instances(plan, payload, MetricContext.OUTPUT)
+            instances = next(iter(result.values()))
+            self.assertEqual(instances[0].metricValues, (prediction,))
+
+    def test_sampled_counter_is_scaled(self):
+        config_data = '''
+        input_metrics {
+            name: "sampled"
+            simple_counter: {}
+        }
+        input_metrics {
+            name: "unsampled"
+            simple_counter: {}
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto, SamplingConfig(
+            rate=1.0, metricRates={'sampled': 0.25}))
+
+        kept = get_metric_instances(plan, {}, MetricContext.INPUT, 0.1)
+        dropped = get_metric_instances(plan, {}, MetricContext.INPUT, 0.5)
+
+        self.assertEqual(
+            {spec.name: instances[0].metricValues for spec, instances in kept.items()},
+            {'sampled': (4.0,), 'unsampled': (1,)})
+        self.assertEqual([spec.name for spec in dropped], ['unsampled'])
+
+    def test_metric_options_attached_to_value_specs(self):
+        config_data = '''
+        input_metrics {
+            name: "count"
+            simple_counter: {}
+        }
+        output_metrics {
+            name: "value"
+            value: {
+                value: { float_value: 1.0 }
+            }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        options = HistogramConfig(buckets=(1.0, 2.0))
+        plan = compile_plan(config_proto, metric_options={'count': options, 'value': options})
+
+        specs = get_instrument_specs(plan)
+
+        self.assertIsNone(specs[MetricContext.INPUT][0].options)
+        self.assertEqual(specs[MetricContext.OUTPUT][0].options, options)
+
+    def test_context_sampling_rates(self):
+        config_data = '''
+        input_metrics {
+            name: "input"
+            simple_counter: {}
+        }
+        output_metrics {
+            name: "output"
+            simple_counter: {}
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto, SamplingConfig(
+            rate=0.5, inputRate=0.1))
+
+        self.assertTrue(is_sampled(plan, MetricContext.INPUT, 0.05))
+        self.assertFalse(is_sampled(plan, MetricContext.INPUT, 0.2))
+        self.assertTrue(is_sampled(plan, MetricContext.OUTPUT, 0.2))
+        self.assertFalse(is_sampled(plan, MetricContext.OUTPUT, 0.5))
+
+    def test_context_labels_sampled_with_output(self):
+        config_data = '''
+        output_metrics {
+            name: "output"
+            simple_counter: {}
+        }
+        context_labels_from_input {
+            label_key: { string_value: "Application" }
+            label_value: { string_value: "MetricRule" }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto, SamplingConfig(rate=0.5))
+
+        self.assertTrue(is_sampled(plan, MetricContext.INPUT, 0.2))
+        self.assertFalse(is_sampled(plan, MetricContext.INPUT, 0.7))
+
+    def test_selected_payload_matches_full_payload(self):
+        config_data = '''
+        input_content_filter: ".instances[*]"
+        input_metrics {
+            name: "input_counts"
+            simple_counter: {}
+        }
+        input_metrics {
+            name: "input_ages"
+            value {
+                value {
+                    parsed_value {
+                        field_path: ".Age[0]"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+            labels: {
+                label_key: { string_value: "Breed" }
+                label_value: {
+                    parsed_value: {
+                        field_path: ".Breed1[0]"
+                        parsed_type: STRING
+                    }
+                }
+            }
+        }
+        context_labels_from_input {
+            label_key: { string_value: "PetType" }
+            label_value: {
+                parsed_value: {
+                    field_path: ".Type[0]"
+                    parsed_type: STRING
+                }
+            }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto)
+        body = json.dumps({'instances': [
+            {'Type': ['Cat'], 'Breed1': ['Tabby'], 'Age': [3], 'Image': 'QUJD' * 100},
+            {'Type': ['Dog'], 'Breed1': ['Husky'], 'Age': [5], 'Embedding': [0.1] * 100},
+            {},
+        ], 'id': 'request'})
+        payload = json.loads(body)
+        selected = select_json(
+            body, get_payload_selection(plan, MetricContext.INPUT), small_value_chars=0)
+
+        self.assertEqual(selected['instances'][0],
+                         {'Type': ['Cat'], 'Breed1': ['Tabby'], 'Age': [3]})
+        self.assertEqual(get_metric_instances(plan, selected, MetricContext.INPUT),
+                         get_metric_instances(plan, payload, MetricContext.INPUT))
+        self.assertEqual(get_context_labels(plan, selected, MetricContext.INPUT),
+                         get_context_labels(plan, payload, MetricContext.INPUT))
+
+    def test_no_selection_for_fallback_paths(self):
+        config_data = '''
+        output_metrics {
+            name: "output_values"
+            value {
+                value {
+                    parsed_value {
+                        field_path: "$..prediction"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        '''
+        config_proto = metric_configuration_pb2.SidecarConfig()
+        text_format.Parse(config_data, config_proto)
+        plan = compile_plan(config_proto)
+
+        self.assertIsNone(get_payload_selection(plan, MetricContext.OUTPUT))
+        self.assertIsNotNone(get_payload_selection(plan, MetricContext.INPUT))
+
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,14 @@
-from unittest import TestCase, main
+import os
+import random
+from unittest import mock, TestCase, main
 
 import prometheus_client
 
-from metricrule.agent.mrotel import initialize_instrument, Counter, ValueRecorder
+from metricrule.agent.mrconfig import exponential_buckets, linear_buckets, HistogramConfig, SketchConfig
+from metricrule.agent.mrhistogram import ExponentialHistogram
+from metricrule.agent.mrotel import initialize_instrument, Counter, LabeledChildCache, QuantileRecorder, ValueRecorder
 from metricrule.agent.mrmetric import MetricInstrumentSpec
+from metricrule.agent.mrprocess import MULTIPROCESS_DIR_ENV
 
 
 class TestMrOtel(TestCase):
@@ -36,6 +41,79 @@ class TestMrOtel(TestCase):
         self.assertIsInstance(recorder, ValueRecorder)
         # self.assertEqual(recorder.recorder, created_recorder)
 
+    def test_initialize_recorder_with_buckets(self):
+        spec = MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_recorder_buckets', (),
+            HistogramConfig(buckets=linear_buckets(1.0, 2.0, 3)))
+
+        recorder = initialize_instrument(spec)
+        recorder.record(4.0, {})
+
+        self.assertEqual(recorder.recorder._upper_bounds, [1.0, 3.0, 5.0, float('inf')])
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value(
+            'test_recorder_buckets_bucket', {'le': '3.0'}), 0)
+        self.assertEqual(registry.get_sample_value(
+            'test_recorder_buckets_bucket', {'le': '5.0'}), 1)
+
+    def test_initialize_exponential_recorder(self):
+        spec = MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_recorder_exponential', ('Breed',),
+            HistogramConfig(exponentialScale=0))
+
+        recorder = initialize_instrument(spec)
+        recorder.record(3.0, {'Breed': 'Tabby'})
+        recorder.record_many([0.5] * 20, {'Breed': 'Tabby'})
+
+        self.assertIsInstance(recorder.recorder, ExponentialHistogram)
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value(
+            'test_recorder_exponential_bucket', {'Breed': 'Tabby', 'le': '0.5'}), 20)
+        self.assertEqual(registry.get_sample_value(
+            'test_recorder_exponential_bucket', {'Breed': 'Tabby', 'le': '4.0'}), 21)
+
+    def test_exponential_recorder_rejected_in_multiprocess_mode(self):
+        spec = MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_recorder_exponential_multiprocess', (),
+            HistogramConfig(exponentialScale=0))
+
+        with mock.patch.dict(os.environ, {MULTIPROCESS_DIR_ENV: '/tmp/metricrule'}):
+            with self.assertRaises(ValueError):
+                initialize_instrument(spec)
+
+    def test_initialize_quantile_recorder(self):
+        spec = MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_recorder_sketch', ('Breed',),
+            SketchConfig(quantiles=(0.5,)))
+
+        recorder = initialize_instrument(spec)
+        recorder.record(2.0, {'Breed': 'Tabby'})
+        recorder.record_many([1.0] * 20, {'Breed': 'Tabby'})
+
+        self.assertIsInstance(recorder, QuantileRecorder)
+        registry = prometheus_client.REGISTRY
+        self.assertAlmostEqual(registry.get_sample_value(
+            'test_recorder_sketch', {'Breed': 'Tabby', 'quantile': '0.5'}), 1.0, delta=0.01)
+        self.assertEqual(registry.get_sample_value(
+            'test_recorder_sketch_count', {'Breed': 'Tabby'}), 21)
+
+    def test_quantile_recorder_rejected_in_multiprocess_mode(self):
+        spec = MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_recorder_sketch_multiprocess', (),
+            SketchConfig())
+
+        with mock.patch.dict(os.environ, {MULTIPROCESS_DIR_ENV: '/tmp/metricrule'}):
+            with self.assertRaises(ValueError):
+                initialize_instrument(spec)
+
+    def test_bucket_generators(self):
+        self.assertEqual(linear_buckets(0.0, 0.5, 3), (0.0, 0.5, 1.0))
+        self.assertEqual(exponential_buckets(1.0, 10.0, 3), (1.0, 10.0, 100.0))
+        with self.assertRaises(ValueError):
+            linear_buckets(0.0, 0.0, 3)
+        with self.assertRaises(ValueError):
+            exponential_buckets(0.0, 2.0, 3)
+
     def test_counter_record(self):
         name = 'test_counter_record'
         spec = MetricInstrumentSpec(
@@ -49,6 +127,71 @@ class TestMrOtel(TestCase):
 
         counter.record(1, ())
 
+    def test_labeled_records_use_cached_children(self):
+        name = 'test_counter_cached_children'
+        spec = MetricInstrumentSpec(
+            prometheus_client.Counter,
+            int,
+            name,
+            ('Breed',),
+        )
+        counter = initialize_instrument(spec)
+
+        counter.record(1, {'Breed': 'Tabby'})
+        counter.record(2, {'Breed': 'Tabby'})
+        counter.record(1, {'Breed': 'Husky'})
+
+        info = counter.children.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 2)
+        self.assertEqual(info.currsize, 2)
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value(
+            name + '_total', {'Breed': 'Tabby'}), 3)
+        self.assertEqual(registry.get_sample_value(
+            name + '_total', {'Breed': 'Husky'}), 1)
+
+    def test_child_cache_evicts_least_recently_used(self):
+        histogram = prometheus_client.Histogram(
+            'test_child_cache_eviction', '', labelnames=('Breed',))
+        cache = LabeledChildCache(histogram, maxsize=2)
+
+        first = cache.get(('a',))
+        cache.get(('b',))
+        self.assertIs(cache.get(('a',)), first)
+        cache.get(('c',))
+        cache.get(('b',))
+
+        info = cache.cache_info()
+        self.assertEqual(info.hits, 1)
+        self.assertEqual(info.misses, 4)
+        self.assertEqual(info.maxsize, 2)
+        self.assertEqual(info.currsize, 2)
+        # The evicted child is resolved again to the same metric child.
+        self.assertIs(cache.get(('a',)), first)
+
+    def test_batched_histogram_matches_single_records(self):
+        labels = {'Breed': 'Tabby'}
+        values = [random.uniform(-1, 12) for _ in range(1000)]
+        values += [0.005, 0.1, 10.0, float('inf'), 3, 7]
+        one_at_a_time = initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_histogram_single', ('Breed',)))
+        batched = initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'test_histogram_batched', ('Breed',)))
+
+        for value in values[:10]:
+            one_at_a_time.record(value, labels)
+            batched.record(value, labels)
+        for value in values[10:]:
+            one_at_a_time.record(value, labels)
+        batched.record_many(values[10:], labels)
+
+        def samples(recorder):
+            metric = next(iter(recorder.recorder.collect()))
+            return [(sample.name.rsplit('_', 1)[-1], sample.labels, sample.value)
+                    for sample in metric.samples if not sample.name.endswith('_created')]
+        self.assertEqual(samples(batched), samples(one_at_a_time))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,235 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrconfig import HistogramConfig, OTLPConfig, Temporality
+from metricrule.agent.mrmetric import MetricInstrumentSpec
+from metricrule.agent.mrotlp import ExportStats, OTLPExporter
+
+
+class _Collector(ThreadingHTTPServer):
+    """A stub OTLP collector, recording the exports it receives.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), _CollectorHandler)
+        self.exports = []
+        # Status codes of the next responses, then 200.
+        self.statuses = []
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1/metrics'
+
+
+class _CollectorHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self.server.statuses.pop(0) if len(self.server.statuses) > 0 else 200
+        if not _has_string_attributes(json.loads(body)):
+            status = 400
+        if status == 200:
+            self.server.exports.append((self.headers['Content-Type'], json.loads(body)))
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def _has_string_attributes(export):
+    for resource_metrics in export['resourceMetrics']:
+        for scope_metrics in resource_metrics['scopeMetrics']:
+            for metric in scope_metrics['metrics']:
+                data = metric.get('sum') or metric.get('histogram')
+                for point in data['dataPoints']:
+                    for attribute in point['attributes']:
+                        if not isinstance(attribute['value']['stringValue'], str):
+                            return False
+    return True
+
+
+def _metrics(export):
+    return {metric['name']: metric
+            for metric in export['resourceMetrics'][0]['scopeMetrics'][0]['metrics']}
+
+
+def _values(metric):
+    return {tuple(attribute['value']['stringValue'] for attribute in point['attributes']):
+            point['asDouble'] for point in metric['sum']['dataPoints']}
+
+
+class TestMrOTLP(TestCase):
+    def setUp(self):
+        self.collector = _Collector()
+        thread = threading.Thread(target=self.collector.serve_forever, args=(0.01,), daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.collector.server_close)
+        self.addCleanup(self.collector.shutdown)
+
+    def _exporter(self, **kwargs):
+        return OTLPExporter(OTLPConfig(endpoint=self.collector.endpoint, **kwargs), start=False)
+
+    def test_export_counter_and_histogram(self):
+        exporter = self._exporter(serviceName='test_service')
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_requests', ('Tag',)))
+        histogram = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'otlp_values', (),
+            HistogramConfig(buckets=(1.0, 2.0, float('inf')))))
+        counter.record(1, {'Tag': 'a'})
+        counter.record(2, {'Tag': 'a'})
+        counter.record(1, {'Tag': 'b'})
+        histogram.record(0.5, {})
+        histogram.record_many([1.5, 3.0, float('nan')] + [2.0] * 16, {})
+
+        self.assertEqual(exporter.flush(), ExportStats(1, 0, 0))
+
+        content_type, export = self.collector.exports[0]
+        self.assertEqual(content_type, 'application/json')
+        resource = export['resourceMetrics'][0]['resource']
+        self.assertEqual(resource['attributes'],
+                         [{'key': 'service.name', 'value': {'stringValue': 'test_service'}}])
+        metrics = _metrics(export)
+        self.assertEqual(_values(metrics['otlp_requests']), {('a',): 3, ('b',): 1})
+        self.assertTrue(metrics['otlp_requests']['sum']['isMonotonic'])
+        point = metrics['otlp_values']['histogram']['dataPoints'][0]
+        self.assertEqual(point['explicitBounds'], [1.0, 2.0])
+        self.assertEqual(point['bucketCounts'], ['1', '17', '1'])
+        self.assertEqual(point['count'], '19')
+        self.assertEqual(point['sum'], 0.5 + 1.5 + 3.0 + 32.0)
+        self.assertEqual((point['min'], point['max']), (0.5, 3.0))
+
+    def test_export_non_string_label_values(self):
+        exporter = self._exporter()
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_numeric_labels', ('Tag',)))
+        counter.record(1, {'Tag': 7})
+
+        self.assertEqual(exporter.flush(), ExportStats(1, 0, 0))
+
+        self.assertEqual(_values(_metrics(self.collector.exports[0][1])['otlp_numeric_labels']),
+                         {('7',): 1})
+
+    def test_duplicate_name(self):
+        exporter = self._exporter()
+        spec = MetricInstrumentSpec(prometheus_client.Counter, int, 'otlp_duplicate', ())
+        exporter.initialize_instrument(spec)
+        with self.assertRaises(ValueError):
+            exporter.initialize_instrument(spec)
+
+    def test_cumulative_accumulates(self):
+        exporter = self._exporter()
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_cumulative', ()))
+        counter.record(1, {})
+        exporter.flush()
+        counter.record(2, {})
+        exporter.flush()
+
+        first, second = [_metrics(export)['otlp_cumulative']['sum']
+                         for _, export in self.collector.exports]
+        self.assertEqual(second['aggregationTemporality'], Temporality.CUMULATIVE.value)
+        self.assertEqual(second['dataPoints'][0]['asDouble'], 3)
+        self.assertEqual(first['dataPoints'][0]['startTimeUnixNano'],
+                         second['dataPoints'][0]['startTimeUnixNano'])
+
+    def test_delta_resets(self):
+        exporter = self._exporter(temporality=Temporality.DELTA)
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_delta', ()))
+        counter.record(1, {})
+        exporter.flush()
+        exporter.flush()
+        counter.record(2, {})
+        exporter.flush()
+
+        self.assertEqual(len(self.collector.exports), 2)
+        first, second = [_metrics(export)['otlp_delta']['sum']['dataPoints'][0]
+                         for _, export in self.collector.exports]
+        self.assertEqual(second['asDouble'], 2)
+        self.assertLessEqual(int(first['timeUnixNano']), int(second['startTimeUnixNano']))
+
+    def test_retries_failed_exports(self):
+        exporter = self._exporter(temporality=Temporality.DELTA)
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_retried', ()))
+        self.collector.statuses = [503]
+        counter.record(1, {})
+        self.assertEqual(exporter.flush(), ExportStats(0, 1, 0))
+        counter.record(2, {})
+        self.assertEqual(exporter.flush(), ExportStats(2, 1, 0))
+
+        self.assertEqual([_values(_metrics(export)['otlp_retried'])
+                          for _, export in self.collector.exports], [{(): 1}, {(): 2}])
+
+    def test_drops_unretryable_exports(self):
+        exporter = self._exporter()
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_rejected', ()))
+        self.collector.statuses = [400]
+        counter.record(1, {})
+        self.assertEqual(exporter.flush(), ExportStats(0, 1, 1))
+
+    def test_drops_after_max_attempts(self):
+        exporter = self._exporter(temporality=Temporality.DELTA, maxAttempts=2)
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_attempts', ()))
+        self.collector.statuses = [503, 503]
+        counter.record(1, {})
+        exporter.flush()
+        self.assertEqual(exporter.flush(), ExportStats(0, 2, 1))
+
+    def test_bounds_pending_exports(self):
+        exporter = self._exporter(temporality=Temporality.DELTA, maxPendingExports=2)
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_bounded', ()))
+        self.collector.statuses = [503] * 3
+        for value in (1, 2, 3):
+            counter.record(value, {})
+            exporter.flush()
+        self.assertEqual(exporter.stats, ExportStats(0, 3, 1))
+
+        exporter.flush()
+        self.assertEqual([_values(_metrics(export)['otlp_bounded'])
+                          for _, export in self.collector.exports], [{(): 2}, {(): 3}])
+
+    def test_cumulative_keeps_latest_export(self):
+        exporter = self._exporter()
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_superseded', ()))
+        self.collector.statuses = [503]
+        counter.record(1, {})
+        exporter.flush()
+        counter.record(2, {})
+        self.assertEqual(exporter.flush(), ExportStats(1, 1, 0))
+
+        self.assertEqual(len(self.collector.exports), 1)
+        self.assertEqual(_values(_metrics(self.collector.exports[0][1])['otlp_superseded']),
+                         {(): 3})
+
+    def test_remove_label_value_and_unregister(self):
+        exporter = self._exporter()
+        counter = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_removed', ('Tag',)))
+        other = exporter.initialize_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'otlp_unregistered', ()))
+        counter.record(1, {'Tag': 'a'})
+        counter.record(1, {'Tag': 'b'})
+        other.record(1, {})
+        counter.remove_label_value(0, 'a')
+        other.unregister(prometheus_client.REGISTRY)
+        exporter.flush()
+
+        metrics = _metrics(self.collector.exports[0][1])
+        self.assertEqual(set(metrics), {'otlp_removed'})
+        self.assertEqual(_values(metrics['otlp_removed']), {('b',): 1})
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+from unittest import TestCase, main
+
+from jsonpath_ng import parse
+
+from metricrule.agent.mrpath import compile_path, FallbackPath, NativePath, parse_native_steps, FIELD, INDEX, WILDCARD
+
+PAYLOADS = (
+    {},
+    [],
+    None,
+    0.495,
+    'text',
+    [[0.495], [0.2, 0.3], []],
+    {'prediction': 0.495, 'predictions': [[0.495], [0.1]]},
+    {'instances': [{'Type': ['Cat'], 'Breed1': ['Tabby'], 'Tags': ['a', 'b']},
+                   {'Type': ['Dog'], 'Breed1': []},
+                   {'Type': 'Dog', 'Breed1': None},
+                   'not an object']},
+    {'instances': {'Type': ['Cat']}},
+    {'a': {'b': {'c': [1, 2, 3]}}, 'quoted key': 1},
+)
+
+PATHS = (
+    '$',
+    '.prediction',
+    '$.prediction',
+    'prediction',
+    '[0]',
+    '[-1]',
+    '[5]',
+    '[*]',
+    '$[*][0]',
+    '.predictions[*]',
+    '.predictions[*][0]',
+    '$.prediction[0][0]',
+    '.instances[*]',
+    '.instances[0].Type[0]',
+    '.instances[*].Breed1[0]',
+    '.instances[*].Tags[*]',
+    '.instances[*].Type[0]',
+    '.a.b.c[1]',
+    '.a.*',
+    '$["a"]["b"]',
+    "$['a'].b",
+)
+
+
+class TestMrPath(TestCase):
+    def test_native_paths_match_jsonpath_ng(self):
+        for path in PATHS:
+            evaluator = compile_path(path)
+            self.assertIsInstance(evaluator, NativePath, path)
+            expr = parse(path if path[0] not in '.[' else '$' + path)
+            for payload in PAYLOADS:
+                try:
+                    expected = [match.value for match in expr.find(payload)]
+                except TypeError:
+                    # jsonpath_ng raises when indexing scalars, which
+                    # matches nothing natively.
+                    expected = []
+                self.assertEqual(evaluator(payload), expected,
+                                 f'{path} on {payload}')
+
+    def test_parse_steps(self):
+        self.assertEqual(
+            parse_native_steps('.instances[*].Breed1[0]'),
+            ((FIELD, 'instances'), (WILDCARD, None),
+             (FIELD, 'Breed1'), (INDEX, 0)))
+        self.assertEqual(parse_native_steps('$'), ())
+
+    def test_falls_back_to_jsonpath_ng(self):
+        payload = {'a': [{'b': 1}, {'b': 2}, {'c': {'b': 3}}]}
+        for path in ('$..b', '.a[0:2].b', '.a[*]..b'):
+            evaluator = compile_path(path)
+            self.assertIsInstance(evaluator, FallbackPath, path)
+            expected = [match.value for match in parse('$' + path.lstrip('$')).find(payload)]
+            self.assertEqual(evaluator(payload), expected)
+
+
+if __name__ == '__main__':
+    main()
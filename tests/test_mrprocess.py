@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+from unittest import TestCase, main, skipUnless
+
+# Multi-process mode changes global state, so it is tested in a new
+# interpreter, which forks workers as a pre-fork server would.
+_SCRIPT = textwrap.dedent('''
+    import os
+    import sys
+
+    from werkzeug.test import Client
+
+    from metricrule.agent import WSGIApplication, WSGIMetricsMiddleware
+    from metricrule.agent.mrprocess import enable_multiprocess, mark_process_dead
+
+    metrics_dir, config_path = sys.argv[1:]
+    enable_multiprocess(metrics_dir)
+
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return [b'{"prediction": 0.5}']
+    middleware = WSGIMetricsMiddleware(app, config_path)
+
+    pids = []
+    for requests in (1, 2):
+        pid = os.fork()
+        if pid == 0:
+            client = Client(middleware)
+            for _ in range(requests):
+                client.post('/predict', data=b'{}', buffered=True)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        pids.append(pid)
+
+    def scrape(path='/'):
+        body = Client(WSGIApplication.make()).get(path).get_data(as_text=True)
+        return sorted(line for line in body.splitlines()
+                      if line.startswith('mp_') and 'created' not in line)
+
+    print('\\n'.join(scrape()))
+    print('---')
+    print('\\n'.join(scrape('/?name[]=mp_input_total')))
+    for pid in pids:
+        mark_process_dead(pid)
+    print('---')
+    print('\\n'.join(sorted(f for f in os.listdir(metrics_dir)
+                            if not f.endswith(f'_{os.getpid()}.db'))))
+    print('---')
+    print('\\n'.join(scrape()))
+''')
+
+
+@skipUnless(hasattr(os, 'fork'), 'requires fork')
+class TestMrProcess(TestCase):
+    def test_aggregates_and_archives_workers(self):
+        with tempfile.TemporaryDirectory() as metrics_dir, \
+                tempfile.NamedTemporaryFile('w', suffix='.textproto') as config_file:
+            config_file.write('''
+            input_metrics {
+                name: "mp_input"
+                simple_counter {}
+            }
+            output_metrics {
+                name: "mp_output"
+                value {
+                    value {
+                        parsed_value {
+                            field_path: ".prediction"
+                            parsed_type: FLOAT
+                        }
+                    }
+                }
+            }
+            ''')
+            config_file.flush()
+            result = subprocess.run(
+                [sys.executable, '-c', _SCRIPT, metrics_dir, config_file.name],
+                capture_output=True, text=True, check=True,
+                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+
+        before, restricted, files, after = (
+            section.strip().split('\n') for section in result.stdout.split('---'))
+        self.assertIn('mp_input_total 3.0', before)
+        self.assertIn('mp_output_count 3.0', before)
+        self.assertIn('mp_output_sum 1.5', before)
+        self.assertIn('mp_output_bucket{le="0.5"} 3.0', before)
+        self.assertEqual(restricted, ['mp_input_total 3.0'])
+        # Files of dead workers are merged into one file per metric type.
+        self.assertEqual(files, ['.metricrule.lock', 'counter_archive.db',
+                                 'histogram_archive.db'])
+        self.assertEqual(before, after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import time
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrmetric import MetricContext
+from metricrule.agent.mrreload import ReloadableConfig
+
+_COUNTER = '''
+input_metrics {{
+    name: "{name}"
+    simple_counter {{}}
+    {labels}
+}}
+'''
+
+_LABEL = '''
+labels {
+    label_key { string_value: "Tag" }
+    label_value {
+        parsed_value {
+            field_path: ".tag"
+            parsed_type: STRING
+        }
+    }
+}
+'''
+
+
+def _counters(*names, labeled=()):
+    return ''.join(_COUNTER.format(name=name, labels=_LABEL if name in labeled else '')
+                   for name in names)
+
+
+class TestMrReload(TestCase):
+    def setUp(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+            self.config_path = config_file.name
+        self.addCleanup(os.remove, self.config_path)
+
+    def _write(self, config_data):
+        with open(self.config_path, 'w', encoding='utf-8') as config_file:
+            config_file.write(config_data)
+
+    def _instruments(self, agent):
+        return {spec.name: instrument
+                for spec, instrument in agent.state.instruments[MetricContext.INPUT].items()}
+
+    def test_reload_diffs_instruments(self):
+        registry = prometheus_client.REGISTRY
+        self._write(_counters('reload_kept', 'reload_removed', 'reload_relabeled'))
+        agent = ReloadableConfig(self.config_path)
+        before = self._instruments(agent)
+        before['reload_kept'].record(1, {})
+        before['reload_removed'].record(1, {})
+
+        self._write(_counters('reload_kept', 'reload_relabeled', 'reload_added',
+                              labeled=('reload_relabeled',)))
+        state = agent.reload()
+
+        self.assertIs(agent.state, state)
+        after = self._instruments(agent)
+        self.assertEqual(set(after), {'reload_kept', 'reload_relabeled', 'reload_added'})
+        self.assertIs(after['reload_kept'], before['reload_kept'])
+        self.assertIsNot(after['reload_relabeled'], before['reload_relabeled'])
+        self.assertEqual(registry.get_sample_value('reload_kept_total'), 1)
+        self.assertIsNone(registry.get_sample_value('reload_removed_total'))
+        self.assertEqual(registry.get_sample_value('reload_added_total'), 0)
+        after['reload_relabeled'].record(1, {'Tag': 'a'})
+        self.assertEqual(registry.get_sample_value('reload_relabeled_total', {'Tag': 'a'}), 1)
+
+    def test_failed_reload_keeps_state(self):
+        self._write(_counters('reload_failing'))
+        agent = ReloadableConfig(self.config_path)
+        state = agent.state
+
+        self._write('input_metrics { unknown_field: 1 }')
+        with self.assertRaises(Exception):
+            agent.reload()
+
+        self.assertIs(agent.state, state)
+
+    def test_watcher_reloads_changed_file(self):
+        self._write(_counters('reload_watched'))
+        agent = ReloadableConfig(self.config_path, reload_interval=0.01)
+        self.addCleanup(agent.stop)
+        state = agent.state
+
+        self._write(_counters('reload_watched', 'reload_watched_added'))
+        deadline = time.monotonic() + 5
+        while agent.state is state and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertIn('reload_watched_added', self._instruments(agent))
+
+
+if __name__ == '__main__':
+    main()
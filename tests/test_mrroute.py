@@ -0,0 +1,103 @@
+import os
+import tempfile
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrconfig import RouteConfig
+from metricrule.agent.mrmetric import MetricContext
+from metricrule.agent.mrroute import RouteTable
+
+_COUNTERS = '''
+input_metrics {{
+    name: "{name}"
+    simple_counter {{}}
+}}
+input_metrics {{
+    name: "{shared}"
+    simple_counter {{}}
+}}
+'''
+
+
+class TestMrRoute(TestCase):
+    def _write_config(self, name, shared='route_shared'):
+        with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+            config_file.write(_COUNTERS.format(name=name, shared=shared))
+        self.addCleanup(os.remove, config_file.name)
+        return config_file.name
+
+    def test_matches_longest_prefix_and_method(self):
+        models_path = self._write_config('route_models')
+        model_a_path = self._write_config('route_model_a')
+        table = RouteTable(routes=[
+            RouteConfig('/v1/models/', models_path),
+            RouteConfig('/v1/models/a', model_a_path, methods=('POST',)),
+        ])
+        self.addCleanup(table.stop)
+        models = table.match('POST', '/v1/models/b:predict')
+        model_a = table.match('POST', '/v1/models/a/versions/1:predict')
+
+        self.assertIsNotNone(models)
+        self.assertIsNotNone(model_a)
+        self.assertIsNot(models, model_a)
+        self.assertIs(table.match('get', '/v1/models/a'), models)
+        self.assertIsNone(table.match('POST', '/metrics'))
+        # Both configs record the shared metric to the same instrument.
+        shared = [instrument for agent in (models, model_a)
+                  for spec, instrument in agent.state.instruments[MetricContext.INPUT].items()
+                  if spec.name == 'route_shared']
+        self.assertEqual(len(shared), 2)
+        self.assertIs(shared[0], shared[1])
+
+    def test_matches_whole_segments(self):
+        predict = self._write_config('route_predict', 'route_predict_shared')
+        table = RouteTable(routes=[RouteConfig('/predict', predict),
+                                   RouteConfig('/models/', predict)])
+        self.addCleanup(table.stop)
+
+        self.assertIsNotNone(table.match('POST', '/predict'))
+        self.assertIsNotNone(table.match('POST', '/predict/batch'))
+        self.assertIsNotNone(table.match('POST', '/models'))
+        self.assertIsNone(table.match('POST', '/predictions'))
+        self.assertIsNone(table.match('POST', '/predict_v2'))
+        self.assertIsNone(table.match('POST', '/models_v2'))
+
+    def test_routes_of_a_config_share_it(self):
+        config_path = self._write_config('route_same', 'route_same_shared')
+        table = RouteTable(routes=[RouteConfig('/a', config_path), RouteConfig('/b', config_path)])
+        self.addCleanup(table.stop)
+
+        self.assertIs(table.match('POST', '/a'), table.match('POST', '/b'))
+
+    def test_shared_instrument_is_kept_until_released(self):
+        first_path = self._write_config('route_first', 'route_kept')
+        second_path = self._write_config('route_second', 'route_kept')
+        table = RouteTable(routes=[RouteConfig('/first', first_path),
+                                   RouteConfig('/second', second_path)])
+        self.addCleanup(table.stop)
+
+        with open(first_path, 'w', encoding='utf-8') as config_file:
+            config_file.write('input_metrics { name: "route_first" simple_counter {} }')
+        table.reload()
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('route_kept_total'), 0)
+        with open(second_path, 'w', encoding='utf-8') as config_file:
+            config_file.write('')
+        table.reload()
+        self.assertIsNone(registry.get_sample_value('route_kept_total'))
+
+    def test_all_requests_match_without_routes(self):
+        table = RouteTable(self._write_config('route_default', 'route_default_shared'))
+        self.addCleanup(table.stop)
+
+        self.assertIsNotNone(table.match('GET', ''))
+
+    def test_config_path_with_routes_is_rejected(self):
+        with self.assertRaises(ValueError):
+            RouteTable('config.textproto', routes=[])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+import json
+from unittest import TestCase, main
+
+from metricrule.agent.mrpath import compile_path
+from metricrule.agent.mrselect import compile_selection, select_json
+
+from .test_mrpath import PATHS, PAYLOADS
+
+
+class TestMrSelect(TestCase):
+    def test_selected_paths_match_full_payload(self):
+        for path in PATHS:
+            evaluator = compile_path(path)
+            selection = compile_selection([evaluator.steps])
+            for payload in PAYLOADS:
+                body = json.dumps(payload)
+                for small_value_chars in (0, 20, 4096):
+                    self.assertEqual(
+                        evaluator(select_json(body, selection, small_value_chars)),
+                        evaluator(payload), f'{path} on {body}')
+                self.assertEqual(evaluator(select_json(body.encode(), selection, 0)),
+                                 evaluator(payload), f'{path} on {body}')
+
+    def test_skips_unselected_values(self):
+        body = json.dumps({
+            'instances': [{'image': 'QUJD' * 1000, 'embedding': [[0.5] * 100],
+                           'meta': {'a': '"}]', 'b': [{}, []]}, 'Type': ['Cat'],
+                           'x\\"y': 1},
+                          {'Type': ['Dog'], 'n': -1.5e-3, 'f': False, 'z': None}],
+            'id': 'abc',
+        })
+        selection = compile_selection([compile_path('.instances[*].Type[0]').steps])
+        self.assertEqual(select_json(body, selection, 0),
+                         {'instances': [{'Type': ['Cat']}, {'Type': ['Dog']}]})
+
+    def test_visited_paths_are_present(self):
+        selection = compile_selection([], [compile_path('.instances[*]').steps])
+        body = '{"instances": [{"a": [1, 2]}, [3, [4]], "text", 5], "b": 1}'
+        self.assertEqual(select_json(body, selection, 0),
+                         {'instances': [{}, [None, None], 'text', 5]})
+
+    def test_keeps_escaped_names_and_indices(self):
+        selection = compile_selection([compile_path('$["a b"][2]').steps])
+        body = '{"a\\u0020b": [1, {"x": 1}, "c", 4], "a": 0}'
+        self.assertEqual(select_json(body, selection, 0), {'a b': [None, None, 'c', None]})
+
+    def test_decodes_small_values_completely(self):
+        selection = compile_selection([compile_path('.a[1]').steps])
+        body = '{"a": [{"b": 1}, 2], "c": [' + '1, ' * 100 + '1]}'
+        self.assertEqual(select_json(body, selection, 20),
+                         {'a': [{'b': 1}, 2]})
+        self.assertEqual(select_json(body, selection), json.loads(body))
+
+    def test_raises_value_error(self):
+        selection = compile_selection([compile_path('.a').steps])
+        for body in ('', '{"a": 1', '{"a": 1} x', '{"b": [1, 2}', '{"a" 1}', '[1 2]', '{"b": tru}'):
+            with self.assertRaises(ValueError, msg=body):
+                select_json(body, selection, 0)
+
+
+if __name__ == '__main__':
+    main()
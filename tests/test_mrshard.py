@@ -0,0 +1,154 @@
+import math
+import os
+import threading
+from unittest import mock, TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrconfig import HistogramConfig, SketchConfig
+from metricrule.agent.mrmetric import MetricInstrumentSpec
+from metricrule.agent.mrotel import QuantileRecorder
+from metricrule.agent.mrprocess import MULTIPROCESS_DIR_ENV
+from metricrule.agent.mrreload import InstrumentPool
+from metricrule.agent.mrshard import initialize_sharded_instrument, ShardedCounter
+from metricrule.agent.mrshard import ShardedHistogram
+
+
+def _record_in_threads(record, num_threads=4):
+    threads = [threading.Thread(target=record) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+class TestMrShard(TestCase):
+    def setUp(self):
+        self.registry = prometheus_client.CollectorRegistry()
+
+    def test_counter_merges_threads(self):
+        counter = ShardedCounter('shard_requests', '', ('Tag',), self.registry)
+
+        def record():
+            for _ in range(1000):
+                counter.record(1, {'Tag': 'a'})
+            counter.record_many([0.5, 0.5], {'Tag': 'b'})
+        _record_in_threads(record)
+        counter.record(1, {'Tag': 'a'})
+
+        self.assertEqual(self.registry.get_sample_value('shard_requests_total', {'Tag': 'a'}),
+                         4001)
+        self.assertEqual(self.registry.get_sample_value('shard_requests_total', {'Tag': 'b'}), 4)
+        # Shards of exited threads are kept once retired.
+        self.assertEqual(self.registry.get_sample_value('shard_requests_total', {'Tag': 'a'}),
+                         4001)
+        with self.assertRaises(ValueError):
+            counter.record(-1, {'Tag': 'a'})
+
+    def test_counter_rejects_negative_increments(self):
+        counter = ShardedCounter('shard_negative', '', (), self.registry)
+
+        with self.assertRaises(ValueError):
+            counter.record_many([5, -1], {})
+
+        self.assertIsNone(self.registry.get_sample_value('shard_negative_total'))
+
+    def test_histogram_matches_prometheus(self):
+        expected_registry = prometheus_client.CollectorRegistry()
+        expected = prometheus_client.Histogram(
+            'shard_values', '', ('Tag',), buckets=(0.5, 1.0), registry=expected_registry)
+        histogram = ShardedHistogram('shard_values', '', ('Tag',), (0.5, 1.0), self.registry)
+        values = [0.25, 0.5, 0.75, 1.0, 2.0, math.nan]
+
+        def record():
+            for value in values:
+                histogram.record(value, {'Tag': 'a'})
+            histogram.record_many(values * 4, {'Tag': 'a'})
+        _record_in_threads(record)
+        for value in values * 5 * 4:
+            expected.labels('a').observe(value)
+
+        def samples(registry):
+            return {(sample.name, tuple(sorted(sample.labels.items()))): sample.value
+                    for metric in registry.collect() for sample in metric.samples
+                    if not sample.name.endswith('_created') and sample.name != 'shard_values_sum'}
+        self.assertEqual(samples(self.registry), samples(expected_registry))
+        self.assertTrue(math.isnan(self.registry.get_sample_value('shard_values_sum', {'Tag': 'a'})))
+
+    def test_retires_shards_of_exited_threads(self):
+        counter = ShardedCounter('shard_retired', '', ('Tag',), self.registry)
+        for _ in range(8):
+            _record_in_threads(lambda: counter.record(1, {'Tag': 'a'}), num_threads=1)
+
+        self.assertLessEqual(len(counter._shards), 1)  # pylint: disable=protected-access
+        self.assertEqual(self.registry.get_sample_value('shard_retired_total', {'Tag': 'a'}), 8)
+
+    def test_remove_label_value(self):
+        counter = ShardedCounter('shard_removed', '', ('Tag',), self.registry)
+        _record_in_threads(lambda: counter.record(1, {'Tag': 'a'}))
+        list(self.registry.collect())
+        _record_in_threads(lambda: counter.record(1, {'Tag': 'a'}))
+        counter.record(1, {'Tag': 'a'})
+        counter.record(1, {'Tag': 'b'})
+
+        counter.remove_label_value(0, 'a')
+
+        self.assertIsNone(self.registry.get_sample_value('shard_removed_total', {'Tag': 'a'}))
+        self.assertEqual(self.registry.get_sample_value('shard_removed_total', {'Tag': 'b'}), 1)
+
+    def test_running_threads_drop_removed_label_values(self):
+        counter = ShardedCounter('shard_removed_running', '', ('Tag',), self.registry)
+        recorded, removed = threading.Event(), threading.Event()
+
+        def record():
+            counter.record(1, {'Tag': 'a'})
+            counter.record(1, {'Tag': 'b'})
+            recorded.set()
+            removed.wait()
+            counter.record(2, {'Tag': 'a'})
+        thread = threading.Thread(target=record)
+        thread.start()
+        recorded.wait()
+
+        counter.remove_label_value(0, 'a')
+
+        self.assertIsNone(self.registry.get_sample_value('shard_removed_running_total',
+                                                         {'Tag': 'a'}))
+        removed.set()
+        thread.join()
+        self.assertEqual(self.registry.get_sample_value('shard_removed_running_total',
+                                                        {'Tag': 'a'}), 2)
+        self.assertEqual(self.registry.get_sample_value('shard_removed_running_total',
+                                                        {'Tag': 'b'}), 1)
+
+    def test_initialize_sharded_instrument(self):
+        counter = initialize_sharded_instrument(MetricInstrumentSpec(
+            prometheus_client.Counter, int, 'shard_counter', ()), self.registry)
+        histogram = initialize_sharded_instrument(MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'shard_buckets', (),
+            HistogramConfig(buckets=(1.0, 2.0))), self.registry)
+        sketch = initialize_sharded_instrument(MetricInstrumentSpec(
+            prometheus_client.Histogram, float, 'shard_sketch', (), SketchConfig()))
+        self.addCleanup(sketch.unregister, prometheus_client.REGISTRY)
+
+        self.assertIsInstance(counter, ShardedCounter)
+        self.assertIsInstance(histogram, ShardedHistogram)
+        self.assertIsInstance(sketch, QuantileRecorder)
+        histogram.record(1.5, {})
+        self.assertEqual(self.registry.get_sample_value('shard_buckets_bucket', {'le': '2.0'}), 1)
+        self.assertEqual(self.registry.get_sample_value('shard_buckets_bucket', {'le': '+Inf'}), 1)
+        with self.assertRaises(ValueError):
+            initialize_sharded_instrument(MetricInstrumentSpec(
+                prometheus_client.Counter, int, 'shard_counter', ()), self.registry)
+
+        counter.unregister(self.registry)
+        self.assertIsNone(self.registry.get_sample_value('shard_counter_total'))
+
+    def test_rejects_multiprocess_mode(self):
+        with mock.patch.dict(os.environ, {MULTIPROCESS_DIR_ENV: '/tmp/metricrule'}):
+            with self.assertRaises(ValueError):
+                InstrumentPool(sharded=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import math
+import random
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrsketch import DDSketch, QuantileSketch
+
+
+def _true_quantile(values, quantile):
+    ordered = sorted(values)
+    return ordered[int(quantile * (len(ordered) - 1))]
+
+
+class TestMrSketch(TestCase):
+    def test_quantiles_within_relative_accuracy(self):
+        rng = random.Random(5)
+        values = [rng.lognormvariate(0, 3) for _ in range(5000)]
+        values += [-rng.expovariate(1) for _ in range(1000)] + [0.0] * 10
+        sketch = DDSketch(relative_accuracy=0.02)
+
+        for value in values:
+            sketch.observe(value)
+
+        for quantile in (0.0, 0.01, 0.1, 0.5, 0.9, 0.99, 1.0):
+            expected = _true_quantile(values, quantile)
+            self.assertLessEqual(abs(sketch.quantile(quantile) - expected),
+                                 0.02 * abs(expected) + 1e-12, quantile)
+
+    def test_batched_observations_match_single(self):
+        rng = random.Random(9)
+        values = [rng.gauss(0, 100) for _ in range(1000)] + [0.0, float('inf')]
+        one_at_a_time = DDSketch()
+        batched = DDSketch()
+
+        for value in values:
+            one_at_a_time.observe(value)
+        batched.observe_many(values)
+
+        quantiles = (0.01, 0.25, 0.5, 0.75, 0.99)
+        self.assertEqual(batched.summarize(quantiles), one_at_a_time.summarize(quantiles))
+
+    def test_merge_matches_single_sketch(self):
+        rng = random.Random(2)
+        values = [rng.uniform(1, 1000) for _ in range(2000)]
+        whole = DDSketch()
+        first, second = DDSketch(), DDSketch()
+
+        for value in values:
+            whole.observe(value)
+        first.observe_many(values[:700])
+        second.observe_many(values[700:])
+        first.merge(second)
+
+        quantiles = (0.01, 0.5, 0.99)
+        self.assertEqual(first.summarize(quantiles)[0], whole.summarize(quantiles)[0])
+        self.assertEqual(first.summarize(quantiles)[1], len(values))
+        with self.assertRaises(ValueError):
+            first.merge(DDSketch(relative_accuracy=0.05))
+
+    def test_bins_are_bounded(self):
+        sketch = DDSketch(relative_accuracy=0.01, max_bins=50)
+        values = [1.1 ** exponent for exponent in range(-500, 500)]
+
+        sketch.observe_many(values)
+
+        # Collapsing only loses accuracy for the lowest quantiles.
+        self.assertLessEqual(len(sketch._snapshot()[0]), 50)
+        self.assertAlmostEqual(sketch.quantile(1.0), values[-1], delta=0.01 * values[-1])
+        self.assertAlmostEqual(sketch.quantile(0.99), _true_quantile(values, 0.99),
+                               delta=0.01 * _true_quantile(values, 0.99))
+
+    def test_empty_sketch_has_nan_quantiles(self):
+        self.assertTrue(math.isnan(DDSketch().quantile(0.5)))
+
+    def test_sketch_is_collected_as_summary(self):
+        registry = prometheus_client.CollectorRegistry()
+        sketch = QuantileSketch('test_sketch', '', labelnames=('Breed',),
+                                quantiles=(0.5, 0.99), registry=registry)
+
+        sketch.labels('Tabby').observe_many([float(value) for value in range(1, 101)])
+
+        self.assertAlmostEqual(registry.get_sample_value(
+            'test_sketch', {'Breed': 'Tabby', 'quantile': '0.5'}), 50, delta=0.5)
+        self.assertAlmostEqual(registry.get_sample_value(
+            'test_sketch', {'Breed': 'Tabby', 'quantile': '0.99'}), 99, delta=1)
+        self.assertEqual(registry.get_sample_value(
+            'test_sketch_count', {'Breed': 'Tabby'}), 100)
+        self.assertEqual(registry.get_sample_value(
+            'test_sketch_sum', {'Breed': 'Tabby'}), 5050)
+        self.assertIn(b'# TYPE test_sketch summary', prometheus_client.generate_latest(registry))
+        with self.assertRaises(ValueError):
+            QuantileSketch('test_sketch_invalid', '', quantiles=(1.5,), registry=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import threading
+from unittest import TestCase, main
+
+import prometheus_client
+
+from metricrule.agent.mrworker import DropPolicy, RecordingWorker, RECORDINGS_COUNTER_NAME
+
+
+def _exported(outcome):
+    return prometheus_client.REGISTRY.get_sample_value(
+        RECORDINGS_COUNTER_NAME + '_total', {'outcome': outcome}) or 0
+
+
+class TestMrWorker(TestCase):
+    def test_records_submitted_items(self):
+        recorded = []
+        worker = RecordingWorker(lambda a, b: recorded.append((a, b)))
+
+        self.assertTrue(worker.submit(1, 2))
+        self.assertTrue(worker.submit(3, 4))
+        worker.flush()
+
+        self.assertEqual(recorded, [(1, 2), (3, 4)])
+        stats = worker.stats
+        self.assertEqual(stats.enqueued, 2)
+        self.assertEqual(stats.dropped, 0)
+        self.assertEqual(stats.processed, 2)
+
+    def test_drop_newest_when_full(self):
+        started = threading.Event()
+        release = threading.Event()
+        recorded = []
+
+        def record(value):
+            started.set()
+            release.wait()
+            recorded.append(value)
+
+        worker = RecordingWorker(record, max_queue_size=1)
+        dropped = _exported('dropped')
+        worker.submit('first')
+        started.wait()
+        self.assertTrue(worker.submit('second'))
+        self.assertFalse(worker.submit('third'))
+        release.set()
+        worker.flush()
+
+        self.assertEqual(recorded, ['first', 'second'])
+        self.assertEqual(worker.stats.dropped, 1)
+        self.assertEqual(_exported('dropped') - dropped, 1)
+
+    def test_drop_oldest_when_full(self):
+        started = threading.Event()
+        release = threading.Event()
+        recorded = []
+
+        def record(value):
+            started.set()
+            release.wait()
+            recorded.append(value)
+
+        worker = RecordingWorker(record, max_queue_size=1,
+                                 drop_policy=DropPolicy.DROP_OLDEST)
+        worker.submit('first')
+        started.wait()
+        worker.submit('second')
+        self.assertTrue(worker.submit('third'))
+        release.set()
+        worker.flush()
+
+        self.assertEqual(recorded, ['first', 'third'])
+        self.assertEqual(worker.stats.dropped, 1)
+        self.assertEqual(worker.stats.processed, 2)
+
+    def test_errors_do_not_stop_worker(self):
+        recorded = []
+
+        def record(value):
+            if value == 'bad':
+                raise ValueError(value)
+            recorded.append(value)
+
+        worker = RecordingWorker(record)
+        failed, processed = _exported('failed'), _exported('processed')
+        with self.assertLogs('metricrule.agent.mrworker'):
+            worker.submit('bad')
+            worker.flush()
+        worker.submit('good')
+        worker.flush()
+
+        self.assertEqual(recorded, ['good'])
+        self.assertEqual(worker.stats.processed, 2)
+        self.assertEqual(worker.stats.failed, 1)
+        self.assertEqual(_exported('failed') - failed, 1)
+        self.assertEqual(_exported('processed') - processed, 2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,297 @@
+import json
+import math
+import os
+import tempfile
+import time
 from unittest import TestCase, main
 
+import prometheus_client
+from werkzeug.test import Client
+
 from metricrule.agent import WSGIMetricsMiddleware
+from metricrule.agent.mrconfig import DriftConfig, RouteConfig, SamplingConfig
+
+
+def _write_config(config_data):
+    with tempfile.NamedTemporaryFile('w', suffix='.textproto', delete=False) as config_file:
+        config_file.write(config_data)
+    return config_file.name
+
+
+def _json_app(response_body, content_type='application/json'):
+    def app(environ, start_response):
+        start_response('200 OK', [('Content-Type', content_type)])
+        return [response_body]
+    return app
+
+
+def _echo_app(environ, start_response):
+    request_body = environ['wsgi.input'].read()
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [b'{"prediction": ', str(len(request_body)).encode(), b'}']
 
 
 class TestWsgiMiddleware(TestCase):
-    pass
+    def setUp(self):
+        self.config_path = None
+
+    def tearDown(self):
+        if self.config_path is not None:
+            os.remove(self.config_path)
+
+    def _make_middleware(self, name, app, **kwargs):
+        self.config_path = _write_config(f'''
+        input_metrics {{
+            name: "{name}_input"
+            simple_counter {{}}
+        }}
+        output_metrics {{
+            name: "{name}_output"
+            value {{
+                value {{
+                    parsed_value {{
+                        field_path: ".prediction"
+                        parsed_type: FLOAT
+                    }}
+                }}
+            }}
+        }}
+        ''')
+        if isinstance(app, bytes):
+            app = _json_app(app)
+        return WSGIMetricsMiddleware(app, self.config_path, **kwargs)
+
+    def test_records_request_and_response(self):
+        middleware = self._make_middleware(
+            'wsgi_sync', b'{"prediction": 0.5}')
+
+        response = Client(middleware).post(
+            '/predict', data=json.dumps({}), buffered=True)
+
+        self.assertEqual(response.get_data(), b'{"prediction": 0.5}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_sync_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('wsgi_sync_output_sum'), 0.5)
+        self.assertIsNone(middleware.recording_stats)
+
+    def test_records_in_background(self):
+        middleware = self._make_middleware(
+            'wsgi_background', b'{"prediction": 0.25}', background=True)
+
+        client = Client(middleware)
+        for _ in range(3):
+            response = client.post('/predict', data=json.dumps({}), buffered=True)
+            self.assertEqual(response.get_data(), b'{"prediction": 0.25}')
+        middleware._worker.flush()  # pylint: disable=protected-access
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(
+            registry.get_sample_value('wsgi_background_input_total'), 3)
+        self.assertEqual(
+            registry.get_sample_value('wsgi_background_output_sum'), 0.75)
+        stats = middleware.recording_stats
+        self.assertEqual(stats.enqueued, 3)
+        self.assertEqual(stats.processed, 3)
+        self.assertEqual(stats.dropped, 0)
+
+    def test_deterministic_sampling(self):
+        middleware = self._make_middleware(
+            'wsgi_sampled', b'{"prediction": 0.5}',
+            sampling=SamplingConfig(rate=0.5, deterministic=True))
+
+        client = Client(middleware)
+        # The crc32 of these bodies fall below and above half the range.
+        for body in (b'{"id": 1}', b'{"id": 1}', b'{"id": 9}'):
+            client.post('/predict', data=body, buffered=True)
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(
+            registry.get_sample_value('wsgi_sampled_input_total'), 4.0)
+        self.assertEqual(
+            registry.get_sample_value('wsgi_sampled_output_count'), 2.0)
+
+    def test_app_reads_request_body(self):
+        middleware = self._make_middleware('wsgi_echo', _echo_app)
+
+        response = Client(middleware).post(
+            '/predict', data=b'{"a": 1}', buffered=True)
+
+        self.assertEqual(response.get_data(), b'{"prediction": 8}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_echo_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('wsgi_echo_output_sum'), 8)
+
+    def test_routes(self):
+        output_only_path = _write_config('''
+        output_metrics {
+            name: "wsgi_routed_output"
+            value {
+                value {
+                    parsed_value {
+                        field_path: ".prediction"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        ''')
+        self.addCleanup(os.remove, output_only_path)
+        inputs = []
+
+        def app(environ, start_response):
+            inputs.append(environ['wsgi.input'])
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [b'{"prediction": 0.5}']
+        middleware = WSGIMetricsMiddleware(app, routes=[
+            RouteConfig('/predict', output_only_path, methods=('post',))])
+
+        originals = []
+
+        def server(environ, start_response):
+            originals.append(environ['wsgi.input'])
+            return middleware(environ, start_response)
+        client = Client(server)
+        for method, path in (('POST', '/predict'), ('GET', '/predict'), ('POST', '/health')):
+            client.open(path, method=method, data=b'{}', buffered=True)
+
+        # No request is captured, as the config does not read requests.
+        self.assertEqual(len(inputs), 3)
+        self.assertTrue(all(stream is original for stream, original in zip(inputs, originals)))
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_routed_output_count'), 1)
+
+    def test_request_over_capture_limit_is_passed_through(self):
+        middleware = self._make_middleware(
+            'wsgi_capped', _echo_app, max_capture_bytes=4)
+
+        response = Client(middleware).post(
+            '/predict', data=b'{"a": 1}', buffered=True)
+
+        self.assertEqual(response.get_data(), b'{"prediction": 8}')
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_capped_input_total'), 0)
+        self.assertEqual(registry.get_sample_value('wsgi_capped_output_count'), 0)
+
+    def test_streams_response_and_records_on_close(self):
+        yielded = []
+
+        def streaming_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            for chunk in (b'{"prediction": ', b'0.5}'):
+                yielded.append(chunk)
+                yield chunk
+        middleware = self._make_middleware('wsgi_streamed', streaming_app)
+
+        response = Client(middleware).post('/predict', data=b'{}')
+        iterator = iter(response.response)
+        self.assertEqual(next(iterator), b'{"prediction": ')
+        self.assertEqual(yielded, [b'{"prediction": '])
+        self.assertEqual(list(iterator), [b'0.5}'])
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_streamed_input_total'), 0)
+        response.close()
+        self.assertEqual(registry.get_sample_value('wsgi_streamed_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('wsgi_streamed_output_sum'), 0.5)
+
+    def test_skips_non_json_response(self):
+        middleware = self._make_middleware(
+            'wsgi_text', _json_app(b'{"prediction": 0.5}', 'text/html'))
+
+        Client(middleware).post('/predict', data=b'{}', buffered=True)
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_text_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('wsgi_text_output_count'), 0)
+
+    def test_skips_non_json_request(self):
+        decoded = []
+
+        def decoder(body):
+            decoded.append(body)
+            return json.loads(body)
+        middleware = self._make_middleware(
+            'wsgi_form', b'{"prediction": 0.5}', json_decoder=decoder)
+        client = Client(middleware)
+
+        client.post('/predict', data=b'{}', content_type='text/plain', buffered=True)
+        client.post('/predict', data=b'<html></html>', buffered=True)
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_form_input_total'), 0)
+        self.assertEqual(registry.get_sample_value('wsgi_form_output_count'), 2)
+        self.assertEqual(decoded, [b'{"prediction": 0.5}'] * 2)
+
+    def test_selective_decoding(self):
+        middleware = self._make_middleware(
+            'wsgi_selective', b'{"prediction": 0.5, "embedding": [' + b'0.1, ' * 2000 + b'0.1]}',
+            selective_decoding=True)
+
+        Client(middleware).post('/predict', data=b'{}', buffered=True)
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value('wsgi_selective_input_total'), 1)
+        self.assertEqual(registry.get_sample_value('wsgi_selective_output_sum'), 0.5)
+
+    def test_drift_scores_exported(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as baseline_file:
+            json.dump({'metrics': {'wsgi_drift_output': {'bounds': [1.0], 'counts': [1, 1]}}},
+                      baseline_file)
+        self.addCleanup(os.remove, baseline_file.name)
+        middleware = self._make_middleware(
+            'wsgi_drift', b'{"prediction": 0.5}',
+            drift=DriftConfig(baseline_file.name, windowSeconds=0.02, slices=1,
+                              gaugeName='wsgi_drift_score'))
+        self.addCleanup(middleware._routes.stop)
+
+        Client(middleware).post('/predict', data=b'{}', buffered=True)
+
+        labels = {'metric': 'wsgi_drift_output', 'measure': 'psi'}
+        deadline = time.monotonic() + 5
+        score = None
+        while time.monotonic() < deadline:
+            score = prometheus_client.REGISTRY.get_sample_value('wsgi_drift_score', labels)
+            if score is not None and not math.isnan(score):
+                break
+            time.sleep(0.01)
+        self.assertGreater(score, 1)
+
+    def test_context_labels_apply_to_all_response_rows(self):
+        self.config_path = _write_config('''
+        output_content_filter: ".predictions[*]"
+        output_metrics {
+            name: "wsgi_rows_output"
+            value {
+                value {
+                    parsed_value {
+                        field_path: "[0]"
+                        parsed_type: FLOAT
+                    }
+                }
+            }
+        }
+        context_labels_from_input {
+            label_key { string_value: "PetType" }
+            label_value {
+                parsed_value {
+                    field_path: ".Type"
+                    parsed_type: STRING
+                }
+            }
+        }
+        ''')
+        middleware = WSGIMetricsMiddleware(
+            _json_app(b'{"predictions": [[0.25], [0.5]]}'), self.config_path)
+
+        Client(middleware).post(
+            '/predict', data=b'{"Type": "Cat"}', buffered=True)
+
+        registry = prometheus_client.REGISTRY
+        self.assertEqual(registry.get_sample_value(
+            'wsgi_rows_output_count', {'PetType': 'Cat'}), 2)
+        self.assertEqual(registry.get_sample_value(
+            'wsgi_rows_output_sum', {'PetType': 'Cat'}), 0.75)
 
 
-if __name__ == 'main':
+if __name__ == '__main__':
     main()